@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Replays recorded clips through the tracker as fast as possible and reports its frame rate, the time spent in each
+# processing stage and the measurements it produced. No cameras (or brick) needed.
+# Usage:
+#   python benchmark.py CLIP [--configs full,roi]              Single camera
+#   python benchmark.py LEFT_CLIP RIGHT_CLIP [--output runs]   Stereo
+# A clip is a video file, an MJPEG file, a directory of images or a stream URL (see replay.py).
+import argparse
+import csv
+import time
+import tracemalloc
+import numpy as np
+import vision as vs
+
+# Tracker settings to compare (keyword arguments for vs.Vision)
+configurations = {
+    "full": {},
+    "roi": {"roi_tracking": True},
+    "coarse": {"scale": 0.5},
+    "roi+coarse": {"roi_tracking": True, "scale": 0.5},
+    "parallel": {"parallel": True},
+    "unfiltered": {"temporal_filter": False},
+    "rectified": {"rectify_frames": True},  # Needs a stereo calibration (vs.calibration_file)
+    "reduced": {"decode_scale": 0.5},  # Decodes MJPEG streams and files at half size
+    "ranges": {"color_table": None},  # Labels pixels with the HSV ranges even when there is a colour table
+}
+
+# Stages in pipeline order (stage timing is not available from inside parallel workers)
+stages = ["decode", "rectify", "resize", "hsv", "masks", "contours", "stereo"]
+
+
+# Runs every frame of the clips through a tracker with the given settings.
+# Output: The finished Vision object and the wall time it took
+def runBenchmark(clips, options):
+    started = time.perf_counter()
+    vision = vs.Vision(stereo=len(clips) == 2, display="headless", sources=clips, benchmark=True, **options)
+    vision.thread.join()
+    return vision, time.perf_counter() - started
+
+
+def report(name, vision, elapsed):
+    log = vision.measurement_log
+    frames = max(len(log), 1)
+    print(f"\n=== {name} ===")
+    print(f"Frames: {len(log)} in {elapsed:.2f} s ({len(log) / elapsed:.1f} fps)")
+    if vision.rejected_pairs:
+        print(f"Stereo pairs rejected: {vision.rejected_pairs}")
+
+    print("Stage latency per frame:")
+    for stage in stages:
+        if stage in vision.stage_times:
+            print(f"\t{stage:<10}{vision.stage_times[stage] * 1000 / frames:8.3f} ms")
+
+    angles = [measurement.angle for measurement in log if measurement.angle is not None]
+    distances = [measurement.distance for measurement in log if measurement.distance is not None]
+    colors = {}
+    for measurement in log:
+        if isinstance(measurement.color, str):
+            colors[measurement.color] = colors.get(measurement.color, 0) + 1
+    if vision.allocation_log:
+        # The first frame allocates the frame pool, every frame after it should reuse it
+        steady = np.array(vision.allocation_log[1:] or vision.allocation_log)
+        frame_bytes = np.prod(vision.detector.pool.shape) * 3
+        print(f"Detection allocations per frame after the first: median {np.median(steady) / 1024:.1f} kB, "
+              f"max {np.max(steady) / 1024:.1f} kB ({np.max(steady) / frame_bytes:.2f} frames), "
+              f"frame pool buffers allocated: {vision.detector.pool.allocations}")
+
+    print(f"Frames with an angle: {len(angles)}, with a distance: {len(distances)}, colors: {colors}")
+    if distances:
+        print(f"Distance: median {np.median(distances):.2f} cm, min {np.min(distances):.2f} cm, "
+              f"max {np.max(distances):.2f} cm")
+    if angles:
+        print(f"Angle: median {np.median(angles):.2f} deg, min {np.min(angles):.2f} deg, max {np.max(angles):.2f} deg")
+
+
+def writeMeasurements(path, log):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(vs.Measurement._fields)
+        for measurement in log:
+            writer.writerow(list(measurement))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded clips through the tracker and time it.")
+    parser.add_argument("clips", nargs="+", help="One clip (single camera) or two clips (left and right camera)")
+    parser.add_argument("--configs", default="full,roi,coarse,roi+coarse",
+                        help="Comma separated tracker settings to run: " + ", ".join(configurations))
+    parser.add_argument("--output", help="Write each run's measurements to OUTPUT_<config>.csv")
+    parser.add_argument("--allocations", action="store_true",
+                        help="Measure the memory detection allocates per frame (slows every stage down)")
+    args = parser.parse_args()
+    if len(args.clips) > 2:
+        parser.error("give one clip, or a left and a right clip")
+    if args.allocations:
+        tracemalloc.start()
+
+    for name in args.configs.split(","):
+        vision, elapsed = runBenchmark(args.clips, configurations[name])
+        report(name, vision, elapsed)
+        if args.output:
+            writeMeasurements(f"{args.output}_{name}.csv", vision.measurement_log)
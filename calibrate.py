@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Calibrates the two phone cameras from recorded clips of a printed checkerboard and writes the stereo calibration the
+# tracker uses (see vs.StereoCalibration). Record both cameras at once while moving the board around the whole view, at
+# different distances and tilts. Only frames where both cameras see the whole board are used for the stereo part.
+# Usage:
+#   python calibrate.py LEFT_CLIP RIGHT_CLIP [--board 9x6] [--square 2.5] [--step 10] [--output calibration.npz]
+# A clip is a video file or a directory of images.
+import argparse
+import cv2
+import numpy as np
+import vision as vs
+
+corner_flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | cv2.CALIB_CB_FAST_CHECK
+subpixel_criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+min_views = 5  # Fewest board views needed for a usable calibration
+
+
+# Output: The inner corners of the board in the frame, refined to subpixel accuracy, or None if it was not found
+def findCorners(frame, board):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    found, corners = cv2.findChessboardCorners(gray, board, corner_flags)
+    if not found:
+        return None
+    return cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), subpixel_criteria)
+
+
+# Looks for the board in every step-th frame pair of the clips.
+# Output: (left corners, right corners, frame size), with None where a camera did not see the board
+def collectViews(left_path, right_path, board, step):
+    left_clip = vs.RecordingSource(left_path)
+    right_clip = vs.RecordingSource(right_path)
+    left_views, right_views = [], []
+    size = None
+
+    frame_id = 0
+    while True:
+        left = left_clip.WaitForFrame(frame_id)
+        right = right_clip.WaitForFrame(frame_id)
+        if left is None or right is None:
+            break
+        frame_id = left[0]
+        if (frame_id - 1) % step != 0:
+            continue
+
+        frame_left, frame_right = left[2], right[2]
+        size = (frame_left.shape[1], frame_left.shape[0])
+        left_views.append(findCorners(frame_left, board))
+        right_views.append(findCorners(frame_right, board))
+
+    left_clip.Stop()
+    right_clip.Stop()
+    return left_views, right_views, size
+
+
+# Output: (camera matrix, distortion coefficients) of one camera, from every view it saw the board in
+def calibrateCamera(name, views, board_points, size):
+    views = [corners for corners in views if corners is not None]
+    if len(views) < min_views:
+        raise SystemExit(f"\t\tERROR: The {name} camera saw the board in only {len(views)} frames, need {min_views}")
+    error, matrix, distortion, _, _ = cv2.calibrateCamera([board_points] * len(views), views, size, None, None)
+    print(f"{name} camera: {len(views)} views, reprojection error {error:.3f} px, "
+          f"focal length {matrix[0, 0]:.1f} x {matrix[1, 1]:.1f} px, center ({matrix[0, 2]:.1f}, {matrix[1, 2]:.1f})")
+    return matrix, distortion
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the stereo cameras from checkerboard clips.")
+    parser.add_argument("left", help="Clip from the left camera")
+    parser.add_argument("right", help="Clip from the right camera, recorded at the same time")
+    parser.add_argument("--board", default="9x6", help="Inner corners of the board, COLUMNSxROWS")
+    parser.add_argument("--square", type=float, default=2.5, help="Side of one board square in centimeters")
+    parser.add_argument("--step", type=int, default=10, help="Use every STEP-th frame pair")
+    parser.add_argument("--output", default=vs.calibration_file, help="Calibration file to write")
+    args = parser.parse_args()
+
+    board = tuple(int(count) for count in args.board.lower().split("x"))
+    board_points = np.zeros((board[0] * board[1], 3), np.float32)
+    board_points[:, :2] = np.mgrid[0:board[0], 0:board[1]].T.reshape(-1, 2) * args.square
+
+    left_views, right_views, size = collectViews(args.left, args.right, board, args.step)
+    if size is None:
+        raise SystemExit("\t\tERROR: Could not read the clips")
+
+    # Intrinsics of each camera on its own first (more views), then only the pose of the right camera
+    K1, D1 = calibrateCamera("Left", left_views, board_points, size)
+    K2, D2 = calibrateCamera("Right", right_views, board_points, size)
+
+    pairs = [(left, right) for left, right in zip(left_views, right_views) if left is not None and right is not None]
+    if len(pairs) < min_views:
+        raise SystemExit(f"\t\tERROR: Both cameras saw the board in only {len(pairs)} frames, need {min_views}")
+    error, K1, D1, K2, D2, R, T, _, _ = cv2.stereoCalibrate(
+        [board_points] * len(pairs), [left for left, _ in pairs], [right for _, right in pairs], K1, D1, K2, D2, size,
+        flags=cv2.CALIB_FIX_INTRINSIC, criteria=subpixel_criteria)
+    print(f"Stereo: {len(pairs)} views, reprojection error {error:.3f} px, baseline {np.linalg.norm(T):.2f} cm")
+
+    np.savez(args.output, size=np.array(size), K1=K1, D1=D1, K2=K2, D2=D2, R=R, T=T)
+
+    # Build the rectification maps for the calibrated resolution now, so the tracker starts without that delay
+    calibration = vs.StereoCalibration(args.output)
+    calibration.Maps(size)
+    _, _, (P1, P2) = calibration.Rectification(size)
+    print(f"Rectified cameras: focal length {P1[0, 0]:.1f} px, center ({P1[0, 2]:.1f}, {P1[1, 2]:.1f}) px")
+    print(f"Wrote {args.output}")
@@ -3,28 +3,48 @@
     
 import socket
 import time
-from ev3dev2.motor import LargeMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C, SpeedPercent
+import queue
+import threading
+import protocol
+
+# "sysfs" drives the motors through their sysfs files directly (motors.py, also much quicker to import), "ev3dev2" through
+# ev3dev2. Both offer the same LargeMotor calls.
+MOTOR_BACKEND = "sysfs"
+if MOTOR_BACKEND == "sysfs":
+    from motors import LargeMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C, SpeedPercent
+else:
+    from ev3dev2.motor import LargeMotor, OUTPUT_A, OUTPUT_B, OUTPUT_C, SpeedPercent
 
 center_axle = LargeMotor(OUTPUT_A)
 rear_wheel_left = LargeMotor(OUTPUT_B)
 rear_wheel_right = LargeMotor(OUTPUT_C)
 
-def move_joints(command):
+OVERLAPPED_MOTION = True  # Steer straight from one command's angle to the next, and start the wheels while the axle settles
+STEERING_TOLERANCE = 5  # degrees (the wheels start once the center axle is this close to the commanded angle)
+STEERING_START_TIMEOUT = 100  # milliseconds to wait for the center axle to start turning (like a blocking ev3dev2 call)
+STEERING_TIMEOUT = 1.0  # seconds after which the wheels start even if the center axle has not reached the tolerance
+
+center_axle.position = 0  # The axle is straight when the program starts. Steering angles are absolute positions from here
+
+commands = queue.Queue()  # (command, sequence id, stop count when it arrived) waiting for the motion thread
+motion_lock = threading.Lock()  # Held while starting or stopping the rear wheels
+stop_count = 0  # STOP messages received so far. Commands that arrived before the latest one are cut short or dropped
+
+# Output: (degrees the rear wheels turned, seconds they ran), see run_wheels
+def move_joints(command, generation):
     direction, duration, speed = command
     direction = -direction  # Reverse the sign because center axle motor spins the other way
 
     print("EXECUTE: direction = " + str(-direction) + ", duration = " + str(duration) + ", speed = " + str(speed))
 
+    if OVERLAPPED_MOTION:
+        return overlapped_move(direction, duration, speed, generation)
+
     # Turn the center axle to the steering angle first (blocking call)
     center_axle.on_for_degrees(SpeedPercent(100), direction)  # Turn to angle to the marker
 
-    # Move the rear wheels simultaneously
-    rear_wheel_left.on_for_seconds(SpeedPercent(speed), duration, block=False)   # Push forward (go straight)
-    rear_wheel_right.on_for_seconds(SpeedPercent(speed), duration, block=False)  # Push forward (go straight)
-
-    # Wait for the rear wheels to finish their movements
-    rear_wheel_left.wait_while('running')
-    rear_wheel_right.wait_while('running')
+    # Move the rear wheels simultaneously and wait for them to finish their movements
+    moved = run_wheels(duration, speed, generation)
 
     # Reset center axle motor rotation back to 0 position
     if direction != 0:
@@ -33,45 +53,181 @@ def move_joints(command):
     print("Movement completed.")
 
     time.sleep(0.2)  # To account for delay when the camera feeds are not in sync
+    return moved
+
+
+# Turns the center axle straight from wherever the last command left it to the new steering angle (no return to 0 in
+# between), and starts the rear wheels as soon as the axle is within STEERING_TOLERANCE of it, or has stopped short of
+# it (stalled, or held against its end stop), or after STEERING_TIMEOUT.
+# Returns once the rear wheels have stopped: the DONE sent right after is the server's signal that the car has settled,
+# so there is no fixed sleep (the server skips frames from before it, see FEED_DELAY in server.py).
+def overlapped_move(direction, duration, speed, generation):
+    center_axle.on_to_position(SpeedPercent(100), direction, block=False)
+    if abs(center_axle.position - direction) > STEERING_TOLERANCE:
+        center_axle.wait_until('running', STEERING_START_TIMEOUT)
+    deadline = time.monotonic() + STEERING_TIMEOUT
+    while abs(center_axle.position - direction) > STEERING_TOLERANCE and generation == stop_count:
+        # Waits up to 5 ms for the axle to stop or stall, which ends the wait like the blocking on_for_degrees did
+        if center_axle.wait_until_not_moving(5) or time.monotonic() > deadline:
+            break
+
+    moved = run_wheels(duration, speed, generation)
 
+    print("Movement completed.")
+    return moved
+
+
+# Runs both rear wheels for the given time (unless a STOP arrived after the command did) and waits for them to stop.
+# Output: (degrees the rear wheels turned, on average, and seconds they ran), which is less than asked for if a STOP
+#         cut the movement short
+def run_wheels(duration, speed, generation):
+    start_left = rear_wheel_left.position
+    start_right = rear_wheel_right.position
+    started = time.monotonic()
+    with motion_lock:
+        if generation != stop_count:
+            return 0.0, 0.0
+        rear_wheel_left.on_for_seconds(SpeedPercent(speed), duration, block=False)   # Push forward (go straight)
+        rear_wheel_right.on_for_seconds(SpeedPercent(speed), duration, block=False)  # Push forward (go straight)
 
-def execute(data):
-    raw_command = data.split(',')
-    command = [float(value) for value in raw_command]
-    move_joints(command)
-    client.sendDone()
-    
+    rear_wheel_left.wait_while('running')
+    rear_wheel_right.wait_while('running')
+    run_time = time.monotonic() - started
+    travel = ((rear_wheel_left.position - start_left) + (rear_wheel_right.position - start_right)) / 2.0
+    return travel, run_time
+
+
+# Stops the rear wheels right away. The command running now is cut short and the ones queued behind it are dropped
+def stop_wheels():
+    global stop_count
+    with motion_lock:
+        stop_count += 1
+        rear_wheel_left.off()
+        rear_wheel_right.off()
+
+
+def stop_motors():
+    if OVERLAPPED_MOTION:
+        # Leave the axle straight, the next run assumes it starts that way
+        center_axle.on_to_position(SpeedPercent(100), 0)
+    for motor in (center_axle, rear_wheel_left, rear_wheel_right):
+        motor.off()
+
+
+# Runs the MOVE commands in the order they arrived, so the main thread is free to read a STOP at any time
+def motion_thread():
+    while True:
+        item = commands.get()
+        if item is None:
+            return
+        command, sequence, generation = item
+        if generation != stop_count:
+            client.sendReset(sequence)  # Dropped by a STOP before it started
+            continue
+        started = time.monotonic()
+        travel, run_time = move_joints(command, generation)
+        execution_time = time.monotonic() - started
+        if generation == stop_count:
+            client.sendDone(sequence, travel, run_time, execution_time)
+        else:
+            client.sendReset(sequence, travel, run_time, execution_time)
+
+
+# Sends the positions of all three motors to the laptop TELEMETRY_RATE times per second (see protocol.py), so it can
+# follow how far the car really drove and turned while a command runs. Positions are absolute, so a lost datagram costs
+# nothing but detail.
+def telemetry_thread(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    period = 1.0 / protocol.TELEMETRY_RATE
+    sample = 0
+    next_sample = time.monotonic()
+    while running:
+        sample += 1
+        datagram = protocol.telemetry(sample, time.monotonic(), center_axle.position, rear_wheel_left.position,
+                                      rear_wheel_right.position)
+        try:
+            sock.sendto(datagram, (host, protocol.TELEMETRY_PORT))
+        except OSError:
+            pass  # Nobody listening (yet), the next sample will do
+        # Keep the rate steady, without catching up on samples missed while the brick was busy
+        next_sample = max(next_sample + period, time.monotonic())
+        time.sleep(max(next_sample - time.monotonic(), 0))
+    sock.close()
 
 
 # This class handles the client side of communication. It has a set of predefined messages to send to the server as well as functionality to poll and decode data.
+# Messages are framed as described in protocol.py. Commands the server queues up while the brick is busy wait for the motion
+# thread, so a STOP is read (and acted on) while a movement is still running.
 class Client:
     def __init__(self, host, port):
         # We need to use the ipv4 address that shows up in ipconfig in the computer for the USB. Ethernet adapter handling the connection to the EV3
         print("Setting up client\nAddress: " + host + "\nPort: " + str(port))
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
         self.s.connect((host, port))                               
+        # Send small messages right away instead of waiting to batch them (Nagle's algorithm)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = protocol.MessageReader(self.s)
+        self.send_lock = threading.Lock()  # Replies come from both the motion thread and the main thread
+        self.safety_mode = False
         
-    # Block until a message from the server is received. When the message is received it will be decoded and returned as a string.
-    # Output: UTF-8 decoded string containing the instructions from server.
+    # Block until a message from the server is received, then act on it.
+    # Output: False once the server asked the client to exit (or closed the connection), True otherwise.
     def pollData(self):
         print("\nWaiting for Data")
-        data = self.s.recv(128).decode("UTF-8")
-        if data:
-            print("Data Received")
-            execute(data)
-            return data
+        message = self.reader.receive()
+        if message is None:
+            print("Connection closed")
+            stop_wheels()
+            finish_motion()
+            return False
+        
+        message_type, sequence, body = message
+        print("Data Received: " + protocol.NAMES.get(message_type, str(message_type)))
+        if message_type == protocol.MOVE:
+            commands.put((protocol.decodeMove(body), sequence, stop_count))
+        elif message_type == protocol.STOP:
+            stop_wheels()
+            self.sendDone(sequence)
+        elif message_type == protocol.EXIT:
+            finish_motion()
+            return False
+        elif message_type == protocol.SAFETY_ON:
+            self.safety_mode = True
+        elif message_type == protocol.SAFETY_OFF:
+            self.safety_mode = False
+        return True
     
     # Sends a message to the server letting it know that the movement of the motors was executed without any inconvenience.
-    def sendDone(self):
-        self.s.send("DONE".encode("UTF-8"))
+    # Like sendReset, it carries how far the rear wheels turned (degrees), for how long (seconds) and how long the whole
+    # command took to execute (seconds), so the laptop can tell time spent on the motors from time lost elsewhere.
+    def sendDone(self, sequence, travel=0.0, run_time=0.0, execution_time=0.0):
+        with self.send_lock:
+            self.s.sendall(protocol.encode(protocol.DONE, sequence,
+                                           protocol.movedBody(travel, run_time, execution_time)))
 
     # Sends a message to the server letting it know that there was an isse during the execution of the movement (obstacle avoided) and that the initial jacobian should be recomputed (Visual servoing started from scratch)
-    def sendReset(self):
-        self.s.send("RESET".encode("UTF-8"))
+    def sendReset(self, sequence, travel=0.0, run_time=0.0, execution_time=0.0):
+        with self.send_lock:
+            self.s.sendall(protocol.encode(protocol.RESET, sequence,
+                                           protocol.movedBody(travel, run_time, execution_time)))
+
+
+# Lets the motion thread finish the commands it was given, then stops all motors
+def finish_motion():
+    commands.put(None)
+    motion.join()
+    stop_motors()
 
 
 host = "169.254.182.18"
 port = 9999 
+running = True  # Cleared on exit to end the telemetry thread
 client = Client(host, port)
-while True:
-    client.pollData()
+motion = threading.Thread(target=motion_thread)
+motion.start()
+telemetry = threading.Thread(target=telemetry_thread, args=(host,), daemon=True)
+telemetry.start()
+while client.pollData():
+    pass
+running = False
+client.s.close()
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Measures how far coarse-to-fine detection (Vision scale below 1) moves the distance and angle readings compared with
+# full resolution detection, over recorded clips.
+# Usage:
+#   python drift.py VIDEO [SCALE]                    Single camera
+#   python drift.py LEFT_VIDEO RIGHT_VIDEO [SCALE]   Stereo
+import sys
+import time
+import cv2
+import numpy as np
+import vision as vs
+
+
+def readFrames(path):
+    vc = cv2.VideoCapture(path)
+    frames = []
+    rval, frame = vc.read()
+    while rval:
+        frames.append(frame)
+        rval, frame = vc.read()
+    vc.release()
+    return frames
+
+
+# Runs the same distance and angle calculations as the tracker on a set of detections.
+# Output: (distance, angle), either of which may be None
+def calculateReadings(calculator, detections, frame_shape):
+    calculator.distance = None
+    calculator.angle = None
+    calculator.color = None
+    frame_height, frame_width = frame_shape[:2]
+
+    if len(detections) == 1:
+        circle, color = detections[0]
+        if circle is not None:
+            calculator.color = color
+            calculator.SingleCameraCalculations(frame_height, frame_width, circle)
+    else:
+        (circle_left, color_left), (circle_right, color_right) = detections
+        if circle_left is not None and circle_right is not None and color_left == color_right:
+            size_difference = abs(circle_left[2] - circle_right[2]) / max(circle_left[2], circle_right[2])
+            if size_difference <= vs.size_threshold:
+                calculator.StereoVision(frame_width / 2, circle_left[0], circle_right[0])
+
+    return calculator.distance, calculator.angle
+
+
+def describe(name, differences, unit):
+    if len(differences) == 0:
+        print(f"{name}: no frames to compare")
+    else:
+        differences = np.abs(differences)
+        print(f"{name}: mean {np.mean(differences):.3f} {unit}, max {np.max(differences):.3f} {unit}")
+
+
+def measureDrift(streams, scale):
+    full = vs.MarkerDetector()
+    coarse = vs.MarkerDetector(scale=scale)
+    # The tracker's distance and angle calculations, without starting a tracker
+    calculator = vs.MarkerGeometry()
+
+    frame_count = min(len(frames) for frames in streams)
+    full_time = 0
+    coarse_time = 0
+    missed = 0
+    extra = 0
+    center_drift, radius_drift, distance_drift, angle_drift = [], [], [], []
+
+    for i in range(frame_count):
+        frames = [frames[i] for frames in streams]
+
+        started = time.perf_counter()
+        full_detections = [full.TrackLocation(frame, camera) for camera, frame in enumerate(frames)]
+        full_time += time.perf_counter() - started
+
+        started = time.perf_counter()
+        coarse_detections = [coarse.TrackLocation(frame, camera) for camera, frame in enumerate(frames)]
+        coarse_time += time.perf_counter() - started
+
+        # Compare the circles each camera saw
+        for (full_circle, full_color), (coarse_circle, coarse_color) in zip(full_detections, coarse_detections):
+            if full_circle is not None and coarse_circle is None:
+                missed += 1
+            elif full_circle is None and coarse_circle is not None:
+                extra += 1
+            elif full_circle is not None:
+                center_drift.append(np.hypot(*(coarse_circle[:2] - full_circle[:2])))
+                radius_drift.append(coarse_circle[2] - full_circle[2])
+
+        # Compare the readings the tracker would publish
+        full_distance, full_angle = calculateReadings(calculator, full_detections, frames[0].shape)
+        coarse_distance, coarse_angle = calculateReadings(calculator, coarse_detections, frames[0].shape)
+        if full_distance is not None and coarse_distance is not None:
+            distance_drift.append(coarse_distance - full_distance)
+        if full_angle is not None and coarse_angle is not None:
+            angle_drift.append(coarse_angle - full_angle)
+
+    print(f"Frames: {frame_count}, cameras: {len(streams)}, scale: {scale}")
+    print(f"Detection time per frame: full {full_time * 1000 / frame_count:.2f} ms, "
+          f"coarse-to-fine {coarse_time * 1000 / frame_count:.2f} ms")
+    print(f"Markers missed by coarse-to-fine: {missed}, markers only coarse-to-fine found: {extra}")
+    describe("Center drift", center_drift, "px")
+    describe("Radius drift", radius_drift, "px")
+    describe("Distance drift", distance_drift, "cm")
+    describe("Angle drift", angle_drift, "deg")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    scale = 0.5
+    try:
+        scale = float(args[-1])
+        args = args[:-1]
+    except (IndexError, ValueError):
+        pass
+    if len(args) not in (1, 2):
+        print("Usage: python drift.py VIDEO [SCALE] | python drift.py LEFT_VIDEO RIGHT_VIDEO [SCALE]")
+        sys.exit(1)
+
+    measureDrift([readFrames(path) for path in args], scale)
@@ -0,0 +1,143 @@
+# RUN ON LAPTOP
+# Latency histograms and counters for each stage of the loop: the tracker, the controller, the network and the brick.
+# Recording is a bucket lookup and a few additions under a lock, cheap enough to leave on during real runs. serve()
+# exposes the numbers over HTTP so they can be scraped while the car is running:
+#   /metrics        Plain text, one line per metric
+#   /metrics.jsonl  One JSON object per metric per line
+# Timings are in seconds. Each process has its own registry (stages timed inside vision's worker processes are missing).
+import json
+import time
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Upper bounds of the histogram buckets: 0.1 ms doubling up to about 26 s, plus one bucket for anything slower
+bucket_bounds = [0.0001 * 2 ** i for i in range(19)]
+
+
+# Counts of observations per bucket, plus their count, sum and largest value
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.largest = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(bucket_bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.largest:
+            self.largest = value
+
+    # Output: The upper bound of the bucket the given fraction of observations falls in (the largest value for the last)
+    def quantile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(bucket_bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.largest)
+        return self.largest
+
+    # Output: Dictionary of the summary statistics
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count, "mean": mean, "p50": self.quantile(0.5), "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99), "max": self.largest}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # Name -> Histogram
+        self.counters = {}  # Name -> count
+        self.started = time.monotonic()
+
+    # Records one latency (seconds) of the named stage
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    # Adds to the named counter
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Output: List of dictionaries, one per metric, in name order
+    def snapshot(self):
+        uptime = time.monotonic() - self.started
+        with self.lock:
+            rows = [dict(name=name, type="latency", **self.histograms[name].summary())
+                    for name in sorted(self.histograms)]
+            rows += [{"name": name, "type": "counter", "count": self.counters[name]} for name in sorted(self.counters)]
+        for row in rows:
+            row["uptime"] = uptime
+        return rows
+
+    # Output: The snapshot as plain text, latencies in milliseconds
+    def text(self):
+        lines = []
+        for row in self.snapshot():
+            if row["type"] == "latency":
+                lines.append(f"{row['name']:<28}count {row['count']:<7}mean {row['mean'] * 1000:9.2f} ms  "
+                             f"p50 {row['p50'] * 1000:9.2f} ms  p90 {row['p90'] * 1000:9.2f} ms  "
+                             f"p99 {row['p99'] * 1000:9.2f} ms  max {row['max'] * 1000:9.2f} ms")
+            else:
+                lines.append(f"{row['name']:<28}count {row['count']}")
+        return "\n".join(lines) + "\n"
+
+    # Output: The snapshot as JSON lines
+    def jsonl(self):
+        return "".join(json.dumps(row) + "\n" for row in self.snapshot())
+
+
+registry = Metrics()  # Shared by everything in the process
+
+
+def observe(name, seconds):
+    registry.observe(name, seconds)
+
+
+def count(name, amount=1):
+    registry.count(name, amount)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = registry.text(), "text/plain"
+        elif self.path == "/metrics.jsonl":
+            body, content_type = registry.jsonl(), "application/jsonl"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Serves the registry on localhost on its own thread.
+# Output: The MetricsServer, or None if the port could not be opened (the run goes on without it)
+def serve(port):
+    try:
+        server = MetricsServer(("127.0.0.1", port), MetricsHandler)
+    except OSError as error:
+        print(f"\t\tERROR: Could not serve metrics on port {port}: {error}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
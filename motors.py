@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# RUN ON BRICK (copy this file next to client.py on the brick)
+# Lean driver for the brick's tacho motors, a stand-in for the part of ev3dev2.motor that client.py uses (LargeMotor,
+# SpeedPercent and the OUTPUT_* ports) without its import time or its per-call overhead on the brick's slow CPU.
+# Each motor's sysfs attribute files are opened once and then read and written with a single pread or pwrite each.
+# Attributes that still hold the value a command needs (speed, time, stop action) are not written again, and waiting
+# for a state change sleeps in poll() until the driver signals the state file instead of reading it over and over.
+# The sysfs root can be any directory, so the driver runs against a fake tree (see make_fake_sysfs) on any Linux machine.
+# Usage (times the driver, and ev3dev2 where it is installed, without moving the motors):
+#   python3 motors.py               On the brick
+#   python3 motors.py --fake DIR    Anywhere, against a fake tree made in DIR
+import os
+import math
+import time
+import select
+import argparse
+
+SYSFS_ROOT = "/sys/class/tacho-motor"
+
+# Ports, named like ev3dev2's (their address attribute)
+OUTPUT_A = "ev3-ports:outA"
+OUTPUT_B = "ev3-ports:outB"
+OUTPUT_C = "ev3-ports:outC"
+OUTPUT_D = "ev3-ports:outD"
+
+state_poll_interval = 10  # Milliseconds between checks of a motor's state when its driver sends no change notifications
+wait_running_timeout = 100  # Milliseconds a blocking command waits for its motor to start (like ev3dev2)
+
+# Attribute files kept open for every motor, and how they are opened
+attribute_flags = {
+    "command": os.O_WRONLY,
+    "speed_sp": os.O_RDWR,
+    "time_sp": os.O_RDWR,
+    "position_sp": os.O_RDWR,
+    "stop_action": os.O_RDWR,
+    "position": os.O_RDWR,
+    "state": os.O_RDONLY,
+}
+
+
+class SpeedPercent:
+    def __init__(self, percent):
+        if not -100 <= percent <= 100:
+            raise ValueError("{} is an invalid percentage, must be between -100 and 100 (inclusive)".format(percent))
+        self.percent = percent
+
+    def to_native_units(self, motor):
+        return self.percent / 100.0 * motor.max_speed
+
+
+# Output: The sysfs directory of the motor plugged into the given port (see OUTPUT_A...)
+def find_motor(address, root=SYSFS_ROOT):
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        with open(os.path.join(path, "address")) as file:
+            if file.read().strip() == address:
+                return path
+    raise OSError("No tacho motor found on " + address + " in " + root)
+
+
+class LargeMotor:
+    # Input:
+    #   address [String]: Port the motor is plugged into (see OUTPUT_A...)
+    #   root [String]: Directory of the tacho-motor class, a fake tree for testing
+    def __init__(self, address, root=SYSFS_ROOT):
+        path = find_motor(address, root)
+        self.address = address
+        with open(os.path.join(path, "max_speed")) as file:
+            self.max_speed = int(file.read())  # Tacho counts per second at 100%
+        with open(os.path.join(path, "count_per_rot")) as file:
+            self.count_per_rot = int(file.read())
+        self.files = {name: os.open(os.path.join(path, name), flags) for name, flags in attribute_flags.items()}
+        self.written = {}  # Attribute -> the last value written to it, so it is not written again while unchanged
+        self.poller = select.poll()
+        self.poller.register(self.files["state"], select.POLLPRI)
+
+    # Output: The attribute's value as text. The file is kept open and read from the start every time
+    def read(self, name):
+        return os.pread(self.files[name], 64, 0).decode().split("\n", 1)[0].strip()
+
+    # Writes the attribute, like echo does (the driver parses "value\n" the same as "value"), unless it already holds the
+    # value (cached) or the value is a command
+    def write(self, name, value, cached=True):
+        if cached and self.written.get(name) == value:
+            return
+        os.pwrite(self.files[name], (str(value) + "\n").encode(), 0)
+        self.written[name] = value
+
+    @property
+    def position(self):
+        return int(self.read("position"))
+
+    @position.setter
+    def position(self, value):
+        self.write("position", int(value), cached=False)
+
+    # Output: The motor's state flags, e.g. ['running', 'ramping'] (empty when it is idle)
+    @property
+    def state(self):
+        return self.read("state").split()
+
+    # Output: Speed in tacho counts per second, from a SpeedPercent or a plain percentage
+    def speed_native_units(self, speed):
+        if not isinstance(speed, SpeedPercent):
+            speed = SpeedPercent(speed)
+        return speed.to_native_units(self)
+
+    def run(self, command, speed_sp, brake):
+        self.write("speed_sp", int(round(speed_sp)))
+        self.write("stop_action", "hold" if brake else "coast")
+        self.write("command", command, cached=False)
+
+    # Runs the motor for the given time, then stops it
+    def on_for_seconds(self, speed, seconds, brake=True, block=True):
+        if seconds < 0:
+            raise ValueError("seconds is negative ({})".format(seconds))
+        self.write("time_sp", int(seconds * 1000))
+        self.run("run-timed", self.speed_native_units(speed), brake)
+        if block:
+            self.wait_until_started_and_stopped()
+
+    # Turns the motor to the given absolute position (tacho counts)
+    def on_to_position(self, speed, position, brake=True, block=True):
+        self.write("position_sp", int(position))
+        self.run("run-to-abs-pos", self.speed_native_units(speed), brake)
+        if block:
+            self.wait_until_started_and_stopped()
+
+    # Turns the motor by the given degrees from where it is (backwards for a negative speed, like ev3dev2)
+    def on_for_degrees(self, speed, degrees, brake=True, block=True):
+        speed_sp = self.speed_native_units(speed)
+        if speed_sp < 0:
+            degrees, speed_sp = -degrees, -speed_sp
+        self.write("position_sp", int(round(degrees * self.count_per_rot / 360.0)))
+        self.run("run-to-rel-pos", speed_sp, brake)
+        if block:
+            self.wait_until_started_and_stopped()
+
+    def off(self, brake=True):
+        self.write("stop_action", "hold" if brake else "coast")
+        self.write("command", "stop", cached=False)
+
+    # Blocks until the condition holds for the motor's state flags.
+    # Output: False if the timeout (milliseconds, like ev3dev2) ran out first
+    def wait(self, condition, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000.0
+        while not condition(self.state):
+            wait = state_poll_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, int(math.ceil(remaining * 1000)))
+            # Returns as soon as the driver signals a state change, or after the interval if it never does
+            self.poller.poll(wait)
+        return True
+
+    def wait_while(self, state, timeout=None):
+        return self.wait(lambda flags: state not in flags, timeout)
+
+    def wait_until(self, state, timeout=None):
+        return self.wait(lambda flags: state in flags, timeout)
+
+    def wait_until_not_moving(self, timeout=None):
+        return self.wait(lambda flags: "running" not in flags or "stalled" in flags, timeout)
+
+    def wait_until_started_and_stopped(self):
+        self.wait_until("running", wait_running_timeout)
+        self.wait_until_not_moving()
+
+    def close(self):
+        for descriptor in self.files.values():
+            os.close(descriptor)
+        self.files = {}
+
+
+# Makes a fake tacho-motor class directory with one idle large motor per port, for running the driver off the brick.
+# Nothing acts on the commands written to it; a test changes state and position itself to play the motor's part.
+def make_fake_sysfs(root, addresses=(OUTPUT_A, OUTPUT_B, OUTPUT_C)):
+    attributes = {"driver_name": "lego-ev3-l-motor", "max_speed": "1050", "count_per_rot": "360", "state": "",
+                  "position": "0", "speed_sp": "0", "time_sp": "0", "position_sp": "0", "stop_action": "coast",
+                  "command": ""}
+    for number, address in enumerate(addresses):
+        path = os.path.join(root, "motor" + str(number))
+        os.makedirs(path, exist_ok=True)
+        for name, value in dict(attributes, address=address).items():
+            with open(os.path.join(path, name), "w") as file:
+                file.write(value + "\n")
+
+
+# Output: Microseconds per call of the function, over repeats calls
+def time_calls(function, repeats):
+    started = time.monotonic()
+    for _ in range(repeats):
+        function()
+    return (time.monotonic() - started) / repeats * 1e6
+
+
+# Times the calls client.py makes for every command, none of which moves the motor
+def time_motor(name, motor, speed, repeats):
+    print("{}:".format(name))
+    print("\tposition read       {:8.0f} us".format(time_calls(lambda: motor.position, repeats)))
+    print("\toff()               {:8.0f} us".format(time_calls(motor.off, repeats)))
+    print("\ton_for_seconds(0 s) {:8.0f} us".format(
+        time_calls(lambda: motor.on_for_seconds(speed, 0, block=False), repeats)))
+    print("\twait_while(running) {:8.0f} us".format(time_calls(lambda: motor.wait_while("running"), repeats)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the tacho motor driver (nothing moves).")
+    parser.add_argument("--fake", metavar="DIR", help="Make a fake sysfs tree in DIR and time the driver against it")
+    parser.add_argument("--repeats", type=int, default=200, help="Calls timed per operation")
+    args = parser.parse_args()
+
+    root = SYSFS_ROOT
+    if args.fake:
+        root = os.path.join(args.fake, "tacho-motor")
+        make_fake_sysfs(root)
+
+    started = time.monotonic()
+    motor = LargeMotor(OUTPUT_B, root)
+    print("motors.LargeMotor opened in {:.3f} s".format(time.monotonic() - started))
+    time_motor("motors", motor, SpeedPercent(0), args.repeats)
+    motor.close()
+
+    if not args.fake:
+        try:
+            started = time.monotonic()
+            import ev3dev2.motor
+        except ImportError:
+            print("ev3dev2 is not installed")
+        else:
+            print("ev3dev2.motor imported in {:.3f} s".format(time.monotonic() - started))
+            time_motor("ev3dev2", ev3dev2.motor.LargeMotor(ev3dev2.motor.OUTPUT_B),
+                       ev3dev2.motor.SpeedPercent(0), args.repeats)
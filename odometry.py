@@ -0,0 +1,107 @@
+# RUN ON LAPTOP
+# Dead reckoning from the brick's motor positions (see TELEMETRY in protocol.py): how far the car really drove and
+# turned, sample by sample, instead of what the commands asked for. The rear wheels give the distance travelled, the
+# center axle the steering angle, and the same bicycle model as calculateRotation in server.py turns them into a heading.
+# The pose starts at (0, 0), heading 0, wherever the car is when the first sample arrives.
+import math
+import time
+import socket
+import threading
+import metrics
+import protocol
+from collections import namedtuple
+from robot import WHEELBASE, WHEEL_CIRCUMFERENCE
+
+odometry_timeout = 0.5  # Seconds without a sample before the odometry stops counting as live
+
+# The car's pose after one telemetry sample. The pose is the middle of the rear axle, like simulator.World's.
+#   sequence [Integer]: Increases by one with every sample integrated (0 means none yet)
+#   timestamp [Float]: time.monotonic() when the sample arrived
+#   x, y [Float]: cm to the right of and ahead of where the car started
+#   heading [Float]: Radians turned since the start, positive to the right
+#   steering_angle [Float]: Degrees the center axle is at, positive steers right
+#   velocity [Float]: cm/s of the rear wheels over the last sample interval, negative when reversing
+#   turn_rate [Float]: Radians/s over the last sample interval, positive turning right
+Pose = namedtuple("Pose", ["sequence", "timestamp", "x", "y", "heading", "steering_angle", "velocity", "turn_rate"])
+
+
+# Receives the brick's telemetry on its own thread and integrates it into a live Pose.
+class Odometry:
+    # Input:
+    #   host [String]: Laptop address the brick sends its telemetry to
+    #   port [Integer]: UDP port it sends to
+    def __init__(self, host, port=protocol.TELEMETRY_PORT):
+        self.pose_ready = threading.Condition()
+        self.pose = Pose(0, None, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)  # Latest Pose
+        self.last_sample = None  # (sample number, brick time, axle, left wheel, right wheel) of the last sample used
+        self.lost = 0  # Samples that never arrived (or arrived too late to be used)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind((host, port))
+        except OSError as error:
+            print(f"\t\tERROR: Could not receive telemetry on port {port}: {error}")
+            return
+        receiver = threading.Thread(target=self.receiverThread, daemon=True)
+        receiver.start()
+
+    def receiverThread(self):
+        datagram = bytearray(protocol.TELEMETRY.size)
+        while True:
+            try:
+                size = self.sock.recv_into(datagram)
+            except OSError as error:
+                print(f"\t\tERROR: Telemetry stopped: {error}")
+                return
+            if size == protocol.TELEMETRY.size:
+                self.integrate(time.monotonic(), protocol.decodeTelemetry(datagram))
+
+    # Advances the pose by the motion between the last sample and this one.
+    # Input:
+    #   arrived [Float]: time.monotonic() when the sample arrived
+    #   sample [Tuple]: The decoded sample (see protocol.TELEMETRY)
+    def integrate(self, arrived, sample):
+        number, brick_time, axle, left, right = sample
+        last = self.last_sample
+        # Datagrams can arrive out of order. Order by the brick's clock, since the sample number restarts with client.py
+        if last is not None and brick_time <= last[1]:
+            self.lost += 1
+            metrics.count("odometry.lost")
+            return
+        if last is not None and number > last[0] + 1:
+            self.lost += number - last[0] - 1
+            metrics.count("odometry.lost", number - last[0] - 1)
+        self.last_sample = sample
+        metrics.count("odometry.samples")
+
+        pose = self.pose
+        steering_angle = -axle  # The center axle motor turns the other way (see move_joints in client.py)
+        x, y, heading, velocity, turn_rate = pose.x, pose.y, pose.heading, 0.0, 0.0
+        if last is not None:
+            dt = brick_time - last[1]
+            travel = ((left - last[3]) + (right - last[4])) / 2.0 / 360.0 * WHEEL_CIRCUMFERENCE  # cm
+            # Bicycle model, with the mean steering angle over the interval (see World.step in simulator.py)
+            last_steering_angle = -last[2]
+            turn = travel * math.tan(math.radians((steering_angle + last_steering_angle) / 2.0)) / WHEELBASE
+            x += travel * math.sin(heading + turn / 2)
+            y += travel * math.cos(heading + turn / 2)
+            heading += turn
+            velocity, turn_rate = travel / dt, turn / dt
+            metrics.observe("odometry.interval", dt)
+
+        with self.pose_ready:
+            self.pose = Pose(pose.sequence + 1, arrived, x, y, heading, steering_angle, velocity, turn_rate)
+            self.pose_ready.notify_all()
+
+    # Output: True if a sample arrived in the last odometry_timeout seconds
+    def isLive(self):
+        timestamp = self.pose.timestamp
+        return timestamp is not None and time.monotonic() - timestamp < odometry_timeout
+
+    # Blocks until a pose newer than after_sequence is available.
+    # Output: The latest Pose, or None if the timeout (seconds) ran out first
+    def waitForPose(self, after_sequence, timeout=None):
+        with self.pose_ready:
+            if self.pose_ready.wait_for(lambda: self.pose.sequence > after_sequence, timeout):
+                return self.pose
+            return None
@@ -0,0 +1,100 @@
+# RUN ON LAPTOP AND BRICK (copy this file next to client.py on the brick)
+# Message framing shared by the Server (laptop) and the Client (EV3 brick).
+#
+# Every message is a fixed header followed by a body:
+#   header: body length [unsigned short], message type [unsigned byte], sequence id [unsigned int]  (network byte order)
+#   body:   depends on the message type (empty for most)
+# The sequence id of a command is echoed back in its acknowledgement, so several commands can be in flight at once.
+import struct
+
+HEADER = struct.Struct("!HBI")
+
+# Message types
+MOVE = 1          # Laptop -> brick. Body: MOVE_BODY
+DONE = 2          # Brick -> laptop. The command with the same sequence id finished. Body: MOVED_BODY
+RESET = 3         # Brick -> laptop. The command with the same sequence id was cut short. Body: MOVED_BODY
+EXIT = 4          # Laptop -> brick. Stop the motors and exit
+SAFETY_ON = 5     # Laptop -> brick. Enable safety mode
+SAFETY_OFF = 6    # Laptop -> brick. Disable safety mode
+STOP = 7          # Laptop -> brick. Stop the wheels now: the running command and the queued ones end with RESET, and the
+                  # STOP itself is answered with DONE once the wheels are off
+
+NAMES = {MOVE: "MOVE", DONE: "DONE", RESET: "RESET", EXIT: "EXIT", SAFETY_ON: "SAFETY_ON", SAFETY_OFF: "SAFETY_OFF",
+         STOP: "STOP"}
+
+# Telemetry: the brick sends its motor positions TELEMETRY_RATE times per second to this UDP port on the laptop, one
+# datagram per sample, outside the framed TCP connection (a late sample is worth nothing, so nothing is resent)
+TELEMETRY_PORT = 9998
+TELEMETRY_RATE = 50  # Samples per second
+
+# MOVE body: steering angle [float, degrees], duration [float, seconds], speed [signed byte, percent]
+MOVE_BODY = struct.Struct("!ffb")
+
+# DONE and RESET body: how far the rear wheels actually turned [float, degrees, negative when reversing] and for how long
+# [float, seconds], so the laptop knows how much of a command that was cut short really happened, and how long the brick
+# spent executing the command [float, seconds, steering included]
+MOVED_BODY = struct.Struct("!fff")
+
+# Telemetry sample: sample number [unsigned int], brick clock [double, seconds, monotonic], and the positions of the
+# center axle, the left rear wheel and the right rear wheel motors [signed ints, degrees]
+TELEMETRY = struct.Struct("!Idiii")
+
+
+# Output: The bytes of one framed message, ready for sendall
+def encode(message_type, sequence, body=b""):
+    return HEADER.pack(len(body), message_type, sequence) + body
+
+
+def moveBody(direction, duration, speed):
+    return MOVE_BODY.pack(direction, duration, int(round(speed)))
+
+
+def decodeMove(body):
+    return MOVE_BODY.unpack(body)
+
+
+def movedBody(wheel_degrees, run_time, execution_time):
+    return MOVED_BODY.pack(wheel_degrees, run_time, execution_time)
+
+
+def decodeMoved(body):
+    return MOVED_BODY.unpack(body)
+
+
+def telemetry(sample, brick_time, axle, left, right):
+    return TELEMETRY.pack(sample, brick_time, axle, left, right)
+
+
+def decodeTelemetry(datagram):
+    return TELEMETRY.unpack(datagram)
+
+
+# Reads exactly size bytes from a socket into the buffer.
+# Output: False if the connection closed first
+def receiveInto(sock, buffer, size):
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:size])
+        if count == 0:
+            return False
+        received += count
+    return True
+
+
+# Reads framed messages from a socket, reusing one buffer for the header.
+class MessageReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.header = bytearray(HEADER.size)
+
+    # Blocks until a whole message has arrived.
+    # Output: (message type, sequence id, body bytes), or None if the connection was closed
+    def receive(self):
+        if not receiveInto(self.sock, self.header, HEADER.size):
+            return None
+        length, message_type, sequence = HEADER.unpack(self.header)
+        body = bytearray(length)
+        if length > 0 and not receiveInto(self.sock, body, length):
+            return None
+        return message_type, sequence, bytes(body)
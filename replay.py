@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Serves recorded clips as live MJPEG streams, the way the phones' IP Webcam app does, so the tracker's stream reading
+# and decoding can be run and timed without the phones. MJPEG files (e.g. saved with curl from a phone's /video) are
+# sent as they are; video files and image directories are encoded to JPEG once when loading.
+# Usage:
+#   python replay.py CLIP [--port 8081] [--fps 30] [--loop]              Serves /single/video
+#   python replay.py LEFT_CLIP RIGHT_CLIP [--port 8081] [--fps 30]       Serves /left/video and /right/video
+# then point the tracker at the printed URLs, e.g. python benchmark.py URL [URL] --configs full,reduced
+import time
+import argparse
+import cv2
+import numpy as np
+import vision as vs
+import simulator
+
+jpeg_quality = 90  # For clips that are not MJPEG already
+
+
+# Output: The JPEGs of every frame of a clip
+def loadJpegs(path):
+    if path.lower().endswith(vs.RecordingSource.mjpeg_extensions):
+        jpegs = []
+        with open(path, "rb") as file:
+            parser = vs.MjpegParser(file)
+            buffer, length = parser.ReadFrame(bytearray(vs.jpeg_buffer_size))
+            while length > 0:
+                jpegs.append(bytes(buffer[:length]))
+                buffer, length = parser.ReadFrame(buffer)
+        return jpegs
+
+    clip = vs.RecordingSource(path)
+    jpegs = []
+    latest = clip.WaitForFrame()
+    while latest is not None:
+        frame_id, _, frame = latest
+        jpegs.append(cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes())
+        latest = clip.WaitForFrame(frame_id)
+    return jpegs
+
+
+# Output: A CameraServer view that sends a clip's JPEGs in order, over and over if loop is set
+def clipView(jpegs, loop):
+    def view(frame_number):
+        if frame_number >= len(jpegs) and not loop:
+            return None
+        return jpegs[frame_number % len(jpegs)]
+    return view
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve recorded clips as IP Webcam style MJPEG streams.")
+    parser.add_argument("clips", nargs="+", help="One clip (single camera) or two clips (left and right camera)")
+    parser.add_argument("--port", type=int, default=simulator.camera_port, help="Port to serve the streams on")
+    parser.add_argument("--fps", type=float, default=30, help="Frames per second to send")
+    parser.add_argument("--loop", action="store_true", help="Start the clips over instead of ending the streams")
+    args = parser.parse_args()
+    if len(args.clips) > 2:
+        parser.error("give one clip, or a left and a right clip")
+
+    urls = simulator.cameraUrls(len(args.clips) == 2, port=args.port)
+    views = {}
+    for url, path in zip(urls, args.clips):
+        jpegs = loadJpegs(path)
+        if not jpegs:
+            raise SystemExit(f"\t\tERROR: Could not read {path}")
+        print(f"{url}: {len(jpegs)} frames, {np.mean([len(jpeg) for jpeg in jpegs]) / 1024:.0f} kB per frame")
+        views[url[url.index("/", len("http://")):]] = clipView(jpegs, args.loop)
+
+    cameras = simulator.CameraServer(args.port, views, args.fps)
+    print("Serving, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        cameras.shutdown()
@@ -0,0 +1,14 @@
+# RUN ON LAPTOP
+# Physical parameters of the car, shared by the controller (server.py) and the simulated brick (simulator.py)
+import math
+
+MAX_STEERING_ANGLE = 35  # degrees
+MAX_MOTOR_SPEED = 1050  # degrees per second
+WHEEL_DIAMETER = 5.6  # cm
+WHEELBASE = 14.75  # cm (distance between front and rear axles)
+CAMERA_OFFSET = WHEELBASE  # cm (the cameras sit on the front axle, the car turns around the rear one)
+
+# Calculate maximum linear speed (circumference * rotations per second)
+WHEEL_CIRCUMFERENCE = math.pi * WHEEL_DIAMETER
+MAX_ROTATIONS_PER_SEC = MAX_MOTOR_SPEED / 360.0
+MAX_SPEED_CM_PER_SEC = WHEEL_CIRCUMFERENCE * MAX_ROTATIONS_PER_SEC
@@ -1,85 +1,313 @@
 #!/usr/bin/python
 # RUN ON LAPTOP USING PYTHON 3.6
+import os
+import sys
 import time
 import math
 import socket
+import threading
+import metrics
+import protocol
+import session
+import odometry as od
 import vision as vs
 from queue import Queue
+from collections import namedtuple
+from robot import MAX_STEERING_ANGLE, WHEELBASE, CAMERA_OFFSET, WHEEL_CIRCUMFERENCE, MAX_SPEED_CM_PER_SEC
+
+# The brick's answer to a command: "DONE" or "RESET" (cut short), how far the rear wheels moved (cm) and for how long (s),
+# and how long the brick took to execute the whole command (s)
+Reply = namedtuple("Reply", ["status", "travel", "run_time", "execution_time"])
 
 # This class handles the Server side of the communication between the laptop and the brick.
+# Messages are framed (see protocol.py) and every command carries a sequence id, so the next command can be queued on the
+# brick while it is still executing the current one. A receiver thread matches the brick's replies to their commands.
+# The brick is accepted on that thread too, so everything else can start up while it connects (see waitForConnection).
 class Server:
     def __init__(self, host, port):
         # setup server socket
         serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow restarting right away (simulated runs), instead of waiting for the old socket to time out
+        serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # We need to use the IP address that shows up in ipconfig for the USB ethernet adapter that handles the communication between the PC and the brick
         print("Setting up Server\nAddress: " + host + "\nPort: " + str(port))
 
         serversocket.bind((host, port))
         # queue up to 5 requests
         serversocket.listen(5)
+        self.cs = None
+        self.connected = threading.Event()  # Set once the brick is connected
+
+        self.send_lock = threading.Lock()
+        self.next_sequence = 1
+        self.replies = threading.Condition()
+        self.received = {}  # Sequence id -> Reply for commands that have been answered
+        self.last_reply_time = time.monotonic()  # When the brick last reported it finished a command
+        self.pending_stops = {}  # STOP sequence id -> (capture time of the frame that caused it, time sent, reason)
+        self.stop_latencies = []  # Seconds from seeing red to the brick reporting its wheels stopped, for every red STOP
+        self.in_flight = []  # (sequence id, steering angle, speed) of the commands the brick has not answered yet, in order
+        self.on_motion = None  # Called with (steering angle, speed) whenever the command the brick is running changes
+        self.sent_times = {}  # Sequence id -> when it was sent, for the MOVE commands that have not been answered yet
+        self.decision_started = None  # When the controller started acting on a measurement (it has not sent a command yet)
+        self.recorder = None  # session.SessionRecorder every command and reply is recorded with, if set
+
+        receiver = threading.Thread(target=self.ReceiverThread, args=(serversocket,), daemon=True)
+        receiver.start()
+
+    def ReceiverThread(self, serversocket):
         self.cs, addr = serversocket.accept()
+        # Send small messages right away instead of waiting to batch them (Nagle's algorithm)
+        self.cs.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         print("Connected to: " + str(addr))
-
-    # Sends set of commands to the brick via TCP.
+        self.connected.set()
+
+        reader = protocol.MessageReader(self.cs)
+        while True:
+            message = reader.receive()
+            if message is None:
+                print("\t\tERROR: Connection to the brick closed")
+                break
+            message_type, sequence, body = message
+            if self.recorder is not None:
+                self.recordMessage(session.REPLY, message_type, sequence, body)
+            with self.replies:
+                previous_reply_time = self.last_reply_time
+                self.last_reply_time = time.monotonic()
+                if sequence in self.pending_stops:
+                    self.reportStop(sequence)
+                    # The STOP cut short the commands sent before it. Ones sent after it still run on the brick
+                    self.in_flight = [command for command in self.in_flight if command[0] > sequence]
+                    self.reportMotion()
+                    continue
+                if self.in_flight and self.in_flight[0][0] <= sequence:
+                    self.in_flight = [command for command in self.in_flight if command[0] > sequence]
+                    self.reportMotion()
+                wheel_degrees, run_time, execution_time = protocol.decodeMoved(body)
+                reply = Reply(protocol.NAMES.get(message_type, str(message_type)),
+                              wheel_degrees / 360.0 * WHEEL_CIRCUMFERENCE, run_time, execution_time)
+                self.received[sequence] = reply
+                self.recordReply(sequence, reply, previous_reply_time)
+                self.replies.notify_all()
+
+    # Records the latencies of a command the brick just answered (self.replies held):
+    #   command.round_trip: from sending the command to its reply, time queued behind earlier commands included
+    #   command.overhead: the part of the round trip the brick was neither executing the command nor busy with an earlier
+    #                     one, i.e. the network and the message handling on both ends
+    #   brick.execution, brick.wheels: how long the brick took for the whole command, and how long its rear wheels ran
+    # Commands cut short by a STOP are only counted.
+    def recordReply(self, sequence, reply, previous_reply_time):
+        sent = self.sent_times.pop(sequence, None)
+        if sent is None:
+            return
+        metrics.count("command." + reply.status.lower())
+        if reply.status != "DONE":
+            return
+        metrics.observe("command.round_trip", self.last_reply_time - sent)
+        started = max(sent, previous_reply_time)  # The brick starts a queued command when it answers the one before
+        metrics.observe("command.overhead", max(self.last_reply_time - started - reply.execution_time, 0.0))
+        metrics.observe("brick.execution", reply.execution_time)
+        metrics.observe("brick.wheels", reply.run_time)
+
+    # Blocks until the brick is connected. Output: False if the timeout (seconds) ran out first
+    def waitForConnection(self, timeout=None):
+        return self.connected.wait(timeout)
+
+    # Sends one message. Output: Its sequence id
+    def send(self, message_type, body=b""):
+        with self.send_lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            self.cs.sendall(protocol.encode(message_type, sequence, body))
+        if self.recorder is not None:
+            self.recordMessage(session.COMMAND, message_type, sequence, body)
+        return sequence
+
+    # Records a message sent to or received from the brick, with its body decoded
+    def recordMessage(self, kind, message_type, sequence, body):
+        event = {"sequence": sequence, "type": protocol.NAMES.get(message_type, str(message_type))}
+        if message_type == protocol.MOVE:
+            event.update(zip(["direction", "duration", "speed"], protocol.decodeMove(body)))
+        elif len(body) == protocol.MOVED_BODY.size:
+            event.update(zip(["wheel_degrees", "run_time", "execution_time"], protocol.decodeMoved(body)))
+        self.recorder.recordEvent(kind, event)
+
+    # Queues a movement command on the brick without waiting for it to finish.
+    # Input:
+    #   direction [Float]: Degrees to turn the center axle motor (steering angle)
+    #   duration [Float]: Time in seconds to move the rear wheels
+    #   speed [Integer]: Speed percentage for the rear wheels (-100 to 100)
+    # Output: The command's sequence id, to wait on with waitForReply
+    def sendCommand(self, direction, duration, speed):
+        print(f"\tSending Data: ({direction:.2f},{duration:.2f},{speed}) to robot.")
+        with self.replies:
+            sent = time.monotonic()
+            if self.decision_started is not None:
+                metrics.observe("controller.decision", sent - self.decision_started)
+                self.decision_started = None
+            sequence = self.send(protocol.MOVE, protocol.moveBody(direction, duration, speed))
+            self.sent_times[sequence] = sent
+            self.in_flight.append((sequence, direction, speed))
+            if len(self.in_flight) == 1:
+                self.reportMotion()
+        return sequence
+
+    # Lets on_motion know what the brick is doing now: running the oldest unanswered command, or standing still.
+    # The brick starts a queued command as soon as it answers the one before, so this follows it closely (self.replies held)
+    def reportMotion(self):
+        if self.on_motion is not None:
+            steering_angle, speed = self.in_flight[0][1:] if self.in_flight else (0, 0)
+            self.on_motion(steering_angle, speed)
+
+    # Output: True once the brick has answered the command with the given sequence id (waitForReply still returns it)
+    def isAnswered(self, sequence):
+        with self.replies:
+            return sequence in self.received
+
+    # Blocks until the brick answers the command with the given sequence id.
+    # Replies to earlier commands that nobody waited for are dropped.
+    # Output: The Reply, or None if the timeout (seconds) ran out first
+    def waitForReply(self, sequence, timeout=None):
+        with self.replies:
+            if not self.replies.wait_for(lambda: sequence in self.received, timeout):
+                return None
+            for earlier in [s for s in self.received if s < sequence]:
+                del self.received[earlier]
+            return self.received.pop(sequence)
+
+    # Sends set of commands to the brick via TCP and waits for the brick to finish them.
     # Input:
     #   direction [Float]: Degrees to turn the center axle motor (steering angle)
     #   duration [Float]: Time in seconds to move the rear wheels
-    #   speed [Integer]: Speed percentage for the rear wheels (0 to 100)
+    #   speed [Integer]: Speed percentage for the rear wheels (-100 to 100)
     #   queue [Thread-safe Queue]: Mutable data structure to store (and return) the messages received from the client
     def sendData(self, direction, duration, speed, queue):
-        # Format in which the client expects the data: "direction,duration,speed"
-        data = f"{direction:.2f},{duration:.2f},{speed}"
-        print(f"\tSending Data: ({data}) to robot.")
-        self.cs.send(data.encode("UTF-8"))
+        sequence = self.sendCommand(direction, duration, speed)
         # Waiting for the client (EV3 brick) to let the server know that it is done moving
-        reply = self.cs.recv(128).decode("UTF-8")
-        queue.put(reply)
+        queue.put(self.waitForReply(sequence))
+
+    # Tells the brick to stop its wheels right away, cutting short the command it is running and dropping the queued ones
+    # (they are answered with RESET). Called from the tracker thread for red markers, without waiting for the controller.
+    # Input:
+    #   detected [Float]: Capture time (time.monotonic) of the frame that called for the stop
+    #   reason [String]: What was seen, for the latency report
+    def sendStop(self, detected, reason="red was seen"):
+        if not self.connected.is_set():
+            return  # Nothing moves before the brick is connected
+        with self.replies:
+            sequence = self.send(protocol.STOP)
+            self.pending_stops[sequence] = (detected, time.monotonic(), reason)
+
+    # Prints how long the STOP with the given sequence id took, now that the brick has answered it (self.replies held)
+    def reportStop(self, sequence):
+        detected, sent, reason = self.pending_stops.pop(sequence)
+        latency = self.last_reply_time - detected
+        metrics.observe("command.stop", self.last_reply_time - sent)
+        if reason == "red was seen":
+            self.stop_latencies.append(latency)
+            metrics.observe("stop.red", latency)
+        print(f"STOP: Wheels stopped {latency * 1000:.0f} ms after {reason} "
+              f"(detection to STOP sent {(sent - detected) * 1000:.0f} ms, "
+              f"STOP sent to stopped {(self.last_reply_time - sent) * 1000:.0f} ms)")
 
     # Sends a termination message to the client. This will cause the client to exit "cleanly", after stopping the motors.
     def sendTermination(self):
-        self.cs.send("EXIT".encode("UTF-8"))
+        self.send(protocol.EXIT)
 
     # Lets the client know that it should enable safety mode on its end
     def sendEnableSafetyMode(self):
-        self.cs.send("SAFETY_ON".encode("UTF-8"))
+        self.send(protocol.SAFETY_ON)
 
     # Lets the client know that it should disable safety mode on its end
     def sendDisableSafetyMode(self):
-        self.cs.send("SAFETY_OFF".encode("UTF-8"))
+        self.send(protocol.SAFETY_OFF)
+
 
 
+SIMULATION = "--simulate" in sys.argv  # Drive simulator.py's brick and cameras instead of the car
+if SIMULATION:
+    import simulator  # Only the simulation needs it, so a real run skips its import (and its HTTP server modules)
+RECORDING = "--record" in sys.argv  # Record the frames, measurements and commands of the run (see session.py)
 
-host = "169.254.182.18"
+host = "127.0.0.1" if SIMULATION else "169.254.182.18"
 port = 9999
-server = Server(host, port)
+startup = time.monotonic()
+server = Server(host, port)  # The brick connects while the tracker starts up
+odometry = od.Odometry(host)  # The brick streams its motor positions to the same address (see protocol.TELEMETRY)
 queue = Queue()
 
 STEREOVISION = True
-MAX_STEERING_ANGLE = 35  # degrees
-MAX_MOTOR_SPEED = 1050  # degrees per second
+ROI_TRACKING = True  # Search around the last detected marker instead of the whole frame
+DISPLAY = "headless"  # Set to "preview" (or "window") to watch the cameras
+DETECTION_SCALE = 1.0  # Below 1 (e.g. 0.5), look for markers in a downscaled frame first. Check drift with drift.py
+PARALLEL_DETECTION = False  # Detect markers in one process per camera (Linux only for now, see vs.Vision)
 MAX_DURATION = 5  # seconds (max duration for turns to prevent overly long turns)   ##### Can actually be 2 theoretically. CHECK #####
 if STEREOVISION:
     TOLERANCE = 17.5  # degrees (tolerance for angle to the marker)
 else:
     TOLERANCE = 15
-WHEEL_DIAMETER = 5.6  # cm
-WHEELBASE = 14.75  # cm (distance between front and rear axles)
 # CALIBRATION_FACTOR = 3.45  # Derived from practical tests (1.90 / 0.55 ≈ 3.45)
-
-# Calculate maximum linear speed (circumference * rotations per second)
-WHEEL_CIRCUMFERENCE = math.pi * WHEEL_DIAMETER
-MAX_ROTATIONS_PER_SEC = MAX_MOTOR_SPEED / 360.0
-MAX_SPEED_CM_PER_SEC = WHEEL_CIRCUMFERENCE * MAX_ROTATIONS_PER_SEC
-
-vision = vs.Vision(stereo=STEREOVISION)
+DISTANCE_WINDOW = 5  # Frames the distance to the marker is taken as the median over
+MIN_DISTANCE_READINGS = 3  # Fresh distance readings needed (since the last move) before driving straight
+MAX_TRUSTED_DISTANCE = 70  # cm (longer moves are not trusted, wait for a better reading)
+FEED_DELAY = 0.2  # seconds (how far the camera feeds lag behind the car; frames this soon after a move are not trusted)
+# Simulated course, 5 runs each: 4.3-5.7 s (median 4.8 s) with ODOMETRY_TURNS, 5.4-8.2 s (median 6.5 s) with timed turns.
+# Not yet timed on the car: set it to False there to fall back to timed turns if odometry turns do not pay off.
+ODOMETRY_TURNS = True  # Stop turns towards a marker once the odometry says the car faces it (see watchTurn)
+STOP_LEAD = 0.03  # seconds (how long the car keeps turning once a turn is complete, until the STOP reaches the brick)
+BRICK_TIMEOUT = 60  # seconds (how long to wait at startup for client.py on the brick to connect)
+METRICS_PORT = 8082  # Latency metrics are served on http://127.0.0.1:8082/metrics (and /metrics.jsonl), see metrics.py
+SESSIONS_DIRECTORY = "sessions"  # Recorded runs go in a directory named after their start time in here
+
+metrics.serve(METRICS_PORT)
+
+recorder = None
+if RECORDING:
+    session_path = os.path.join(SESSIONS_DIRECTORY, time.strftime("%Y%m%d-%H%M%S"))
+    print("Recording to: " + session_path)
+    recorder = session.SessionRecorder(session_path)
+    server.recorder = recorder
+
+vision = vs.Vision(stereo=STEREOVISION, roi_tracking=ROI_TRACKING, display=DISPLAY,
+                   parallel=PARALLEL_DETECTION, scale=DETECTION_SCALE,
+                   sources=simulator.cameraUrls(STEREOVISION) if SIMULATION else None,
+                   on_red=lambda measurement: server.sendStop(measurement.timestamp), recorder=recorder)
 print("Tracker Initializing...")
-time.sleep(5)  # Wait for the tracker to initialize
-
 
-def calculateRotation(angle):
+# Start as soon as the tracker has processed its first frames and the brick is connected, whichever comes last
+if not vision.WaitUntilReady():
+    print("\t\tERROR: The tracker processed no frames, check the camera streams")
+    vision.Stop()
+    if server.connected.is_set():
+        server.sendTermination()
+    sys.exit(1)
+if not server.waitForConnection(max(BRICK_TIMEOUT - (time.monotonic() - startup), 0)):
+    print(f"\t\tERROR: The brick did not connect within {BRICK_TIMEOUT} seconds, is client.py running?")
+    vision.Stop()
+    sys.exit(1)
+metrics.observe("startup.ready", time.monotonic() - startup)
+print(f"Ready after {time.monotonic() - startup:.2f} seconds")
+
+
+# Passes the motion of the command the brick is running on to the tracker, so it can predict where markers will be seen,
+# and lets it slow down while the car moves (unless a scan is watching the measurements). Once the brick is idle, the
+# tracker skips straight to the first settled frame, which the next decision waits for (see nextMeasurement).
+def reportMotion(steering_angle, speed):
+    velocity = (speed / 100.0) * MAX_SPEED_CM_PER_SEC  # cm/s
+    turn_rate = velocity * math.tan(math.radians(steering_angle)) / WHEELBASE  # radians/s (see calculateRotation)
+    vision.SetMotion(velocity, turn_rate)
+    if speed == 0:
+        vision.Resume(server.last_reply_time + FEED_DELAY)
+    elif not scanning:
+        vision.Throttle()
+
+
+server.on_motion = reportMotion
+
+
+# speed is the rear wheels' speed percentage: slow, to make the turn
+def calculateRotation(angle, speed=25):
     # Rotate robot towards the marker
     angle = angle * 1.5  # (Overshoot just in case it's a sharp turn)
-    speed = 25  # Slow speed to make the turn
     # Desired change in heading angle (Δϕ)
     desired_angle = angle
     # Steering angle (θ) is limited by robot's capability. Can be equal to any angle, even vision.angle.
@@ -107,7 +335,10 @@ def calculateRotation(angle):
             duration = 0
     return desired_angle, steering_angle, duration, speed
 
-def rotateRobot(desired_angle, steering_angle, duration, speed, towards=True):
+# With wait=False the command is only queued on the brick, so the next one can follow without a network round trip.
+# Given the marker's measured (distance, angle) and live odometry (ODOMETRY_TURNS), the turn is stopped as soon as the
+# car faces the marker (see watchTurn), so the overshoot built into calculateRotation only bounds how long it may take.
+def rotateRobot(desired_angle, steering_angle, duration, speed, towards=True, wait=True, marker=None):
     if duration > 0:
         if towards:
             print(f"ROTATE: Rotating robot by {desired_angle:.2f} degrees towards marker over {duration:.2f} seconds.")
@@ -118,138 +349,321 @@ def rotateRobot(desired_angle, steering_angle, duration, speed, towards=True):
                 print(f"ROTATE: Rotating robot by {desired_angle:.2f} degrees backwards over {duration:.2f} seconds.")
 
         # Send command to robot
-        server.sendData(steering_angle, duration, speed, queue)
-        # Wait for robot to complete the action
-        reply = queue.get()
-        print("\tRobot reply:", reply)
+        if not wait:
+            server.sendCommand(steering_angle, duration, speed)
+            return
+        if ODOMETRY_TURNS and marker is not None and odometry.isLive():
+            sequence = server.sendCommand(steering_angle, duration, speed)
+            watchTurn(sequence, *marker)
+            reply = server.waitForReply(sequence)
+        else:
+            server.sendData(steering_angle, duration, speed, queue)
+            # Wait for robot to complete the action
+            reply = queue.get()
+        print(f"\tRobot reply: {reply.status} ({reply.travel:.1f} cm in {reply.run_time:.2f} s)")
 
     else:
         print("Speed is zero or duration is zero, not moving.")
 
 
-if __name__ == "__main__":
-    
-    checked_back = False
-    checked_left = False
-    checked_right = False
-
+# Follows the car with the odometry while the brick runs a turn, and stops the wheels once the cameras face the marker.
+# The marker's bearing is worked out from the pose for every telemetry sample, so the car moving along its arc is
+# allowed for. Without a distance, the marker is taken as far away, which makes the turn stop after turning by angle.
+# Input:
+#   sequence [Integer]: Sequence id of the turn command
+#   distance [Float]: cm from the cameras to the marker when the turn started (None if not measured)
+#   angle [Float]: Degrees to the marker when the turn started (positive to the right)
+def watchTurn(sequence, distance, angle):
+    start = odometry.pose
+    direction = math.copysign(1, angle)
+    if distance is not None:
+        # Marker position in the odometry's frame: ahead of the cameras, which sit CAMERA_OFFSET ahead of the rear axle
+        ahead = CAMERA_OFFSET + distance * math.cos(math.radians(angle))
+        right = distance * math.sin(math.radians(angle))
+        marker_x = start.x + ahead * math.sin(start.heading) + right * math.cos(start.heading)
+        marker_y = start.y + ahead * math.cos(start.heading) - right * math.sin(start.heading)
+
+    pose = start
+    while not server.isAnswered(sequence):
+        latest = odometry.waitForPose(pose.sequence, timeout=od.odometry_timeout)
+        if latest is None:
+            return  # Telemetry lost, so the turn runs for as long as it was sent for
+        pose = latest
+        if distance is None:
+            bearing = angle - math.degrees(pose.heading - start.heading)
+        else:
+            dx = marker_x - (pose.x + CAMERA_OFFSET * math.sin(pose.heading))
+            dy = marker_y - (pose.y + CAMERA_OFFSET * math.cos(pose.heading))
+            bearing = math.degrees(math.atan2(dx, dy) - pose.heading)
+            bearing = (bearing + 180) % 360 - 180
+        # Where the bearing will be by the time the STOP reaches the brick
+        if direction * (bearing - math.degrees(pose.turn_rate) * STOP_LEAD) <= 0:
+            server.sendStop(pose.timestamp, "the turn was complete")
+            return
+
+
+##### Controller States ##########################################
+TRACKING = "tracking"  # Marker in view, turning towards it
+APPROACHING = "approaching"  # Facing the marker, driving up to it (or waiting for enough fresh distance readings)
+STOPPED = "stopped"  # Red marker in view
+REVERSING = "reversing"  # No marker in view, backed up to look for one
+CHECKING_LEFT = "checking left"  # Turned left to look for a marker
+CHECKING_RIGHT = "checking right"  # Turned back and then right to look for a marker
+REVERSING_MORE = "reversing more"  # Turned back and reversed further, next is another look left, then right
+CHECK_ANGLE = 30  # degrees (how far to turn when looking left and right for a marker)
+SCAN_SPEED = 15  # Speed percentage of the rear wheels when sweeping left and right for a marker
+SCAN_CONFIRMATIONS = 2  # Measurements in a row that must show a marker before a sweep is cut short
+SCAN_TIMEOUT = 0.5  # seconds (longest wait for a measurement during a sweep before checking on the brick again)
+STOP_REPLY_TIMEOUT = 5  # seconds (longest wait for the brick to answer the legs a STOP cut short before giving up on it)
+##################################################################
+
+last_sweep = None  # (steering angle, seconds it actually ran, speed) of the last search sweep
+scanning = False  # A scan is watching the measurements while the brick moves, so the tracker must keep its full rate
+
+
+# Blocks until the tracker publishes a measurement newer than after_sequence, from a frame taken after the robot settled
+# from its last move.
+# Output: The Measurement, or None if the tracker stopped
+def nextMeasurement(after_sequence):
     while True:
-        print()
-        # Get vision data
-        angle = vision.angle
-        distance = vision.distance
-        color = vision.color
-
-        # Determine speed
-        if color == 'green':
-            speed = 50
-        elif color == 'yellow':
-            speed = 25
-        elif color == 'red':
-            speed = 0
+        measurement = vision.WaitForMeasurement(after_sequence, timeout=1)
+        if measurement is None:
+            if not vision.thread.is_alive():
+                print("\t\tERROR: Tracker stopped")
+                return None
+            continue
+        after_sequence = measurement.sequence
+        # The brick replies once the car has stopped. Frames from before that (and the feed delay) are stale
+        if measurement.timestamp >= server.last_reply_time + FEED_DELAY:
+            return measurement
+
+
+# A marker is in view: turn towards it, or drive up to it once it is straight ahead.
+# Output: The next state
+def trackMarker(measurement):
+    angle = measurement.angle
+    color = measurement.color
+
+    # Determine speed
+    if color == 'green':
+        speed = 50
+    elif color == 'yellow':
+        speed = 25
+    else:
+        speed = 0  # Default to 0 speed
+
+    # Rotate the robot until robot is facing the marker
+    if math.ceil(abs(angle)) > TOLERANCE or color is None:
+        desired_angle, steering_angle, duration, speed = calculateRotation(angle)
+        # Only a marker seen by both cameras is where the angle says (otherwise the angle is a hint which way to turn)
+        marker = (measurement.distance, angle) if color is not None else None
+        rotateRobot(desired_angle, steering_angle, duration, speed, marker=marker)
+        return TRACKING
+
+    # Angle is approximately zero; move straight towards the marker.
+    # Use the median distance over the last few frames captured since the robot stopped, to filter out bad readings.
+    distance = vision.history.Median("distance", DISTANCE_WINDOW, since=server.last_reply_time + FEED_DELAY,
+                                     minimum=MIN_DISTANCE_READINGS)
+    if distance is None:
+        # Not enough fresh readings yet, wait for the next frame
+        return APPROACHING
+
+    if color == 'green':
+        if STEREOVISION:
+            distance = distance - 25  # (Undershoot extra for fast speed to be able to see the next marker)
+        else:
+            distance = distance - 35  # (Undershoot extra for fast speed to be able to see the next marker)
+    else:
+        if STEREOVISION:
+            distance = distance - 20  # (Undershoot to be able to see the next marker)
         else:
-            speed = 0  # Default to 0 speed
-
-        # Move robot
-        if angle is not None and color != 'red':
-            # Marker detected, so reset checked_back, checked_left, and checked_right
-            checked_back = False
-            checked_left = False
-            checked_right = False
-            
-            # Rotate the robot until robot is facing the marker
-            if math.ceil(abs(angle)) > TOLERANCE or color is None:
-                desired_angle, steering_angle, duration, speed = calculateRotation(angle)
-                rotateRobot(desired_angle, steering_angle, duration, speed)
+            distance = distance - 30  # (Undershoot to be able to see the next marker)
+    direction = 0
 
-            else:
-                # Angle is approximately zero; move straight towards the marker
-                if color == 'green':
-                    if STEREOVISION:
-                        distance = distance - 25  # (Undershoot extra for fast speed to be able to see the next marker)
-                    else:
-                        distance = distance - 35  # (Undershoot extra for fast speed to be able to see the next marker)
-                else:
-                    if STEREOVISION:
-                        distance = distance - 20  # (Undershoot to be able to see the next marker)
-                    else:
-                        distance = distance - 30  # (Undershoot to be able to see the next marker)
-                direction = 0
-
-                if distance is not None and math.floor(distance) > 0:
-                    # Ignore incorrect, unreasonable distance readings
-                    if distance > 70:
-                        continue
-
-                    # Calculate linear speed
-                    speed_cm_per_sec = (speed / 100.0) * MAX_SPEED_CM_PER_SEC  # cm/s
-
-                    # Calculate duration to move based on distance
-                    duration = distance / speed_cm_per_sec  # seconds
-
-                    print(f"MOVE: Moving forward {distance:.2f}cm at {speed*2}% speed for {duration:.2f} seconds.")
-
-                    # Send command to robot
-                    server.sendData(direction, duration, speed, queue)
-                    # Wait for robot to complete the action
-                    reply = queue.get()
-                    print("\tRobot reply:", reply)
-
-                else:
-                    if math.floor(distance) <= 0:
-                        print(f"MOVE: Moving forward for 1 second to find next marker.")
-                        # Send command to robot
-                        server.sendData(direction, 1, 25, queue)
-                        # Wait for robot to complete the action
-                        reply = queue.get()
-                        print("\tRobot reply:", reply)
-                    print("ERROR: No valid distance, not moving.")
+    if math.floor(distance) > 0:
+        # Ignore incorrect, unreasonable distance readings (wait for a better one)
+        if distance > MAX_TRUSTED_DISTANCE:
+            return APPROACHING
+
+        # Calculate linear speed
+        speed_cm_per_sec = (speed / 100.0) * MAX_SPEED_CM_PER_SEC  # cm/s
+
+        # Calculate duration to move based on distance
+        duration = distance / speed_cm_per_sec  # seconds
 
+        print(f"MOVE: Moving forward {distance:.2f}cm at {speed*2}% speed for {duration:.2f} seconds.")
+
+        # Send command to robot
+        server.sendData(direction, duration, speed, queue)
+        # Wait for robot to complete the action
+        reply = queue.get()
+        print(f"\tRobot reply: {reply.status} ({reply.travel:.1f} cm in {reply.run_time:.2f} s)")
+
+    else:
+        print(f"MOVE: Moving forward for 1 second to find next marker.")
+        # Send command to robot
+        server.sendData(direction, 1, 25, queue)
+        # Wait for robot to complete the action
+        reply = queue.get()
+        print(f"\tRobot reply: {reply.status} ({reply.travel:.1f} cm in {reply.run_time:.2f} s)")
+    return TRACKING
+
+
+# Sweeps through search legs with the tracker watching: the legs are queued on the brick back to back, and the sweep is
+# cut short (STOP) as soon as a marker shows up in SCAN_CONFIRMATIONS measurements in a row. Only legs that steer are
+# watched: backing up straight mostly brings back the marker that was just reached.
+# Input: legs [List]: (steering angle, duration, speed) of each leg
+# Output: The brick's Reply to every leg, and whether a marker was found, or None if the brick stopped answering
+def scan(legs):
+    global scanning
+    scanning = True
+    try:
+        return watchLegs(legs)
+    finally:
+        scanning = False
+
+
+# scan without the duty cycle bookkeeping
+def watchLegs(legs):
+    started = time.monotonic()
+    sequences = [server.sendCommand(*leg) for leg in legs]
+    replies = []
+    measurement = vision.measurement
+    confirmations = 0
+
+    while len(replies) < len(sequences):
+        reply = server.waitForReply(sequences[len(replies)], timeout=0)
+        if reply is not None:
+            replies.append(reply)
+            continue
+
+        # Wakes up for every new measurement while the brick is moving
+        latest = vision.WaitForMeasurement(measurement.sequence, timeout=SCAN_TIMEOUT)
+        if latest is None:
+            continue
+        measurement = latest
+        sweeping = legs[len(replies)][0] != 0
+        if sweeping and measurement.timestamp > started and measurement.angle is not None:
+            confirmations += 1
         else:
-            # Red marker detected, so stop
-            if color == 'red':
-                print("STOP: Red!")
-                time.sleep(1)
+            confirmations = 0
+        if confirmations == SCAN_CONFIRMATIONS:
+            server.sendStop(measurement.timestamp, "a marker was found")
+            for sequence in sequences[len(replies):]:
+                reply = server.waitForReply(sequence, timeout=STOP_REPLY_TIMEOUT)
+                if reply is None:
+                    print(f"\t\tERROR: The brick did not answer within {STOP_REPLY_TIMEOUT} seconds of the STOP, "
+                          "search aborted")
+                    return None
+                replies.append(reply)
+            return replies, True
+
+    return replies, False
+
+
+# A search leg that turns the robot by the given angle, slowly enough for the tracker to catch a marker on the way
+def sweepLeg(angle):
+    desired_angle, steering_angle, duration, speed = calculateRotation(angle, SCAN_SPEED)
+    print(f"\tSweeping {desired_angle:.2f} degrees over {duration:.2f} seconds.")
+    return steering_angle, duration, speed
+
+
+# A search leg that undoes the last sweep, as far as the brick reported it actually went
+def returnLeg():
+    steering_angle, run_time, speed = last_sweep
+    print(f"\tReturning to the original track over {run_time:.2f} seconds.")
+    return steering_angle, run_time, -speed
+
+
+# No marker in view: back up, then look left, then right, then back up further and look again. Every step is a
+# continuous scan (see scan), so the search ends as soon as a marker comes into view.
+# Output: The next state, or None if the brick stopped answering
+def searchForMarker(state):
+    global last_sweep
+    print("No marker detected.")
+    reverse_leg = (0, 2, -25)
+
+    if state in (REVERSING, REVERSING_MORE):
+        legs = []
+        # Reverse then turn for single camera
+        if not STEREOVISION and state == REVERSING:
+            print("\tRobot is reversing to search for markers.")
+            legs.append(reverse_leg)
+        # Check left side first
+        print("\tRobot is checking left side for markers.")
+        legs.append(sweepLeg(-CHECK_ANGLE))
+        next_state = CHECKING_LEFT
+    elif state == CHECKING_LEFT:
+        # Check right side, but first reverse back to original track
+        print("\tRobot is checking right side for markers.")
+        legs = [returnLeg(), sweepLeg(CHECK_ANGLE)]
+        next_state = CHECKING_RIGHT
+    elif state == CHECKING_RIGHT:
+        # Reverse to check, but first reverse back to original track
+        print("\tRobot is reversing more to search for markers.")
+        legs = [returnLeg(), reverse_leg]
+        next_state = REVERSING_MORE
+    else:
+        # The marker was just lost. Reverse a little, then check left and right
+        if not STEREOVISION:
+            return REVERSING
+        print("\tRobot is reversing to search for markers.")
+        legs = [reverse_leg]
+        next_state = REVERSING
+
+    result = scan(legs)
+    if result is None:
+        return None
+    replies, found = result
+    for (steering_angle, duration, speed), reply in zip(legs, replies):
+        if reply.status == "RESET":
+            print(f"\tLeg cut short after {reply.run_time:.2f} of {duration:.2f} seconds ({reply.travel:.1f} cm).")
+    # Remember how far the sweep really went, so the way back matches it
+    steering_angle, duration, speed = legs[-1]
+    if steering_angle != 0:
+        last_sweep = (steering_angle, replies[-1].run_time, speed)
+
+    if found:
+        print("\tMarker found, search stopped.")
+        return TRACKING
+    return next_state
 
-            # No marker detected, robot is idle
-            else:
-                print("No marker detected.")
-
-                check_angle = 30
-                
-                if not checked_back and not checked_left and not checked_right:
-                    # Reverse a little, then check left and right
-                    checked_back = True
-                    if STEREOVISION:
-                        print("\tRobot is reversing to search for markers.")
-                        rotateRobot(0, 0, 2, -25, towards=False)
-                elif checked_back and not checked_left and not checked_right:
-                    # Reverse then turn for single camera
-                    if not STEREOVISION:
-                        print("\tRobot is reversing to search for markers.")
-                        rotateRobot(0, 0, 2, -25, towards=False)
-                    # Check left side first
-                    checked_left = True
-                    print("\tRobot is checking left side for markers.")
-                    desired_angle, steering_angle, duration, speed = calculateRotation(-check_angle)
-                    rotateRobot(desired_angle, steering_angle, duration, speed)
-                elif checked_back and checked_left and not checked_right:
-                    # Check right side, but first reverse back to original track
-                    desired_angle, steering_angle, duration, speed = calculateRotation(-check_angle)
-                    rotateRobot(desired_angle, steering_angle, duration, -speed, towards=False)
-                    
-                    checked_right = True
-                    print("\tRobot is checking right side for markers.")
-                    desired_angle, steering_angle, duration, speed = calculateRotation(check_angle)
-                    rotateRobot(desired_angle, steering_angle, duration, speed)
-                elif checked_back and checked_left and checked_right:
-                    # Reverse to check, but first reverse back to original track
-                    desired_angle, steering_angle, duration, speed = calculateRotation(check_angle)
-                    rotateRobot(desired_angle, steering_angle, duration, -speed, towards=False)
-
-                    print("\tRobot is reversing more to search for markers.")
-                    rotateRobot(0, 0, 2, -25, towards=False)
-                else:
-                    # Both sides checked, robot is idle
-                    print("\tBoth sides checked. No marker detected, robot is idle.")
-                    time.sleep(1)
+
+if __name__ == "__main__":
+    # Event driven: every step waits for a fresh measurement (and every move for the brick's reply), and acts on each
+    # measurement once
+    state = TRACKING
+    measurement = vision.measurement
+
+    while True:
+        measurement = nextMeasurement(measurement.sequence)
+        if measurement is None:
+            break
+        server.decision_started = time.monotonic()
+        metrics.observe("controller.measurement_age", server.decision_started - measurement.timestamp)
+
+        if measurement.color == 'red':
+            # Red marker detected, so stop
+            if state != STOPPED:
+                print("\nSTOP: Red!")
+            next_state = STOPPED
+        elif measurement.angle is not None:
+            if state != APPROACHING:
+                print()
+            next_state = trackMarker(measurement)
+        else:
+            print()
+            next_state = searchForMarker(state)
+            if next_state is None:
+                break
+
+        if next_state != state:
+            print(f"\t[{state} -> {next_state}]")
+            metrics.count("controller.transitions")
+        state = next_state
+
+    vision.Stop()
+    if recorder is not None:
+        recorder.close()
+        print(f"Recorded {session_path} ({recorder.dropped_frames} frames dropped)")
+    print(metrics.registry.text())
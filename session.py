@@ -0,0 +1,357 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Records a run so a bad one can be looked at (and run through the tracker) again: the raw frames of every camera as the
+# tracker received them, every published measurement, and every command sent to the brick with its reply.
+# Recording never waits on the disk. Entries are handed to a writer thread through a bounded queue; when the disk falls
+# behind, frames are dropped (and counted) instead of stalling the tracker. Events are only dropped if the queue is full.
+#
+# A session is a directory:
+#   session.json    What was recorded: camera names, the tracker's settings, drop counts (rewritten as they change)
+#   chunk_NNNNN.bin Entry payloads back to back: raw frame pixels, or JSON for events. A new chunk starts every chunk_size
+#   index.bin       One fixed-size record per entry (see index_dtype), in the order they were written, so any entry can
+#                   be found without reading the chunks and read with one seek
+# Usage:
+#   python session.py SESSION                           Summary of a recorded session
+#   python session.py SESSION --events                  Also print every measurement, command and reply in order
+#   python session.py SESSION --replay [--realtime]     Run the recorded frames through the tracker again, as fast as
+#                                                       possible or at their original timing, and compare measurements
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+import metrics
+
+##### Recording Parameters #######################################
+chunk_size = 256 * 1024 * 1024  # Bytes per chunk file
+queue_size = 1024  # Entries waiting for the writer at most (events can use all of it)
+frame_queue_size = 64  # Frames waiting for the writer at most. Further frames are dropped until it catches up.
+index_flush_interval = 1.0  # Seconds between index flushes, so a crashed run still leaves a readable session
+##################################################################
+
+header_file = "session.json"
+index_file = "index.bin"
+
+# Entry kinds
+FRAME = 0
+MEASUREMENT = 1
+COMMAND = 2
+REPLY = 3
+KINDS = {FRAME: "frame", MEASUREMENT: "measurement", COMMAND: "command", REPLY: "reply"}
+
+# Index record of one entry:
+#   kind: One of the entry kinds
+#   camera: Position of the frame's camera in the header's cameras (0 for events)
+#   recorded: time.monotonic() when the entry was recorded
+#   captured: Capture time of a frame (or of a measurement's frames); recorded for other events
+#   chunk, offset, length: Where its payload is
+#   height, width, channels: Shape of a frame's pixels (uint8)
+index_dtype = np.dtype([("kind", "u1"), ("camera", "u1"), ("recorded", "<f8"), ("captured", "<f8"), ("chunk", "<u4"),
+                        ("offset", "<u8"), ("length", "<u4"), ("height", "<u2"), ("width", "<u2"), ("channels", "u1")])
+
+
+# Output: True if the path is a recorded session
+def isSession(path):
+    return os.path.isfile(os.path.join(path, index_file))
+
+
+def chunkPath(path, chunk):
+    return os.path.join(path, f"chunk_{chunk:05d}.bin")
+
+
+class SessionRecorder:
+    # Input:
+    #   path [String]: Directory to record into (created if it does not exist)
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.header = {"started": time.strftime("%Y-%m-%d %H:%M:%S"), "cameras": [], "tracker": {},
+                       "dropped_frames": 0, "dropped_events": 0}
+        self.queue = queue.Queue(queue_size)
+        self.dropped_frames = 0
+        self.dropped_events = 0
+        self.recording = True
+
+        self.writer = threading.Thread(target=self.writerThread, daemon=True)
+        self.writer.start()
+
+    # Queues a frame for writing, or drops it if the writer is behind. The recorder keeps a reference to the frame, so
+    # it must not be drawn on or reused afterwards (pass a copy otherwise).
+    # Input:
+    #   camera [String]: Which camera it came from
+    #   captured [Float]: Its capture time
+    #   frame [Array]: Its pixels
+    def recordFrame(self, camera, captured, frame):
+        if self.queue.qsize() >= frame_queue_size or not self.put((FRAME, camera, time.monotonic(), captured, frame)):
+            self.dropped_frames += 1
+            metrics.count("session.dropped_frames")
+
+    # Queues an event for writing.
+    # Input:
+    #   kind [Integer]: MEASUREMENT, COMMAND or REPLY
+    #   event [Dictionary]: What happened, saved as JSON
+    #   captured [Float]: Capture time of the frames a measurement came from (defaults to now)
+    def recordEvent(self, kind, event, captured=None):
+        now = time.monotonic()
+        if not self.put((kind, None, now, captured if captured is not None else now, event)):
+            self.dropped_events += 1
+            metrics.count("session.dropped_events")
+
+    # Saves the settings the tracker ran with in the header, so a replay can use the same ones
+    def describeTracker(self, **settings):
+        self.put(("tracker", None, None, None, settings))
+
+    # Output: False if the queue is full
+    def put(self, entry):
+        if not self.recording:
+            return False
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            return False
+        return True
+
+    # Writes everything still queued and closes the files. Entries recorded afterwards are ignored.
+    def close(self):
+        self.recording = False
+        self.queue.put(None)
+        self.writer.join()
+
+    def writerThread(self):
+        chunk, offset = 0, 0
+        chunk_file = open(chunkPath(self.path, chunk), "wb")
+        index = open(os.path.join(self.path, index_file), "wb")
+        last_flush = time.monotonic()
+        self.writeHeader()
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            kind, camera, recorded, captured, payload = entry
+            if kind == "tracker":
+                self.header["tracker"].update(payload)
+                self.writeHeader()
+                continue
+
+            started = time.perf_counter()
+            camera_id, shape = 0, (0, 0, 0)
+            if kind == FRAME:
+                if camera not in self.header["cameras"]:
+                    self.header["cameras"].append(camera)
+                    self.writeHeader()
+                camera_id = self.header["cameras"].index(camera)
+                shape = payload.shape if payload.ndim == 3 else payload.shape + (1,)
+                data = memoryview(np.ascontiguousarray(payload)).cast("B")
+            else:
+                data = json.dumps(payload).encode()
+
+            if offset > 0 and offset + len(data) > chunk_size:
+                chunk_file.close()
+                chunk, offset = chunk + 1, 0
+                chunk_file = open(chunkPath(self.path, chunk), "wb")
+            chunk_file.write(data)
+            record = np.array([(kind, camera_id, recorded, captured, chunk, offset, len(data)) + tuple(shape)],
+                              index_dtype)
+            index.write(record.tobytes())
+            offset += len(data)
+
+            # Push what was written so far to the disk now and then (not per entry, which would be far slower)
+            if time.monotonic() - last_flush > index_flush_interval:
+                chunk_file.flush()
+                index.flush()
+                last_flush = time.monotonic()
+            metrics.observe("session.write", time.perf_counter() - started)
+
+        chunk_file.close()
+        index.close()
+        self.writeHeader()
+
+    def writeHeader(self):
+        self.header["dropped_frames"] = self.dropped_frames
+        self.header["dropped_events"] = self.dropped_events
+        with open(os.path.join(self.path, header_file), "w") as file:
+            json.dump(self.header, file, indent=2)
+
+
+# A recorded session, read back by seeking to single entries.
+class Session:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, header_file)) as file:
+            self.header = json.load(file)
+        self.cameras = self.header["cameras"]
+        # A run that was killed can leave a partly written last record, and records whose payload never reached the disk
+        data = np.fromfile(os.path.join(path, index_file), np.uint8)
+        self.index = data[:len(data) // index_dtype.itemsize * index_dtype.itemsize].view(index_dtype)
+        if len(self.index):
+            last_chunk = self.index["chunk"][-1]
+            written = os.path.getsize(chunkPath(path, int(last_chunk)))
+            self.index = self.index[(self.index["chunk"] != last_chunk) |
+                                    (self.index["offset"] + self.index["length"] <= written)]
+
+    # Output: Index records of the entries of one kind (and camera, for frames), in recording order
+    def entries(self, kind, camera=None):
+        selected = self.index["kind"] == kind
+        if camera is not None:
+            selected &= self.index["camera"] == self.cameras.index(camera)
+        return self.index[selected]
+
+    # Reads one entry's payload.
+    # Input:
+    #   record: Its index record
+    #   files [Dictionary]: Chunk number -> open chunk file, kept by the caller between reads (one per thread)
+    # Output: The frame's pixels, or the event's dictionary
+    def read(self, record, files):
+        chunk_file = files.get(int(record["chunk"]))
+        if chunk_file is None:
+            chunk_file = files[int(record["chunk"])] = open(chunkPath(self.path, int(record["chunk"])), "rb")
+        chunk_file.seek(int(record["offset"]))
+        if record["kind"] != FRAME:
+            return json.loads(chunk_file.read(int(record["length"])))
+        frame = np.empty((int(record["height"]), int(record["width"]), int(record["channels"])), np.uint8)
+        chunk_file.readinto(memoryview(frame).cast("B"))
+        return frame if frame.shape[2] > 1 else frame[:, :, 0]
+
+    # Output: One SessionSource per camera (in the given order), sharing the same replay clock
+    def sources(self, cameras, realtime=False):
+        started = time.monotonic()
+        return [SessionSource(self, camera, realtime, started) for camera in cameras]
+
+
+# Plays one camera's recorded frames back to the tracker (same interface as vs.FrameGrabber), either as fast as the
+# tracker takes them or at their original timing. At original timing frames the tracker is too slow for are skipped, as
+# with a live camera, and timestamps are shifted to the replay's time.monotonic().
+class SessionSource:
+    # Input:
+    #   session [Session]: The recorded session
+    #   camera [String]: Which camera's frames to play
+    #   realtime [Boolean]: Play the frames at their original timing instead of as fast as possible
+    #   started [Float]: time.monotonic() the replay started at (shared by all the session's cameras)
+    def __init__(self, session, camera, realtime, started):
+        self.session = session
+        self.frames = session.entries(FRAME, camera)
+        self.live = realtime
+        self.started = started
+        self.first_recorded = session.index["recorded"][0] if len(session.index) else 0.0
+        self.files = {}
+        self.frame = None
+        self.frame_id = 0
+        self.running = len(self.frames) > 0
+        self.decode_time = 0  # Seconds spent reading frames
+
+    def IsOpened(self):
+        return self.running
+
+    # Output: (frame_id, timestamp, frame) of the next frame, or None at the end of the session
+    def WaitForFrame(self, after_id=0):
+        if self.frame_id <= after_id and self.running:
+            position = after_id  # Position of the next frame in self.frames
+            if self.live:
+                # Wait for the next frame to come due, then skip to the newest one that has
+                elapsed = time.monotonic() - self.started
+                due = self.frames["recorded"] - self.first_recorded
+                if position < len(self.frames) and due[position] > elapsed:
+                    time.sleep(due[position] - elapsed)
+                    elapsed = due[position]
+                position = max(int(np.searchsorted(due, elapsed, side="right")) - 1, position)
+            if position >= len(self.frames):
+                self.Stop()
+                return None
+
+            started = time.perf_counter()
+            record = self.frames[position]
+            self.frame = self.session.read(record, self.files)
+            self.decode_time += time.perf_counter() - started
+            self.frame_id = position + 1
+            self.timestamp = float(record["captured"])
+            if self.live:
+                self.timestamp += self.started - self.first_recorded
+
+        if self.frame_id <= after_id:
+            return None
+        return self.frame_id, self.timestamp, self.frame
+
+    def Stop(self):
+        self.running = False
+        for chunk_file in self.files.values():
+            chunk_file.close()
+        self.files = {}
+
+
+def printSummary(session):
+    index = session.index
+    duration = index["recorded"][-1] - index["recorded"][0] if len(index) else 0.0
+    print(f"Session {session.path}: started {session.header['started']}, {duration:.1f} s, "
+          f"tracker settings {session.header['tracker']}")
+    for camera in session.cameras:
+        frames = session.entries(FRAME, camera)
+        shape = f"{frames['width'][0]}x{frames['height'][0]}" if len(frames) else "-"
+        print(f"\t{camera}: {len(frames)} frames ({shape})")
+    for kind in (MEASUREMENT, COMMAND, REPLY):
+        print(f"\t{KINDS[kind]} events: {len(session.entries(kind))}")
+    print(f"\tDropped: {session.header['dropped_frames']} frames, {session.header['dropped_events']} events")
+
+
+def printEvents(session):
+    files = {}
+    start = session.index["recorded"][0]
+    for record in session.index[session.index["kind"] != FRAME]:
+        print(f"{record['recorded'] - start:9.3f} s  {KINDS[int(record['kind'])]:<12}{session.read(record, files)}")
+
+
+# Runs the recorded frames through the tracker again with its recorded settings, and compares the measurements it
+# publishes with the recorded ones (matched by the capture time of their frames, the latest one where several share it).
+# The live tracker skipped frames while throttled (see vs.Vision.Throttle), so the marker filter can differ for a while
+# after the car moved.
+def replay(session, realtime):
+    import vision as vs
+    settings = dict(session.header["tracker"])
+    stereo = settings.pop("stereo", len(session.cameras) == 2)
+    cameras = ["left", "right"] if stereo else ["single"]
+    started = time.perf_counter()
+    vision = vs.Vision(stereo=stereo, display="headless", sources=session.sources(cameras, realtime), benchmark=True,
+                       **settings)
+    vision.thread.join()
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {len(vision.measurement_log)} measurements in {elapsed:.2f} s")
+    if realtime:
+        return  # Timestamps were shifted, and frames skipped differently, so there is nothing to match them with
+
+    files = {}
+    recorded = {round(event["timestamp"], 6): event for event in
+                (session.read(record, files) for record in session.entries(MEASUREMENT))}
+    replayed = {round(measurement.timestamp, 6): measurement for measurement in vision.measurement_log}
+    matched, differing = 0, 0
+    for timestamp, measurement in replayed.items():
+        event = recorded.get(timestamp)
+        if event is None:
+            continue
+        matched += 1
+        if event["color"] != measurement.color or \
+                (event["angle"] is None) != (measurement.angle is None) or \
+                (event["distance"] is None) != (measurement.distance is None) or \
+                (measurement.angle is not None and abs(event["angle"] - measurement.angle) > 0.5) or \
+                (measurement.distance is not None and abs(event["distance"] - measurement.distance) > 1):
+            differing += 1
+            print(f"\tDiffers at {measurement.timestamp:.3f}: recorded {event}, replayed {measurement._asdict()}")
+    print(f"Matched {matched} of {len(recorded)} recorded capture times, {differing} differ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or replay a recorded session.")
+    parser.add_argument("session", help="Session directory")
+    parser.add_argument("--events", action="store_true", help="Print every measurement, command and reply")
+    parser.add_argument("--replay", action="store_true", help="Run the recorded frames through the tracker again")
+    parser.add_argument("--realtime", action="store_true", help="Replay at the original timing, not as fast as possible")
+    args = parser.parse_args()
+    if not isSession(args.session):
+        raise SystemExit(f"\t\tERROR: {args.session} is not a recorded session")
+
+    recorded_session = Session(args.session)
+    printSummary(recorded_session)
+    if args.events:
+        printEvents(recorded_session)
+    if args.replay:
+        replay(recorded_session, args.realtime)
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Stands in for the EV3 brick and the phone cameras, so the whole control loop in server.py can run (and be timed)
+# without the car. The simulated brick speaks the same protocol as client.py and drives a kinematic model of the car;
+# the cameras render the course's markers from wherever the car is and stream them like IP Webcam does.
+# Usage:
+#   python simulator.py [--time-scale 4]    then, in another terminal:    python server.py --simulate
+import math
+import time
+import socket
+import argparse
+import threading
+import queue
+import cv2
+import numpy as np
+import protocol
+import vision as vs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from robot import MAX_MOTOR_SPEED, WHEELBASE, CAMERA_OFFSET, MAX_SPEED_CM_PER_SEC
+
+##### Simulation Parameters ######################################
+# Markers in the order they should be visited: x (cm, to the right), y (cm, ahead of the car's start) and colour.
+# The last one is the goal (red, so the car stops in front of it)
+course = [
+    (0, 80, 'green'),
+    (25, 145, 'yellow'),
+    (0, 210, 'green'),
+    (-20, 275, 'red'),
+]
+marker_radius = vs.distance_to_largest_marker_radius * vs.largest_marker_radius / vs.focal_length  # cm
+reach_distance = 45  # cm (a marker counts as reached once the cameras get this close to it)
+goal_distance = vs.distance_to_largest_marker_radius * vs.largest_marker_radius / vs.smallest_marker_radius  # cm
+camera_port = 8081  # Port the simulated cameras are streamed on
+camera_fps = 30  # Simulated frames per second (multiplied by the time scale)
+frame_width = 640
+frame_height = 480
+jpeg_quality = 90
+simulation_step = 0.01  # seconds of simulated time per kinematic update
+settle_time = 0.2  # seconds the brick sleeps after every move when not overlapping them (see move_joints in client.py)
+steering_tolerance = 5  # degrees (see STEERING_TOLERANCE in client.py)
+##################################################################
+
+
+# Colour a marker is painted in: the middle of its HSV range, converted to BGR
+def markerColor(color):
+    lower, upper = [(lower, upper) for name, lower, upper in vs.color_ranges if name == color][0]
+    hsv = ((lower.astype(int) + upper.astype(int)) // 2).astype(np.uint8).reshape(1, 1, 3)
+    return tuple(int(c) for c in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0])
+
+
+marker_bgr = {color: markerColor(color) for color in vs.marker_colors}
+
+
+# Stream URLs of the simulated cameras, in the order vs.Vision expects its sources
+def cameraUrls(stereo, host="127.0.0.1", port=camera_port):
+    views = ["left", "right"] if stereo else ["single"]
+    return [f"http://{host}:{port}/{view}/video" for view in views]
+
+
+# Where the car is on the course. The pose is the middle of the rear axle: x and y in cm, heading in radians
+# (0 is straight up the course, positive turns right, like a positive steering angle).
+class World:
+    def __init__(self, markers):
+        self.lock = threading.Lock()
+        self.markers = markers
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.reached = 0  # Markers reached so far (in course order)
+        self.started = None  # When the first command arrived
+        self.moving_time = 0.0  # Simulated seconds spent executing commands
+
+    def pose(self):
+        with self.lock:
+            return self.x, self.y, self.heading
+
+    # Advances the bicycle model by one step.
+    # Input:
+    #   steering_angle [Float]: Degrees, positive steers right
+    #   velocity [Float]: cm/s of the rear wheels, negative reverses
+    #   dt [Float]: Simulated seconds
+    def step(self, steering_angle, velocity, dt):
+        # Heading rate of a bicycle: v / R with turning radius R = WHEELBASE / tan(steering angle) (see calculateRotation)
+        turn_rate = velocity * math.tan(math.radians(steering_angle)) / WHEELBASE
+        with self.lock:
+            heading = self.heading + turn_rate * dt / 2  # Move along the mean heading of the step
+            self.x += velocity * dt * math.sin(heading)
+            self.y += velocity * dt * math.cos(heading)
+            self.heading += turn_rate * dt
+        self.checkMarkers()
+
+    def checkMarkers(self):
+        x, y, heading = self.pose()
+        if self.reached == len(self.markers):
+            return
+        marker_x, marker_y, color = self.markers[self.reached]
+        dx = marker_x - (x + CAMERA_OFFSET * math.sin(heading))
+        dy = marker_y - (y + CAMERA_OFFSET * math.cos(heading))
+        if self.reached < len(self.markers) - 1:
+            if math.hypot(dx, dy) > reach_distance:
+                return
+        else:
+            # The car never drives up to the goal, it stops as soon as the tracker can measure it
+            Z = dx * math.sin(heading) + dy * math.cos(heading)
+            X = dx * math.cos(heading) - dy * math.sin(heading)
+            if not 0 < Z <= goal_distance or abs(X / Z) > frame_width / 2 / vs.focal_length:
+                return
+        self.reached += 1
+        elapsed = time.monotonic() - self.started
+        print(f"REACHED: Marker {self.reached}/{len(self.markers)} ({color}) after {elapsed:.2f} s "
+              f"({self.moving_time:.2f} s of simulated driving)")
+        if self.reached == len(self.markers):
+            print(f"GOAL: Course finished in {elapsed:.2f} s")
+
+    # Draws what a camera on the car sees.
+    # Input: lateral_offset [Float]: cm to the right of the car's centre line the camera sits at
+    # Output: A BGR frame
+    def render(self, lateral_offset):
+        x, y, heading = self.pose()
+        forward = (math.sin(heading), math.cos(heading))
+        right = (math.cos(heading), -math.sin(heading))
+        camera_x = x + CAMERA_OFFSET * forward[0] + lateral_offset * right[0]
+        camera_y = y + CAMERA_OFFSET * forward[1] + lateral_offset * right[1]
+
+        # Project every marker in front of the camera (pinhole model, markers at camera height)
+        visible = []
+        for marker_x, marker_y, color in self.markers:
+            dx = marker_x - camera_x
+            dy = marker_y - camera_y
+            Z = dx * forward[0] + dy * forward[1]
+            X = dx * right[0] + dy * right[1]
+            if Z > marker_radius:
+                visible.append((Z, X, color))
+
+        frame = np.full((frame_height, frame_width, 3), 128, np.uint8)
+        # Far markers first, so nearer ones cover them
+        for Z, X, color in sorted(visible, reverse=True):
+            u = frame_width / 2 + vs.focal_length * X / Z
+            radius = vs.focal_length * marker_radius / Z
+            if abs(u - frame_width / 2) > frame_width + radius:
+                continue
+            # Fixed point coordinates (4 fractional bits) keep the sub-pixel position the disparity depends on
+            center = (int(round(u * 16)), int(round(frame_height / 2 * 16)))
+            cv2.circle(frame, center, int(round(radius * 16)), marker_bgr[color], -1, cv2.LINE_AA, 4)
+        return frame
+
+
+# Streams a camera as multipart JPEG, the way the IP Webcam app does. Every client gets its own stream, from frame 0.
+class CameraHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        view = self.server.views.get(self.path)
+        if view is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+        self.end_headers()
+
+        interval = 1 / self.server.fps
+        next_frame = time.monotonic()
+        frame_number = 0
+        try:
+            while True:
+                jpeg = view(frame_number)
+                if jpeg is None:
+                    break
+                if self.server.content_length:
+                    self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % len(jpeg))
+                else:
+                    self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\n\r\n")
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+                frame_number += 1
+                next_frame += interval
+                time.sleep(max(next_frame - time.monotonic(), 0))
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The tracker stopped reading
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves camera streams on its own thread.
+# Input:
+#   port [Integer]: Port to listen on (localhost only)
+#   views [Dictionary]: Stream path -> function returning the JPEG bytes of a frame number, or None to end the stream
+#   fps [Float]: Frames per second sent to each client
+#   content_length [Boolean]: Send every part's Content-Length, like IP Webcam (some cameras leave it out)
+class CameraServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, views, fps, content_length=True):
+        super().__init__(("127.0.0.1", port), CameraHandler)
+        self.views = views
+        self.fps = fps
+        self.content_length = content_length
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+# Output: A CameraServer view that renders the world from a camera the given cm to the right of the car's centre line
+def worldView(world, lateral_offset):
+    def view(frame_number):
+        ok, jpeg = cv2.imencode(".jpg", world.render(lateral_offset), [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+        return jpeg
+    return view
+
+
+# Takes the place of the Client in client.py: same messages, but the motors move the World instead of the car.
+# Every wait is divided by the time scale, so a time scale of 4 runs the course four times faster than the real car.
+class SimulatedBrick:
+    def __init__(self, host, port, world, time_scale=1.0, overlapped=True, telemetry=True):
+        print("Setting up simulated brick\nAddress: " + host + "\nPort: " + str(port))
+        self.world = world
+        self.time_scale = time_scale
+        self.overlapped = overlapped  # Like OVERLAPPED_MOTION in client.py
+        self.steering_angle = 0.0  # Current angle of the center axle (degrees)
+        self.steering_target = 0.0  # Angle the center axle is turning to (degrees)
+        self.wheel_position = 0.0  # Degrees both rear wheel motors have turned since the start
+        self.safety_mode = False
+        self.commands = queue.Queue()  # (command, sequence id, stop count when it arrived), like commands in client.py
+        self.stop_count = 0  # STOP messages received so far
+        self.send_lock = threading.Lock()
+        # Keep trying until server.py is listening
+        while True:
+            try:
+                self.s = socket.create_connection((host, port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.5)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = protocol.MessageReader(self.s)
+        self.motion = threading.Thread(target=self.motionThread)
+        self.motion.start()
+        if telemetry:
+            threading.Thread(target=self.telemetryThread, args=(host,), daemon=True).start()
+
+    def wait(self, seconds):
+        self.world.moving_time += seconds
+        time.sleep(seconds / self.time_scale)
+
+    # Turns the center axle at full motor speed until it is within the given degrees of its target
+    def turnAxle(self, tolerance=0.0):
+        error = self.steering_target - self.steering_angle
+        if abs(error) > tolerance:
+            self.wait((abs(error) - tolerance) / MAX_MOTOR_SPEED)
+            self.steering_angle = self.steering_target - math.copysign(tolerance, error)
+
+    # Runs both rear wheels at the given speed percentage for the given (simulated) time, or until a STOP arrives.
+    # The center axle keeps turning towards its target meanwhile.
+    # Output: (degrees the rear wheels turned, seconds they ran), like run_wheels in client.py
+    def runWheels(self, duration, speed, generation):
+        velocity = (speed / 100.0) * MAX_SPEED_CM_PER_SEC
+        elapsed = 0.0
+        while elapsed < duration and generation == self.stop_count:
+            dt = min(simulation_step, duration - elapsed)
+            error = self.steering_target - self.steering_angle
+            self.steering_angle += math.copysign(min(abs(error), MAX_MOTOR_SPEED * dt), error)
+            self.world.step(self.steering_angle, velocity, dt)
+            self.wheel_position += (speed / 100.0) * MAX_MOTOR_SPEED * dt
+            self.wait(dt)
+            elapsed += dt
+        return (speed / 100.0) * MAX_MOTOR_SPEED * elapsed, elapsed
+
+    # Same steps and timing as move_joints (or overlapped_move) in client.py.
+    # Output: (degrees the rear wheels turned, seconds they ran)
+    def moveJoints(self, command, generation):
+        direction, duration, speed = command
+        print(f"EXECUTE: direction = {direction:.2f}, duration = {duration:.2f}, speed = {speed}")
+
+        self.steering_target = direction
+        if self.overlapped:
+            self.turnAxle(steering_tolerance)
+            return self.runWheels(duration, speed, generation)
+
+        self.turnAxle()
+        moved = self.runWheels(duration, speed, generation)
+        self.steering_target = 0.0
+        self.turnAxle()
+        self.wait(settle_time)
+        return moved
+
+    def motionThread(self):
+        while True:
+            item = self.commands.get()
+            if item is None:
+                return
+            command, sequence, generation = item
+            moved = (0.0, 0.0, 0.0)
+            if generation == self.stop_count:
+                started = time.monotonic()
+                moved = self.moveJoints(command, generation)
+                # Execution time in wall clock seconds, like the round trip the server compares it with
+                moved += (time.monotonic() - started,)
+            completed = generation == self.stop_count
+            try:
+                self.send(protocol.DONE if completed else protocol.RESET, sequence, moved)
+            except OSError:
+                return  # The server went away
+
+    # Same samples as telemetry_thread in client.py, TELEMETRY_RATE times per simulated second
+    def telemetryThread(self, host):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        period = 1.0 / (protocol.TELEMETRY_RATE * self.time_scale)
+        sample = 0
+        while True:
+            sample += 1
+            wheels = round(self.wheel_position)
+            try:
+                sock.sendto(protocol.telemetry(sample, time.monotonic(), round(-self.steering_angle), wheels, wheels),
+                            (host, protocol.TELEMETRY_PORT))
+            except OSError:
+                pass  # server.py is not listening (yet)
+            time.sleep(period)
+
+    def send(self, message_type, sequence, moved=(0.0, 0.0, 0.0)):
+        with self.send_lock:
+            self.s.sendall(protocol.encode(message_type, sequence, protocol.movedBody(*moved)))
+
+    # Output: False once the server asked the brick to exit (or closed the connection), True otherwise
+    def pollData(self):
+        message = self.reader.receive()
+        if message is None:
+            print("Connection closed")
+            self.stop_count += 1
+            self.commands.put(None)
+            return False
+
+        message_type, sequence, body = message
+        if self.world.started is None:
+            self.world.started = time.monotonic()
+        if message_type == protocol.MOVE:
+            self.commands.put((protocol.decodeMove(body), sequence, self.stop_count))
+        elif message_type == protocol.STOP:
+            self.stop_count += 1  # The motion thread checks this between simulation steps
+            print("STOP")
+            self.send(protocol.DONE, sequence)
+        elif message_type == protocol.EXIT:
+            self.commands.put(None)
+            self.motion.join()
+            return False
+        elif message_type == protocol.SAFETY_ON:
+            self.safety_mode = True
+        elif message_type == protocol.SAFETY_OFF:
+            self.safety_mode = False
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated brick and cameras for python server.py --simulate.")
+    parser.add_argument("--time-scale", type=float, default=4.0, help="How many times faster than real time to run")
+    parser.add_argument("--host", default="127.0.0.1", help="Address server.py listens on")
+    parser.add_argument("--port", type=int, default=9999, help="Port server.py listens on")
+    parser.add_argument("--stop-and-go", action="store_true",
+                        help="Return the axle to 0 and pause after every move, like client.py without OVERLAPPED_MOTION")
+    parser.add_argument("--no-telemetry", action="store_true", help="Do not send the motor positions to server.py")
+    args = parser.parse_args()
+
+    world = World(course)
+    views = {"/left/video": worldView(world, -vs.baseline * 100 / 2), "/right/video": worldView(world, vs.baseline * 100 / 2),
+             "/single/video": worldView(world, 0)}
+    cameras = CameraServer(camera_port, views, camera_fps * args.time_scale)
+    brick = SimulatedBrick(args.host, args.port, world, args.time_scale, overlapped=not args.stop_and_go,
+                           telemetry=not args.no_telemetry)
+    while brick.pollData():
+        pass
+    brick.motion.join()
+    brick.s.close()
+    cameras.shutdown()
+
+    x, y, heading = world.pose()
+    print(f"Markers reached: {world.reached}/{len(course)}, final pose: ({x:.1f} cm, {y:.1f} cm, "
+          f"{math.degrees(heading):.1f} deg)")
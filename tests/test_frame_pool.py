@@ -0,0 +1,41 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import vision as vs
+
+
+def test_cameras_with_different_resolutions_share_the_buffers():
+    pool = vs.FramePool()
+    for _ in range(3):
+        pool.Fit((480, 640, 3))
+        pool.Fit((240, 320, 3))
+    assert pool.allocations == len(vs.FramePool.buffer_channels)
+    assert pool.Get("hsv", (240, 320)).shape == (240, 320, 3)
+
+
+def test_buffers_grow_to_the_largest_frame():
+    pool = vs.FramePool()
+    pool.Fit((480, 320, 3))
+    pool.Fit((240, 640, 3))
+    assert pool.shape == (480, 640)
+    assert pool.allocations == 2 * len(vs.FramePool.buffer_channels)
+
+
+def test_detection_results_do_not_depend_on_the_pool_size():
+    frame = np.zeros((240, 320, 3), np.uint8)
+    lower, upper = [(lower, upper) for name, lower, upper in vs.color_ranges if name == 'green'][0]
+    hsv = ((lower.astype(int) + upper.astype(int)) // 2).astype(np.uint8).reshape(1, 1, 3)
+    color = tuple(int(c) for c in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0])
+    cv2.circle(frame, (160, 120), 30, color, -1)
+
+    detector = vs.MarkerDetector()
+    expected = detector.TrackLocation(frame, "left")
+    detector.TrackLocation(np.zeros((480, 640, 3), np.uint8), "right")
+    circle, found = detector.TrackLocation(frame, "left")
+    assert found == expected[1] == 'green'
+    assert np.allclose(circle, expected[0])
@@ -0,0 +1,41 @@
+import os
+import math
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import vision as vs
+
+
+def test_mismatch_during_track_publishes_prediction():
+    marker_filter = vs.MarkerFilter()
+    marker_filter.Update(0.0, 100.0, 5.0, 'green')
+    marker_filter.Update(0.033, 100.0, 5.0, 'green')
+    # Colour mismatch (or failed size check) between the cameras: only a "try 20" hint with no colour
+    distance, angle, color, confidence = marker_filter.Update(0.066, None, 20, None)
+    assert color == 'green'
+    assert abs(distance - 100.0) < 1
+    assert abs(angle - 5.0) < 1
+    assert confidence >= vs.min_confidence
+
+
+def test_hint_passes_through_without_track():
+    marker_filter = vs.MarkerFilter()
+    assert marker_filter.Update(0.0, None, 20, None) == (None, 20, None, vs.confidence_gain)
+
+
+def test_hint_passes_through_after_track_expires():
+    marker_filter = vs.MarkerFilter()
+    marker_filter.Update(0.0, 100.0, 5.0, 'green')
+    assert marker_filter.Update(vs.max_dropout + 0.1, None, -20, None) == (None, -20, None, vs.confidence_gain)
+
+
+def test_turn_rotates_tracks_about_the_rear_axle():
+    marker_filter = vs.MarkerFilter(camera_offset=15.0)
+    marker_filter.Update(0.0, 100.0, 0.0, 'green')
+    marker_filter.motion = (0.0, 0.5)  # Turning right on the spot
+    marker_filter.Predict(0.2)
+    x, z = marker_filter.tracks['green'][:2]
+    # Straight ahead of the cameras, 115 cm from the rear axle, and the car turned 0.1 rad to the right about it
+    assert abs(x - -115.0 * math.sin(0.1)) < 1e-9
+    assert abs(z - (115.0 * math.cos(0.1) - 15.0)) < 1e-9
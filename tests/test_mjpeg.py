@@ -0,0 +1,59 @@
+import os
+import sys
+import urllib.request
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import vision as vs
+import simulator
+
+
+# Output: JPEGs of noise (so they hold plenty of line breaks for the parser to get past) in a few sizes
+def makeClip():
+    rng = np.random.default_rng(0)
+    sizes = [(48, 64), (120, 160), (48, 64), (240, 320), (120, 160)]
+    return [cv2.imencode(".jpg", rng.integers(0, 256, size + (3,), np.uint8))[1].tobytes() for size in sizes]
+
+
+# Output: URL of the clip, served once per request by a simulator.CameraServer
+@pytest.fixture(params=[True, False], ids=["content-length", "no-content-length"])
+def stream(request):
+    clip = makeClip()
+    cameras = simulator.CameraServer(0, {"/video": lambda number: clip[number] if number < len(clip) else None}, 200,
+                                     content_length=request.param)
+    yield f"http://127.0.0.1:{cameras.server_address[1]}/video", clip
+    cameras.shutdown()
+    cameras.server_close()
+
+
+def decoded(jpeg):
+    return cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+
+
+def test_parser_reads_every_frame(stream):
+    url, clip = stream
+    parser = vs.MjpegParser(urllib.request.urlopen(url, timeout=5))
+    buffer = bytearray(16)  # Too small for any of the frames, so it has to grow
+    for jpeg in clip:
+        buffer, length = parser.ReadFrame(buffer)
+        assert bytes(buffer[:length]).rstrip(b"\r\n") == jpeg
+        assert np.array_equal(vs.decodeJpeg(memoryview(buffer)[:length]), decoded(jpeg))
+    assert parser.ReadFrame(buffer)[1] == 0
+
+
+def test_grabber_decodes_the_frames(stream):
+    url, clip = stream
+    grabber = vs.MjpegGrabber(url)
+    assert grabber.IsOpened()
+    seen = []
+    latest = grabber.WaitForFrame()
+    while latest is not None:
+        frame_id, _, frame = latest
+        assert np.array_equal(frame, decoded(clip[frame_id - 1]))
+        seen.append(frame_id)
+        latest = grabber.WaitForFrame(frame_id)
+    assert seen and seen[-1] == len(clip)
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import motors
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = str(tmp_path / "tacho-motor")
+    motors.make_fake_sysfs(root)
+    return root
+
+
+@pytest.fixture
+def motor(root):
+    motor = motors.LargeMotor(motors.OUTPUT_B, root)
+    yield motor
+    motor.close()
+
+
+# Output: The attribute's value, read from the fake tree the way the driver would see it
+def attribute(root, name, address=motors.OUTPUT_B):
+    with open(os.path.join(motors.find_motor(address, root), name)) as file:
+        return file.read().split("\n", 1)[0].strip()
+
+
+# Plays the motor's part: rewrites one of its attribute files, like the driver does
+def set_attribute(root, name, value, address=motors.OUTPUT_B):
+    with open(os.path.join(motors.find_motor(address, root), name), "w") as file:
+        file.write(value + "\n")
+
+
+def test_finds_motor_by_port(root):
+    assert motors.find_motor(motors.OUTPUT_A, root) != motors.find_motor(motors.OUTPUT_C, root)
+    with pytest.raises(OSError):
+        motors.find_motor(motors.OUTPUT_D, root)
+
+
+def test_writes_attributes(root, motor):
+    motor.on_for_seconds(motors.SpeedPercent(50), 1.5, brake=False, block=False)
+    assert attribute(root, "speed_sp") == "525"
+    assert attribute(root, "time_sp") == "1500"
+    assert attribute(root, "stop_action") == "coast"
+    assert attribute(root, "command") == "run-timed"
+
+    motor.on_to_position(motors.SpeedPercent(100), -30, block=False)
+    assert attribute(root, "speed_sp") == "1050"
+    assert attribute(root, "position_sp") == "-30"
+    assert attribute(root, "stop_action") == "hold"
+    assert attribute(root, "command") == "run-to-abs-pos"
+
+
+def test_reads_attributes(root, motor):
+    set_attribute(root, "position", "-123")
+    set_attribute(root, "state", "running ramping")
+    assert motor.position == -123
+    assert motor.state == ["running", "ramping"]
+
+
+def test_unchanged_values_are_not_written_again(root, motor):
+    motor.on_for_seconds(motors.SpeedPercent(50), 1.0, block=False)
+    set_attribute(root, "speed_sp", "0")
+    set_attribute(root, "time_sp", "0")
+    motor.on_for_seconds(motors.SpeedPercent(50), 1.0, block=False)
+    assert attribute(root, "speed_sp") == "0"
+    assert attribute(root, "time_sp") == "0"
+
+    motor.on_for_seconds(motors.SpeedPercent(25), 1.0, block=False)
+    assert attribute(root, "speed_sp") == "262"
+
+
+def test_commands_and_position_are_always_written(root, motor):
+    motor.off()
+    set_attribute(root, "command", "")
+    motor.off()
+    assert attribute(root, "command") == "stop"
+
+    motor.position = 0
+    set_attribute(root, "position", "42")
+    motor.position = 0
+    assert attribute(root, "position") == "0"
+
+
+def test_wait_until_returns_when_state_changes(root, motor):
+    threading.Timer(0.05, set_attribute, (root, "state", "running")).start()
+    started = time.monotonic()
+    assert motor.wait_until("running", timeout=2000)
+    assert 0.04 < time.monotonic() - started < 1.0
+
+
+def test_wait_while_returns_when_state_changes(root, motor):
+    set_attribute(root, "state", "running")
+    threading.Timer(0.05, set_attribute, (root, "state", "")).start()
+    started = time.monotonic()
+    assert motor.wait_while("running", timeout=2000)
+    assert 0.04 < time.monotonic() - started < 1.0
+
+
+def test_wait_times_out(motor):
+    started = time.monotonic()
+    assert not motor.wait_until("running", timeout=50)
+    assert time.monotonic() - started >= 0.05
+    assert not motor.wait(lambda flags: False, timeout=0)
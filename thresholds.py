@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# RUN ON LAPTOP
+# Finds the HSV thresholds of every marker colour from recorded frames with labelled markers, and writes them as the
+# colour table the tracker labels pixels with (see vs.loadColorTable), instead of re-tuning the ranges at the top of
+# vision.py by hand whenever the lighting changes.
+# The labelled pixels of all frames are first counted into one histogram per label over quantized (hue, saturation,
+# value) bins. Then, for each colour, every hue interval (wrapping around for red) and every lowest saturation and value
+# is scored at once from prefix sums of those histograms, and the best one (highest F1 score over the labelled pixels)
+# is kept.
+# Labels are a CSV file with a header and one row per marker: frame (position in the clip, from 0), color, x, y, radius
+# (pixels). A row with no color marks a frame without markers. Only frames with a row are used.
+# Usage:
+#   python thresholds.py CLIP LABELS [CLIP LABELS ...] [--bins 90x32x32] [--output colors.npz]
+# A clip is a video file, an MJPEG file or a directory of images.
+import csv
+import time
+import argparse
+import cv2
+import numpy as np
+import vision as vs
+
+inner_radius = 0.8  # Only pixels this far into a labelled marker count as its colour (its edge is blurred)
+outer_radius = 1.2  # Pixels out to this far around a labelled marker are left out, as neither marker nor background
+ignored = 255  # Label of the pixels that are left out
+
+
+# Output: Dictionary of frame position -> [(color, x, y, radius)] from a labels file
+def readLabels(path):
+    labels = {}
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            markers = labels.setdefault(int(row["frame"]), [])
+            if row["color"]:
+                markers.append((row["color"], float(row["x"]), float(row["y"]), float(row["radius"])))
+    return labels
+
+
+# Output: The frame's label image: the colour's label inside every marker, 0 for the background and ignored around the
+# markers' edges
+def labelFrame(shape, markers):
+    labels = np.zeros(shape[:2], np.uint8)
+    for color, x, y, radius in markers:
+        cv2.circle(labels, (round(x), round(y)), round(radius * outer_radius), ignored, -1)
+    for color, x, y, radius in markers:
+        cv2.circle(labels, (round(x), round(y)), round(radius * inner_radius), vs.marker_colors.index(color) + 1, -1)
+    return labels
+
+
+# Counts the labelled pixels of every labelled frame of the clips.
+# Output: Histogram of pixel counts by (hue bin, saturation bin, value bin, label), and the number of frames used
+def countPixels(pairs, bins):
+    label_count = len(vs.marker_colors) + 1
+    histogram = np.zeros(bins + (label_count,), np.float32)
+    frames = 0
+    for clip_path, labels_path in pairs:
+        labels = readLabels(labels_path)
+        clip = vs.RecordingSource(clip_path)
+        latest = clip.WaitForFrame()
+        while latest is not None and labels:
+            frame_id, _, frame = latest
+            markers = labels.pop(frame_id - 1, None)
+            if markers is not None:
+                hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+                cv2.calcHist([hsv, labelFrame(frame.shape, markers)], [0, 1, 2, 3], None, list(histogram.shape),
+                             vs.hsv_ranges + [0, label_count], hist=histogram, accumulate=True)
+                frames += 1
+            latest = clip.WaitForFrame(frame_id)
+        clip.Stop()
+        if labels:
+            print(f"\t\tERROR: {clip_path} has no frames {sorted(labels)[:5]}... that {labels_path} labels")
+    return histogram, frames
+
+
+# Scores every candidate box of one colour: hue from any bin to any bin (wrapping past the last one when the first is
+# after the second), and saturation and value from any bin up to the top.
+# Input:
+#   positive [Array]: Pixel counts of the colour by (hue, saturation, value) bin
+#   negative [Array]: Pixel counts of everything else that was labelled
+# Output: (F1 score, precision, recall, (first hue bin, last hue bin, lowest saturation bin, lowest value bin)) of the
+#         best box
+def searchBox(positive, negative):
+    hue_bins = positive.shape[0]
+
+    # Pixels at or above every (saturation, value) bin, then summed over the hues below every hue bin
+    def prefixSums(counts):
+        counts = counts[:, ::-1, ::-1].cumsum(axis=1).cumsum(axis=2)[:, ::-1, ::-1]
+        return np.concatenate([np.zeros((1,) + counts.shape[1:], counts.dtype), counts.cumsum(axis=0)])
+
+    first = np.arange(hue_bins).reshape(-1, 1)
+    last = np.arange(hue_bins).reshape(1, -1)
+    wraps = first > last
+
+    # Pixels inside every box at once, indexed by (first hue bin, last hue bin, lowest saturation, lowest value)
+    def boxCounts(sums):
+        inside = sums[last + 1] - sums[first]
+        wrapped = sums[hue_bins] - sums[first] + sums[last + 1]
+        return np.where(wraps[..., None, None], wrapped, inside)
+
+    true_positives = boxCounts(prefixSums(positive.astype(np.float64)))
+    false_positives = boxCounts(prefixSums(negative.astype(np.float64)))
+    scores = 2 * true_positives / (true_positives + false_positives + positive.sum())
+    # Many boxes score the same when they only differ in bins no labelled pixel fell in. Keep the tightest of those.
+    hue_widths = (last - first) % hue_bins + 1
+    saturations, values = np.arange(positive.shape[1]), np.arange(positive.shape[2])
+    sizes = hue_widths[..., None, None] * (positive.shape[1] - saturations[:, None]) * (positive.shape[2] - values)
+    best = np.unravel_index(np.argmin(np.where(scores >= scores.max() - 1e-9, sizes, np.inf)), scores.shape)
+    precision = true_positives[best] / max(true_positives[best] + false_positives[best], 1)
+    recall = true_positives[best] / positive.sum()
+    return scores[best], precision, recall, tuple(int(i) for i in best)
+
+
+# Output: The colour's [(lower, upper)] HSV ranges (two when the hue wraps around), in the units of vision.py's ranges
+def boxRanges(box, bins):
+    first, last, saturation, value = box
+    hue_step, saturation_step, value_step = (top // count for top, count in zip(vs.hsv_ranges[1::2], bins))
+    lower = [saturation * saturation_step, value * value_step]
+    hues = [(first, last)] if first <= last else [(first, bins[0] - 1), (0, last)]
+    return [(np.array([start * hue_step] + lower), np.array([(end + 1) * hue_step - 1, 255, 255])) for start, end in hues]
+
+
+# Output: The colour table for the boxes: every (hue, saturation, value) bin holds its colour's label (earlier colours
+#         in vs.marker_colors win where boxes overlap), 0 for no colour
+def buildTable(boxes, bins):
+    table = np.zeros(bins, np.uint8)
+    for color in reversed(vs.marker_colors):
+        if color not in boxes:
+            continue
+        first, last, saturation, value = boxes[color]
+        hues = np.arange(bins[0])
+        inside = (hues >= first) & (hues <= last) if first <= last else (hues >= first) | (hues <= last)
+        table[inside, saturation:, value:] = vs.marker_colors.index(color) + 1
+    return table
+
+
+# Output: The box of bins that best covers one of vision.py's hand-tuned ranges, for colours without labelled pixels
+def defaultBox(color, bins):
+    steps = [top // count for top, count in zip(vs.hsv_ranges[1::2], bins)]
+    ranges = [(lower, upper) for name, lower, upper in vs.color_ranges if name == color]
+    first = int(ranges[-1][0][0]) // steps[0]
+    last = int(ranges[0][1][0]) // steps[0]
+    return first, last, int(ranges[0][0][1]) // steps[1], int(ranges[0][0][2]) // steps[2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the marker colours' HSV thresholds from labelled clips.")
+    parser.add_argument("inputs", nargs="+", help="Clips, each followed by its labels file")
+    parser.add_argument("--bins", default="90x32x32", help="Hue, saturation and value bins of the table, HxSxV")
+    parser.add_argument("--output", default=vs.color_table_file, help="Colour table file to write")
+    args = parser.parse_args()
+    if len(args.inputs) % 2:
+        parser.error("give every clip's labels file after it")
+
+    bins = tuple(int(count) for count in args.bins.lower().split("x"))
+    if len(bins) != 3 or any(top % count for top, count in zip(vs.hsv_ranges[1::2], bins)):
+        parser.error("the bins must divide the hue range (180) and the saturation and value ranges (256) evenly")
+
+    started = time.perf_counter()
+    histogram, frames = countPixels(list(zip(args.inputs[::2], args.inputs[1::2])), bins)
+    counted = time.perf_counter()
+    print(f"Counted {histogram.sum():.0f} labelled pixels of {frames} frames in {counted - started:.1f} s")
+    if frames == 0:
+        raise SystemExit("\t\tERROR: No labelled frames")
+
+    boxes = {}
+    for label, color in enumerate(vs.marker_colors, start=1):
+        positive = histogram[..., label]
+        if positive.sum() == 0:
+            boxes[color] = defaultBox(color, bins)
+            print(f"{color}: no labelled pixels, keeping the hand-tuned range")
+            continue
+        score, precision, recall, boxes[color] = searchBox(positive, histogram.sum(axis=-1) - positive)
+        ranges = ", ".join(f"{lower.tolist()} to {upper.tolist()}" for lower, upper in boxRanges(boxes[color], bins))
+        print(f"{color}: {ranges} (F1 {score:.3f}, precision {precision:.3f}, recall {recall:.3f})")
+    print(f"Searched in {time.perf_counter() - counted:.1f} s")
+
+    np.savez_compressed(args.output, table=buildTable(boxes, bins), colors=np.array(vs.marker_colors))
+    print(f"Wrote {args.output}")
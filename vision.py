@@ -1,7 +1,16 @@
+import os
 import cv2
+import math
 import time
 import threading
+import tracemalloc
+import multiprocessing
+import urllib.request
 import numpy as np
+import metrics
+import session
+from collections import namedtuple
+from robot import CAMERA_OFFSET
 
 ##### HSV Colour Ranges ##########################################
 # Red color ranges
@@ -17,64 +26,1136 @@ yellowUpper = np.array([30, 255, 255])
 # Green color range
 greenLower = np.array([40, 70, 70])
 greenUpper = np.array([80, 255, 255])
+
+# Marker colours in priority order. A pixel's label is its index here plus one (0 means no colour)
+marker_colors = ['red', 'yellow', 'green']
+
+# Every HSV range that makes up a colour (red wraps around the hue range, so it has two)
+color_ranges = [
+    ('red', redLower1, redUpper1),
+    ('red', redLower2, redUpper2),
+    ('yellow', yellowLower, yellowUpper),
+    ('green', greenLower, greenUpper),
+]
 ##################################################################
 
 ##### Camera Parameters ##########################################
+left_camera_url = "http://192.168.223.77:8080/video"  # Other phone
+right_camera_url = "http://192.168.223.249:8080/video"  # Maher's phone
+single_camera_url = "http://192.168.223.249:8080/video"  # Maher's phone
 baseline = 0.10  # Distance between the two cameras in meters
 focal_length = 500  # Focal length in pixels
 size_threshold = 0.2  # Tolerance level for size similarity (20%)
 largest_marker_radius = 80  # Largest detectable marker's radius
 distance_to_largest_marker_radius = 20  # In centimeters
+smallest_marker_radius = 20  # Markers with an enclosing radius at or below this are ignored
+roi_margin = 40  # Pixels searched around the last marker (on top of its radius) when tracking
+full_scan_interval = 15  # Frames between full-frame rescans when tracking, so nearer markers are not missed
+coarse_radius_slack = 2  # Pixels of slack on the marker radius limits when searching a downscaled frame
+refine_margin = 3  # Downscaled pixels searched around a coarse marker (on top of its radius) at full resolution
+max_pair_skew = 0.025  # Largest capture time difference (seconds) allowed between a stereo pair's frames
+preview_fps = 5  # Highest rate the preview window is redrawn at
+history_length = 64  # Measurements kept in Vision.history
+filter_gain = 0.6  # Weight of a new reading against a marker's predicted position (MarkerFilter)
+gate_distance = 25  # Centimeters a reading may be from a marker's predicted position before it starts a new track
+max_dropout = 0.5  # Seconds a marker is still predicted for after it was last seen
+confidence_gain = 0.5  # How far each reading raises a marker's confidence towards 1 (it fades to 0 over max_dropout)
+min_confidence = 0.2  # Predictions are not published below this confidence
+calibration_file = "calibration.npz"  # Stereo calibration written by calibrate.py, used when it exists
+color_table_file = "colors.npz"  # Colour table written by thresholds.py, used instead of the HSV ranges when it exists
+stream_timeout = 5  # Seconds to wait for an MJPEG stream to connect or send data before giving up on it
+jpeg_buffer_size = 256 * 1024  # Starting size of each MJPEG frame buffer (they grow if a frame does not fit)
+throttled_fps = 10  # Highest rate frames are processed at while throttled (see Vision.Throttle)
+startup_timeout = 15  # Seconds to wait for the tracker's first processed frame (see Vision.WaitUntilReady)
+##################################################################
+
+
+##### Segmentation Tables ########################################
+def buildColorTables(color_ranges):
+    # Per-channel tables: bit i of an entry is set when that channel value is inside range i
+    channel_tables = np.zeros((3, 256), np.uint8)
+    for bit, (color, lower, upper) in enumerate(color_ranges):
+        for channel in range(3):
+            channel_tables[channel, lower[channel]:upper[channel] + 1] |= 1 << bit
+
+    # Label table: maps the ranges a pixel is inside of to its colour label (earlier colours win)
+    label_table = np.zeros(256, np.uint8)
+    for bits in range(1, 256):
+        for bit, (color, lower, upper) in enumerate(color_ranges):
+            if bits & (1 << bit):
+                label_table[bits] = marker_colors.index(color) + 1
+                break
+    return channel_tables[0], channel_tables[1], channel_tables[2], label_table
+
+hue_range_table, saturation_range_table, value_range_table, range_label_table = buildColorTables(color_ranges)
+morph_kernel = np.ones((5, 5), np.uint8)  # Same as two iterations with the default 3x3 kernel
+hsv_ranges = [0, 180, 0, 256, 0, 256]  # Value ranges of the H, S and V channels, split evenly into a colour table's bins
+
+
+# Loads a colour table written by thresholds.py: the label of every quantized (hue, saturation, value), laid out the way
+# cv2.calcBackProject looks it up.
+# Output: The table, or None if there is no such file (or it was made for other marker colours)
+def loadColorTable(path):
+    if path is None or not os.path.exists(path):
+        return None
+    data = np.load(path)
+    if list(data["colors"]) != marker_colors:
+        print(f"\t\tERROR: {path} is for the colours {list(data['colors'])}, not {marker_colors}")
+        return None
+    return data["table"].astype(np.float32)
 ##################################################################
 
+# JPEG decoders can skip the fine detail of a frame and decode it at a half, a quarter or an eighth of its size
+reduced_decode_flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+# Output: The frame shrunk by scale (1 leaves it as it is)
+def scaleFrame(frame, scale):
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+# Reads a video stream on its own thread and keeps only the newest frame, tagged with a monotonic timestamp.
+# Readers never block on the stream itself and never see a backlog of stale frames.
+class FrameGrabber:
+    live = True  # Timestamps are time.monotonic() capture times
+    
+    # Input:
+    #   source: Stream URL or camera index, anything cv2.VideoCapture opens
+    #   fps [Integer]: Frame rate asked of the camera
+    #   scale [Float]: Frames are shrunk by this factor (see Vision decode_scale)
+    def __init__(self, source, fps=30, scale=1.0):
+        self.capture = cv2.VideoCapture(source)
+        self.capture.set(cv2.CAP_PROP_FPS, fps)
+        self.scale = scale
+        
+        # Latest frame slot
+        self.new_frame = threading.Condition()
+        self.frame = None
+        self.timestamp = None
+        self.frame_id = 0
+        self.running = self.capture.isOpened()
+        self.decode_time = 0  # Seconds spent reading and decoding frames
+        
+        thread = threading.Thread(target=self.CaptureThread, daemon=True)
+        thread.start()
+    
+    def CaptureThread(self):
+        while self.running:
+            started = time.perf_counter()
+            rval, frame = self.capture.read()
+            timestamp = time.monotonic()
+            if rval:
+                frame = scaleFrame(frame, self.scale)
+            self.decode_time += time.perf_counter() - started
+            if not rval:
+                break
+            # Overwrite the slot; frames nobody picked up are simply dropped
+            with self.new_frame:
+                self.frame = frame
+                self.timestamp = timestamp
+                self.frame_id += 1
+                self.new_frame.notify_all()
+        
+        with self.new_frame:
+            self.running = False
+            self.new_frame.notify_all()
+        self.capture.release()
+    
+    def IsOpened(self):
+        return self.running
+    
+    # Blocks until a frame newer than after_id is available.
+    # Output: (frame_id, timestamp, frame) of the newest frame, or None if the stream has ended.
+    def WaitForFrame(self, after_id=0):
+        with self.new_frame:
+            while self.running and self.frame_id <= after_id:
+                self.new_frame.wait()
+            if self.frame_id <= after_id:
+                return None
+            return self.frame_id, self.timestamp, self.frame
+    
+    def Stop(self):
+        with self.new_frame:
+            self.running = False
+            self.new_frame.notify_all()
+
+
+# Splits a multipart MJPEG stream (an IP Webcam /video stream, or a file recorded from one) into its JPEGs.
+class MjpegParser:
+    def __init__(self, stream):
+        self.stream = stream  # Anything with readline and readinto: an HTTP response or a file opened in binary mode
+
+    # Reads the next JPEG into the buffer, replacing the buffer with a bigger one if the JPEG does not fit.
+    # Output: (buffer, length of the JPEG in bytes), or (buffer, 0) at the end of the stream
+    def ReadFrame(self, buffer):
+        # Skip to the next boundary, then read the part's headers up to the blank line after them
+        line = self.stream.readline()
+        while line and not line.startswith(b"--"):
+            line = self.stream.readline()
+        length = None
+        line = self.stream.readline()
+        while line.strip():
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value)
+            line = self.stream.readline()
+        if not line:
+            return buffer, 0
+
+        if length is None:
+            # No length given: the JPEG runs up to its end of image marker. Only the line just read (and the byte
+            # before it, in case the marker straddles the lines) is searched for it, so the search stays linear
+            length = 0
+            while True:
+                line = self.stream.readline()
+                if not line:
+                    return buffer, 0
+                if length + len(line) > len(buffer):
+                    grown = bytearray(max(2 * len(buffer), length + len(line)))
+                    grown[:length] = buffer[:length]
+                    buffer = grown
+                buffer[length:length + len(line)] = line
+                start = max(length - 1, 0)
+                length += len(line)
+                if buffer[start:length].rstrip(b"\r\n").endswith(b"\xff\xd9"):
+                    return buffer, length
+
+        if length > len(buffer):
+            buffer = bytearray(2 * length)
+        view = memoryview(buffer)
+        received = 0
+        while received < length:
+            count = self.stream.readinto(view[received:length])
+            if not count:
+                return buffer, 0
+            received += count
+        return buffer, length
+
+
+# Output: The JPEG decoded at the given scale (1, 0.5, 0.25 or 0.125; anything else is decoded whole and resized), or
+# None if it is corrupt
+def decodeJpeg(jpeg, scale=1.0):
+    reduction = round(1 / scale)
+    if reduction in reduced_decode_flags and abs(reduction * scale - 1) < 1e-6:
+        return cv2.imdecode(np.frombuffer(jpeg, np.uint8), reduced_decode_flags[reduction])
+    frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+    return scaleFrame(frame, scale) if frame is not None else None
+
+
+# Reads an MJPEG stream (IP Webcam's /video) on its own thread, like FrameGrabber, but without decoding on that thread.
+# Every JPEG is copied into one of three reusable buffers, and only the newest one is decoded, on the reader's thread and
+# only when a frame is asked for, so frames the tracker is too slow for are dropped without ever being decoded. Frames
+# can be decoded at a reduced scale, which skips most of the decoding work.
+class MjpegGrabber:
+    live = True  # Timestamps are time.monotonic() capture times
+    
+    # Input:
+    #   url [String]: Stream URL
+    #   scale [Float]: Decode frames shrunk by this factor (see Vision decode_scale)
+    def __init__(self, url, scale=1.0):
+        self.url = url
+        self.scale = scale
+        
+        # JPEG buffers: the newest complete JPEG, the one being decoded and the one being received are never the same
+        self.buffers = [bytearray(jpeg_buffer_size) for _ in range(3)]
+        self.lengths = [0, 0, 0]
+        self.latest = None  # Buffer holding the newest JPEG
+        self.decoding = None  # Buffer being decoded
+        
+        # Latest frame slot
+        self.new_frame = threading.Condition()
+        self.timestamp = None
+        self.frame_id = 0
+        self.frame = None  # Last decoded frame, and its id
+        self.decoded_id = 0
+        self.decode_time = 0  # Seconds spent decoding frames
+        
+        try:
+            self.parser = MjpegParser(urllib.request.urlopen(url, timeout=stream_timeout))
+            self.running = True
+        except (OSError, ValueError) as error:
+            print(f"\t\tERROR: Could not open {url}: {error}")
+            self.running = False
+        
+        if self.running:
+            thread = threading.Thread(target=self.ReceiveThread, daemon=True)
+            thread.start()
+    
+    def ReceiveThread(self):
+        try:
+            while self.running:
+                with self.new_frame:
+                    index = [i for i in range(3) if i != self.latest and i != self.decoding][0]
+                self.buffers[index], length = self.parser.ReadFrame(self.buffers[index])
+                if length == 0:
+                    break
+                # Overwrite the slot; JPEGs nobody asked for are simply dropped
+                with self.new_frame:
+                    self.lengths[index] = length
+                    self.latest = index
+                    self.timestamp = time.monotonic()
+                    self.frame_id += 1
+                    self.new_frame.notify_all()
+        except (OSError, ValueError) as error:
+            if self.running:
+                print(f"\t\tERROR: Lost {self.url}: {error}")
+        
+        with self.new_frame:
+            self.running = False
+            self.new_frame.notify_all()
+        self.parser.stream.close()
+    
+    def IsOpened(self):
+        return self.running
+    
+    # Blocks until a frame newer than after_id is available, and decodes it.
+    # Output: (frame_id, timestamp, frame) of the newest frame, or None if the stream has ended.
+    def WaitForFrame(self, after_id=0):
+        with self.new_frame:
+            while self.running and self.frame_id <= after_id:
+                self.new_frame.wait()
+            if self.frame_id <= after_id:
+                return None
+            if self.decoded_id == self.frame_id:
+                return self.frame_id, self.timestamp, self.frame
+            frame_id, timestamp, index = self.frame_id, self.timestamp, self.latest
+            self.decoding = index
+        
+        started = time.perf_counter()
+        frame = decodeJpeg(memoryview(self.buffers[index])[:self.lengths[index]], self.scale)
+        self.decode_time += time.perf_counter() - started
+        
+        with self.new_frame:
+            self.decoding = None
+            if frame is None:
+                print(f"\t\tERROR: Corrupt frame from {self.url}")
+            else:
+                self.frame = frame
+                self.decoded_id = frame_id
+        if frame is None:
+            return self.WaitForFrame(frame_id)
+        return frame_id, timestamp, frame
+    
+    def Stop(self):
+        with self.new_frame:
+            self.running = False
+            self.new_frame.notify_all()
+
+
+# Replays a recorded video file, MJPEG stream (.mjpeg or .mjpg) or directory of images, one frame each time the tracker
+# asks for a new one. Nothing is dropped, so a clip runs through the tracker as fast as it can process it.
+# Timestamps come from the frame's position in the recording, so stereo clips still pair up by capture time.
+class RecordingSource:
+    image_extensions = (".png", ".jpg", ".jpeg", ".bmp")
+    mjpeg_extensions = (".mjpeg", ".mjpg")
+    live = False  # Timestamps are positions in the recording
+    
+    # Input:
+    #   path [String]: Video file, MJPEG file or directory of images
+    #   fps [Integer]: Frame rate of an MJPEG file or image sequence (video files know their own)
+    #   scale [Float]: Frames are shrunk by this factor (see Vision decode_scale). MJPEG files are decoded at that scale.
+    def __init__(self, path, fps=30, scale=1.0):
+        self.capture = None
+        self.images = None
+        self.parser = None
+        self.fps = fps
+        if os.path.isdir(path):
+            # Image sequence, in file name order
+            self.images = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                 if name.lower().endswith(self.image_extensions))
+            self.running = len(self.images) > 0
+        elif path.lower().endswith(self.mjpeg_extensions):
+            self.parser = MjpegParser(open(path, "rb"))
+            self.buffer = bytearray(jpeg_buffer_size)
+            self.running = True
+        else:
+            self.capture = cv2.VideoCapture(path)
+            self.fps = self.capture.get(cv2.CAP_PROP_FPS) or fps
+            self.running = self.capture.isOpened()
+        
+        self.scale = scale
+        self.frame = None
+        self.timestamp = None
+        self.frame_id = 0
+        self.decode_time = 0  # Seconds spent reading and decoding frames
+    
+    def IsOpened(self):
+        return self.running
+    
+    # Reads the next frame if the caller has already seen the current one (same interface as FrameGrabber).
+    # Output: (frame_id, timestamp, frame), or None at the end of the recording.
+    def WaitForFrame(self, after_id=0):
+        if self.frame_id <= after_id and self.running:
+            started = time.perf_counter()
+            if self.capture is not None:
+                rval, frame = self.capture.read()
+            elif self.parser is not None:
+                self.buffer, length = self.parser.ReadFrame(self.buffer)
+                frame = decodeJpeg(memoryview(self.buffer)[:length], self.scale) if length > 0 else None
+                rval = frame is not None
+            else:
+                frame = cv2.imread(self.images[self.frame_id]) if self.frame_id < len(self.images) else None
+                rval = frame is not None
+            if rval and self.parser is None:
+                frame = scaleFrame(frame, self.scale)
+            self.decode_time += time.perf_counter() - started
+            
+            if rval:
+                self.frame = frame
+                self.timestamp = self.frame_id / self.fps
+                self.frame_id += 1
+            else:
+                self.Stop()
+        
+        if self.frame_id <= after_id:
+            return None
+        return self.frame_id, self.timestamp, self.frame
+    
+    def Stop(self):
+        self.running = False
+        if self.capture is not None:
+            self.capture.release()
+        if self.parser is not None:
+            self.parser.stream.close()
+
+
+# One published tracker result. Immutable, so the distance, angle and color always belong to the same frame(s).
+#   sequence [Integer]: Increases by one with every published measurement (0 means nothing published yet)
+#   timestamp [Float]: Capture time of the frame (the older frame of a stereo pair). time.monotonic() for live cameras,
+#                      position in the recording for recorded clips
+Measurement = namedtuple("Measurement", ["sequence", "timestamp", "distance", "angle", "color", "confidence"])
+
+
+# The last few measurements, kept in preallocated arrays (oldest entries are overwritten) so windowed queries are cheap.
+# Missing distances and angles are stored as NaN, colors as their index in marker_colors (-1 if none).
+class MeasurementHistory:
+    fields = ["sequence", "timestamp", "distance", "angle", "color", "confidence"]
+    
+    def __init__(self, capacity=history_length):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.count = 0  # Measurements added so far
+        self.sequence = np.zeros(capacity, np.int64)
+        self.timestamp = np.zeros(capacity)
+        self.distance = np.full(capacity, np.nan)
+        self.angle = np.full(capacity, np.nan)
+        self.color = np.full(capacity, -1, np.int8)
+        self.confidence = np.zeros(capacity)
+    
+    def Append(self, measurement):
+        with self.lock:
+            i = self.count % self.capacity
+            self.sequence[i] = measurement.sequence
+            self.timestamp[i] = measurement.timestamp if measurement.timestamp is not None else np.nan
+            self.distance[i] = measurement.distance if measurement.distance is not None else np.nan
+            self.angle[i] = measurement.angle if measurement.angle is not None else np.nan
+            self.color[i] = marker_colors.index(measurement.color) if measurement.color in marker_colors else -1
+            self.confidence[i] = measurement.confidence
+            self.count += 1
+    
+    # Input:
+    #   count [Integer]: How many of the latest measurements to look at
+    #   since [Float]: If given, only keep measurements captured at or after this timestamp
+    # Output: Dictionary of arrays, one per field, oldest measurement first
+    def Window(self, count, since=None):
+        with self.lock:
+            count = min(count, self.count, self.capacity)
+            indices = np.arange(self.count - count, self.count) % self.capacity
+            window = {field: getattr(self, field)[indices] for field in self.fields}
+        
+        if since is not None:
+            recent = window["timestamp"] >= since
+            window = {field: values[recent] for field, values in window.items()}
+        return window
+    
+    # Median of a field ("distance" or "angle") over a window, skipping frames without a value.
+    # Output: The median, or None if fewer than minimum frames had a value
+    def Median(self, field, count, since=None, minimum=1):
+        values = self.Window(count, since)[field]
+        values = values[~np.isnan(values)]
+        if len(values) < minimum:
+            return None
+        return float(np.median(values))
+
+
+# Follows each marker colour across frames, in the car's frame of reference (x to the right and z ahead, in cm), so a
+# marker missing from a frame or two is predicted instead of dropped. Readings are smoothed against the prediction,
+# which moves with the car (see Vision.SetMotion). Every estimate comes with a confidence between 0 and 1.
+class MarkerFilter:
+    # Input: camera_offset [Float]: cm from the rear axle, which the car turns around, forward to the cameras
+    def __init__(self, camera_offset=CAMERA_OFFSET):
+        self.camera_offset = camera_offset
+        self.tracks = {}  # Colour -> [x, z, time last seen, confidence when last seen]
+        self.motion = (0.0, 0.0)  # The car's speed (cm/s, negative reversing) and turn rate (rad/s, positive turns right)
+        self.timestamp = None  # Capture time the tracks were last moved to
+        self.stale = set()  # Colours whose next reading replaces their track instead of being smoothed into it
+
+    # Moves every track by the car's motion since the last frame (markers move the opposite way in the car's frame). The
+    # car turns about its rear axle, so tracks are rotated about that rather than about the cameras.
+    def Predict(self, timestamp):
+        if self.timestamp is not None and timestamp > self.timestamp:
+            dt = timestamp - self.timestamp
+            velocity, turn_rate = self.motion
+            cos_turn = math.cos(turn_rate * dt)
+            sin_turn = math.sin(turn_rate * dt)
+            for track in self.tracks.values():
+                x, z = track[0], track[1] + self.camera_offset - velocity * dt  # From the rear axle
+                track[0] = x * cos_turn - z * sin_turn
+                track[1] = x * sin_turn + z * cos_turn - self.camera_offset
+        if self.timestamp is None or timestamp > self.timestamp:
+            self.timestamp = timestamp
+
+    # Input: The tracker's reading for one frame (distance, angle and color may each be None)
+    # Output: (distance, angle, color, confidence) to publish for the frame
+    def Update(self, timestamp, distance, angle, color):
+        self.Predict(timestamp)
+
+        if color in marker_colors and distance is not None and angle is not None:
+            x = distance * math.sin(math.radians(angle))
+            z = distance * math.cos(math.radians(angle))
+            track = self.tracks.get(color)
+            if track is None or math.hypot(track[0] - x, track[1] - z) > gate_distance:
+                track = self.tracks[color] = [x, z, timestamp, 0.0]
+            elif color in self.stale:
+                track[0], track[1], track[2] = x, z, timestamp
+            else:
+                track[0] += filter_gain * (x - track[0])
+                track[1] += filter_gain * (z - track[1])
+                track[2] = timestamp
+            track[3] += confidence_gain * (1 - track[3])
+            self.stale.discard(color)
+            return self.Estimate(track) + (color, track[3])
+
+        # No full reading: forget stale markers and predict the most recently seen one, with fading confidence.
+        # A glitched stereo pair (colours or sizes that do not match) only gives a "try +-20" hint, which must not
+        # override a marker that is still being tracked.
+        for track_color, track in list(self.tracks.items()):
+            if timestamp - track[2] > max_dropout:
+                del self.tracks[track_color]
+        if self.tracks:
+            track_color, track = max(self.tracks.items(), key=lambda item: item[1][2])
+            confidence = track[3] * (1 - (timestamp - track[2]) / max_dropout)
+            if confidence >= min_confidence:
+                return self.Estimate(track) + (track_color, confidence)
+
+        if angle is not None:
+            # Partial marker (single camera, at the frame edge) and nothing tracked: pass it on as it is
+            return distance, angle, color, confidence_gain
+        return None, None, None, 0.0
+
+    # Frames were skipped, so the tracks have only been predicted for a while: the next reading of each marker replaces
+    # its track instead of being smoothed against a prediction that may have drifted
+    def Resync(self):
+        self.stale = set(self.tracks)
+
+    # Output: (distance, angle) of a track
+    def Estimate(self, track):
+        return math.hypot(track[0], track[1]), math.degrees(math.atan2(track[0], track[1]))
+
+
+# Each camera's intrinsics and lens distortion, and where the right camera sits relative to the left one, as measured by
+# calibrate.py. Rectification maps the two cameras onto ideal, row-aligned pinhole cameras, so the disparity of a marker
+# gives its true depth. Frames at another resolution than the calibration reuse it with scaled intrinsics.
+class StereoCalibration:
+    def __init__(self, path):
+        data = np.load(path)
+        self.path = path
+        self.size = tuple(int(value) for value in data["size"])  # (width, height) the cameras were calibrated at
+        self.camera_matrices = [data["K1"], data["K2"]]
+        self.distortion = [data["D1"], data["D2"]]
+        self.rotation = data["R"]
+        self.translation = data["T"]  # Centimeters
+        self.rectifications = {}  # (width, height) -> (camera matrices, rectification rotations, projection matrices)
+        self.maps = {}  # (width, height) -> [left (map1, map2), right (map1, map2)]
+
+    # Output: ([K left, K right], [R1, R2], [P1, P2]) for frames of the given (width, height)
+    def Rectification(self, size):
+        if size not in self.rectifications:
+            scale = np.diag([size[0] / self.size[0], size[1] / self.size[1], 1.0])
+            matrices = [scale @ matrix for matrix in self.camera_matrices]
+            R1, R2, P1, P2, _, _, _ = cv2.stereoRectify(matrices[0], self.distortion[0], matrices[1], self.distortion[1],
+                                                        size, self.rotation, self.translation,
+                                                        flags=cv2.CALIB_ZERO_DISPARITY, alpha=0)
+            self.rectifications[size] = (matrices, [R1, R2], [P1, P2])
+        return self.rectifications[size]
+
+    # Moves a point found in one camera's frame to where the rectified camera would have seen it.
+    # Input:
+    #   camera [Integer]: 0 for the left camera, 1 for the right one
+    #   point [Array]: (x, y) in pixels
+    #   size [Tuple]: (width, height) of the frame
+    # Output: (x, y) in the rectified frame
+    def RectifyPoint(self, camera, point, size):
+        matrices, rotations, projections = self.Rectification(size)
+        points = np.array(point[:2], np.float64).reshape(1, 1, 2)
+        rectified = cv2.undistortPoints(points, matrices[camera], self.distortion[camera], R=rotations[camera],
+                                        P=projections[camera])
+        return rectified[0, 0]
+
+    # Finds a marker from where the two cameras saw it.
+    # Input:
+    #   point_left, point_right [Array]: (x, y) of the marker in the left and right frames, in pixels
+    #   size [Tuple]: (width, height) of the frames
+    #   rectified [Boolean]: The points come from rectified frames (see Rectify)
+    # Output: (depth in cm, angle in degrees) from the midpoint between the cameras, or None if there is no disparity
+    def Locate(self, point_left, point_right, size, rectified=False):
+        _, (R1, _), (P1, P2) = self.Rectification(size)
+        if not rectified:
+            point_left = self.RectifyPoint(0, point_left, size)
+            point_right = self.RectifyPoint(1, point_right, size)
+
+        disparity = point_left[0] - point_right[0]  # In pixels
+        if disparity <= 0:
+            return None
+        focal, c_x, c_y = P1[0, 0], P1[0, 2], P1[1, 2]
+        Z = -P2[0, 3] / disparity  # P2[0, 3] is -focal * baseline
+        rectified_position = np.array([(point_left[0] - c_x) * Z / focal, (point_left[1] - c_y) * Z / focal, Z])
+
+        # Back to the left camera's orientation (rectification turns both cameras a little), then from the midpoint
+        position = R1.T @ rectified_position + self.rotation.T @ self.translation.ravel() / 2
+        return position[2], np.degrees(np.arctan2(position[0], position[2]))
+
+    # Output: The remap tables of both cameras for frames of the given (width, height). Building them takes a while, so
+    # they are kept next to the calibration file and rebuilt only when the calibration changes.
+    def Maps(self, size):
+        if size not in self.maps:
+            cache = f"{os.path.splitext(self.path)[0]}_{size[0]}x{size[1]}.maps.npz"
+            source_time = os.path.getmtime(self.path)
+            if os.path.exists(cache) and os.path.getmtime(cache) >= source_time:
+                data = np.load(cache)
+                self.maps[size] = [(data["left1"], data["left2"]), (data["right1"], data["right2"])]
+            else:
+                matrices, rotations, projections = self.Rectification(size)
+                self.maps[size] = [cv2.initUndistortRectifyMap(matrices[camera], self.distortion[camera],
+                                                               rotations[camera], projections[camera], size,
+                                                               cv2.CV_16SC2)
+                                   for camera in range(2)]
+                (left1, left2), (right1, right2) = self.maps[size]
+                np.savez(cache, left1=left1, left2=left2, right1=right1, right2=right2)
+        return self.maps[size]
+
+    # Output: The frame as the rectified camera (0 left, 1 right) would have captured it
+    def Rectify(self, frame, camera):
+        map1, map2 = self.Maps((frame.shape[1], frame.shape[0]))[camera]
+        return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR)
+
+
+# Records the time since started (a time.perf_counter() reading) in the stage's latency metric ("vision.<stage>"), and
+# adds it to the stage's total when stage timing is turned on
+def recordStage(stage_times, stage, started):
+    elapsed = time.perf_counter() - started
+    metrics.observe("vision." + stage, elapsed)
+    if stage_times is not None:
+        stage_times[stage] = stage_times.get(stage, 0) + elapsed
+
+
+# Opens a frame source: a live stream URL (or camera index), a video file, an MJPEG file, or a directory of images.
+# HTTP streams are read as MJPEG (what IP Webcam serves), so they can be decoded at a reduced scale. Sources that are
+# already open (e.g. a session.SessionSource) are used as they are.
+def openSource(source, scale=1.0):
+    if hasattr(source, "WaitForFrame"):
+        return source
+    if isinstance(source, str) and os.path.exists(source):
+        return RecordingSource(source, scale=scale)
+    if isinstance(source, str) and source.startswith("http"):
+        return MjpegGrabber(source, scale)
+    return FrameGrabber(source, scale=scale)
 
-class Vision:
+
+# Opens several frame sources at the same time, so connecting to one stream does not wait for the others.
+# Output: The opened sources, in the same order
+def openSources(sources, scale=1.0):
+    opened = [None] * len(sources)
+    
+    def openOne(i):
+        opened[i] = openSource(sources[i], scale)
     
-    def __init__(self, stereo):
+    threads = [threading.Thread(target=openOne, args=(i,)) for i in range(len(sources))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return opened
+
+
+# Work buffers for the detection stages, sized to the stream resolution, so each frame is segmented into the same arrays
+# instead of a dozen new full-frame arrays per camera per iteration. A smaller image (a search window, a downscaled frame
+# or the frame of a camera with a lower resolution) uses the top-left corner of each buffer. The buffers only grow, to
+# the largest resolution seen, so cameras that differ in resolution share them without reallocating on every frame.
+class FramePool:
+    buffer_channels = {"small": 3, "hsv": 3, "hue": 1, "saturation": 1, "value": 1, "labels": 1, "lowest": 1,
+                       "highest": 1, "mask": 1}  # Name -> channels of each buffer
+
+    def __init__(self):
+        self.shape = None  # (height, width) the buffers are sized for
+        self.buffers = {}  # Name -> buffer
+        self.allocations = 0  # Buffers allocated so far
+
+    # Sizes the buffers for frames of the given shape, allocating them all at once if such frames do not fit yet
+    def Fit(self, shape):
+        height, width = shape[:2]
+        if self.shape is not None:
+            if height <= self.shape[0] and width <= self.shape[1]:
+                return
+            height, width = max(height, self.shape[0]), max(width, self.shape[1])
+        self.shape = height, width
+        self.buffers = {name: np.empty((height, width, channels) if channels > 1 else (height, width), np.uint8)
+                        for name, channels in self.buffer_channels.items()}
+        self.allocations += len(self.buffers)
+        metrics.count("vision.pool_allocations", len(self.buffers))
+
+    # Output: The named buffer cut down to the given (height, width), for a stage to write its result into
+    def Get(self, name, shape):
+        return self.buffers[name][:shape[0], :shape[1]]
+
+
+# Finds the marker in a frame. Keeps the per-camera state needed for region of interest tracking.
+class MarkerDetector:
+    # Input:
+    #   roi_tracking [Boolean]: Search around the last detected marker instead of scanning every full frame
+    #   scale [Float]: Below 1, blobs are first searched for in a frame downscaled by this factor (e.g. 0.5 or 0.25),
+    #                  and only the winning blob is measured at full resolution
+    #   stage_times [Dictionary]: If given, the time spent in each detection stage is added to it (see recordStage)
+    #   frame_scale [Float]: Below 1, frames arrive shrunk by this factor (see Vision decode_scale). Markers are searched
+    #                        for in them directly (no coarse-to-fine), and circles are still returned in pixels of the
+    #                        camera's full resolution.
+    #   color_table [Array]: Colour table to label pixels with (see loadColorTable), None to use the HSV ranges
+    def __init__(self, roi_tracking=False, scale=1.0, stage_times=None, frame_scale=1.0, color_table=None):
+        self.stage_times = stage_times
+        # Wrapped so the table's last dimension is not taken for its channels (arrays lose the wrapping when pickled)
+        self.color_table = cv2.Mat(color_table, wrap_channels=False) if color_table is not None else None
+        
+        # Region of interest tracking: search around the last detected marker instead of the whole frame
+        self.roi_tracking = roi_tracking
+        self.roi_margin = roi_margin
+        self.full_scan_interval = full_scan_interval
+        self.last_circles = {}  # Last detected circle of each camera
+        self.frames_since_scan = {}  # Frames tracked in a window since each camera's last full scan
+        
+        # Coarse-to-fine detection. The clean-up kernel shrinks with the frame so it removes the same size of noise.
+        self.scale = scale
+        self.frame_scale = frame_scale
+        kernel_size = 2 * round(2 * min(scale, frame_scale)) + 1
+        self.coarse_kernel = np.ones((kernel_size, kernel_size), np.uint8)
+
+        self.pool = FramePool()  # Sized on the first frame
+
+    def TrackLocation(self, frame, camera):
+        self.pool.Fit(frame.shape)
+        
+        # Without tracking, always scan the whole frame
+        if not self.roi_tracking:
+            return self.GetLocation(frame)
+
+        last_circle = self.last_circles.get(camera)
+        frames_tracked = self.frames_since_scan.get(camera, 0)
+        
+        # Search a window around the last marker, padded by its radius plus a margin
+        if last_circle is not None and frames_tracked < self.full_scan_interval:
+            x, y, radius = last_circle * self.frame_scale
+            frame_height, frame_width = frame.shape[:2]
+            padding = radius + self.roi_margin * self.frame_scale
+            left = max(int(x - padding), 0)
+            top = max(int(y - padding), 0)
+            right = min(int(x + padding) + 1, frame_width)
+            bottom = min(int(y + padding) + 1, frame_height)
+            
+            circle, color = self.GetLocation(frame[top:bottom, left:right])
+            if circle is not None:
+                # Move the circle back into full frame coordinates
+                circle[0] += left / self.frame_scale
+                circle[1] += top / self.frame_scale
+                self.last_circles[camera] = circle
+                self.frames_since_scan[camera] = frames_tracked + 1
+                return circle, color
+        
+        # Marker lost (or a periodic rescan is due), so scan the whole frame
+        circle, color = self.GetLocation(frame)
+        self.last_circles[camera] = circle
+        self.frames_since_scan[camera] = 0
+        return circle, color
+        
+    def GetLocation(self, frame):
+        if self.frame_scale < 1:
+            # The frame is already shrunk, so it is searched as it is and the circle scaled back up
+            circle, color = self.FindMarker(self.SegmentFrame(frame, self.coarse_kernel), self.frame_scale)
+            return (circle / self.frame_scale if circle is not None else None), color
+        if self.scale >= 1:
+            return self.FindMarker(self.SegmentFrame(frame))
+        
+        # Coarse: find the winning blob in a downscaled copy of the frame
+        started = time.perf_counter()
+        frame_height, frame_width = frame.shape[:2]
+        small_size = (round(frame_width * self.scale), round(frame_height * self.scale))
+        small = cv2.resize(frame, small_size, dst=self.pool.Get("small", small_size[::-1]),
+                           interpolation=cv2.INTER_AREA)
+        recordStage(self.stage_times, "resize", started)
+        coarse_circle, _ = self.FindMarker(self.SegmentFrame(small, self.coarse_kernel), self.scale)
+        if coarse_circle is None:
+            return None, None
+        
+        # Fine: measure its centre and radius at full resolution, in a window around it
+        x, y, radius = coarse_circle / self.scale
+        padding = radius + refine_margin / self.scale
+        left = max(int(x - padding), 0)
+        top = max(int(y - padding), 0)
+        right = min(int(x + padding) + 1, frame_width)
+        bottom = min(int(y + padding) + 1, frame_height)
+        
+        circle, color = self.FindMarker(self.SegmentFrame(frame[top:bottom, left:right]))
+        if circle is not None:
+            # Move the circle back into full frame coordinates
+            circle[0] += left
+            circle[1] += top
+        return circle, color
+    
+    # Picks the marker out of a label image (see SegmentFrame).
+    # Input:
+    #   labels [Array]: Label image
+    #   scale [Float]: Scale of the label image relative to the camera frame. The radius limits are scaled to match,
+    #                  with some slack so a borderline marker is still handed to the full resolution check.
+    # Output: (circle, color) of the largest valid marker, or (None, None)
+    def FindMarker(self, labels, scale=1.0):
+        if scale >= 1:
+            min_radius, max_radius = smallest_marker_radius, largest_marker_radius
+        else:
+            min_radius = smallest_marker_radius * scale - coarse_radius_slack
+            max_radius = largest_marker_radius * scale + coarse_radius_slack
+        
+        started = time.perf_counter()
+        
+        # Initialize list to hold contours with their colors
+        contours_with_color = []
+        
+        # Pull the blobs of each colour out of the shared label image
+        for label, color in enumerate(marker_colors, start=1):
+            mask = cv2.compare(labels, label, cv2.CMP_EQ, dst=self.pool.Get("mask", labels.shape))
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            for c in contours:
+                contours_with_color.append((color, c))
+            
+        # Proceed only if at least one contour was found
+        if len(contours_with_color) > 0:
+            # Sort the contours by area in descending order
+            contours_with_color.sort(key=lambda x: cv2.contourArea(x[1]), reverse=True)
+            
+            # Iterate through the sorted contours to find the first valid one
+            for color, contour in contours_with_color:
+                # Determine the circle enclosing the current contour
+                ((x, y), radius) = cv2.minEnclosingCircle(contour)
+                if min_radius < radius <= max_radius:
+                    # Return the circle parameters and the color
+                    recordStage(self.stage_times, "contours", started)
+                    return np.array([x, y, radius]), color
+        
+        recordStage(self.stage_times, "contours", started)
+        return None, None
+
+    # Labels every pixel of the frame with its marker colour (see marker_colors), cleaned of specks.
+    # Output: The label image, in the pool's "labels" buffer (valid until the next frame is segmented)
+    def SegmentFrame(self, frame, kernel=morph_kernel):
+        shape = frame.shape[:2]
+        
+        # Convert the frame to HSV color space
+        started = time.perf_counter()
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=self.pool.Get("hsv", shape))
+        recordStage(self.stage_times, "hsv", started)
+        
+        started = time.perf_counter()
+        if self.color_table is not None:
+            # One lookup per pixel in the calibrated colour table
+            labels = cv2.calcBackProject([hsv], [0, 1, 2], self.color_table, hsv_ranges, 1,
+                                         dst=self.pool.Get("labels", shape))
+        else:
+            # Look up which colour ranges each channel value falls in, then keep the ranges all three channels agree on
+            hue, saturation, value = cv2.split(hsv, [self.pool.Get("hue", shape), self.pool.Get("saturation", shape),
+                                                     self.pool.Get("value", shape)])
+            ranges = cv2.LUT(hue, hue_range_table, dst=hue)
+            ranges = cv2.bitwise_and(ranges, cv2.LUT(saturation, saturation_range_table, dst=saturation), dst=ranges)
+            ranges = cv2.bitwise_and(ranges, cv2.LUT(value, value_range_table, dst=value), dst=ranges)
+            labels = cv2.LUT(ranges, range_label_table, dst=self.pool.Get("labels", shape))
+        
+        # Morphological operations, done once for all colours.
+        # A pixel survives the erosion only if its whole neighbourhood has the same label (min == max).
+        # Eroded blobs of different colours end up far enough apart that dilating the label image never lets them overlap.
+        lowest = cv2.erode(labels, kernel, dst=self.pool.Get("lowest", shape))
+        highest = cv2.dilate(labels, kernel, dst=self.pool.Get("highest", shape))
+        uniform = cv2.compare(lowest, highest, cv2.CMP_EQ, dst=lowest)
+        uniform = cv2.bitwise_and(labels, uniform, dst=uniform)
+        labels = cv2.dilate(uniform, kernel, dst=labels)
+        recordStage(self.stage_times, "masks", started)
+        return labels
+
+
+# Runs a MarkerDetector for one camera in its own process, so detection neither waits for the other camera nor holds the GIL.
+# Frames are copied into a shared memory buffer instead of being pickled; only the small (circle, color) result is sent back.
+class DetectionWorker:
+    def __init__(self, shape, roi_tracking=False, scale=1.0, frame_scale=1.0, color_table=None):
+        self.shape = shape
+        self.buffer = multiprocessing.RawArray('B', int(np.prod(shape)))
+        self.frame = np.frombuffer(self.buffer, np.uint8).reshape(shape)
+        
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=detectionWorker,
+                                               args=(self.buffer, shape, roi_tracking, scale, frame_scale, color_table,
+                                                     worker_connection),
+                                               daemon=True)
+        self.process.start()
+    
+    # Starts detection on a frame (non-blocking). Collect the result with Result().
+    def Submit(self, frame):
+        np.copyto(self.frame, frame)
+        self.connection.send(True)
+    
+    # Blocks until the submitted frame has been processed.
+    # Output: (circle, color), same as MarkerDetector.TrackLocation
+    def Result(self):
+        return self.connection.recv()
+    
+    def Stop(self):
+        self.connection.send(False)
+        self.process.join(timeout=1)
+
+
+def detectionWorker(buffer, shape, roi_tracking, scale, frame_scale, color_table, connection):
+    frame = np.frombuffer(buffer, np.uint8).reshape(shape)
+    detector = MarkerDetector(roi_tracking, scale, frame_scale=frame_scale, color_table=color_table)
+    # Each worker only ever sees one camera
+    while connection.recv():
+        connection.send(detector.TrackLocation(frame, "camera"))
+
+
+# The distance and angle to a marker, worked out from where the cameras saw it (without calibration). Vision runs these
+# on every frame; tools that have detections of their own (see drift.py) run the same calculations on one of these.
+class MarkerGeometry:
+    def __init__(self):
+        # Results of the last calculation
         self.distance = None
         self.angle = None
         self.color = None
+    
+    def StereoVision(self, c_x, x_left, x_right):        
+        disparity = abs(x_left - x_right)  # In pixels
+        
+        if disparity != 0:
+            # Calculate depth (Z)
+            Z = (focal_length * baseline) / disparity  # Depth in meters
+            self.distance = Z * 100  # Depth in centimeters
+            
+            # Calculate the average x-position of the marker
+            x_center_image = (x_left + x_right) / 2  # In pixels
+            
+            # Calculate horizontal displacement (X)
+            X = (x_center_image - c_x) * Z / focal_length  # In meters
+            
+            # Calculate the angle in radians
+            angle_rad = np.arctan2(X, Z)
+            # Convert to degrees
+            self.angle = np.degrees(angle_rad)
 
-        # self.TrackerThread(stereo)  # Use this instead of the threading code below if on macOS if you want to see camera view
-        thread = threading.Thread(target=self.TrackerThread, args=(stereo,), daemon=True)
-        thread.start()
+        else:
+            print("\t\tERROR: Disparity is zero, cannot compute depth")
+            self.distance = None
+            self.angle = None
+            self.color = None
+            
+    def SingleCameraCalculations(self, frame_height, frame_width, circle):
+        # Extract the marker's information
+        x, y, radius = circle
+        c_x = frame_width / 2
+
+        # Contour completeness check
+        margin = 5  # Pixel margin to check if marker is too close to the frame edges
+        tolerance = 15  # degrees (tolerance for angle to the marker)
+        if (x - radius < margin or x + radius > frame_width - margin):
+            if round(radius) < 55:
+                self.distance = None
+                self.color = radius
+                if x - c_x > tolerance:
+                    self.angle = 20
+                elif x - c_x < -tolerance:
+                    self.angle = -20
+                else:
+                    self.angle = 0
+                return
+        if (y - radius < margin or y + radius > frame_height - margin):
+            if round(radius) < 65:
+                self.distance = None
+                self.color = radius
+                if x - c_x > 0:
+                    self.angle = 20
+                elif x - c_x < 0:
+                    self.angle = -20
+                else:
+                    self.angle = 0
+                return
+            
+        # Minimum radius threshold to filter out small unreliable detections
+        threshold = 20  # Pixels
+        if radius < threshold:
+            self.distance = None
+            self.angle = None
+            self.color = None
+            return
+        
+        # Calculate the distance to the marker using scaling
+        if radius > 0:
+            # Approach 1
+            self.distance = (distance_to_largest_marker_radius * largest_marker_radius) / radius  # Distance in cm
+
+            # Calculate the angle to the marker
+            del_x = x - c_x  # Horizontal Displacement
+            
+            # Calculate the angle in radians and then convert to degrees
+            angle_rad = np.arctan2(del_x, focal_length)
+            self.angle = np.degrees(angle_rad)
+        else:
+            self.distance = None
+            self.angle = None
+            self.color = None
+
+
+class Vision(MarkerGeometry):
+    
+    # Input:
+    #   stereo [Boolean]: Use both cameras (stereo vision) or a single camera
+    #   roi_tracking [Boolean]: Search around the last detected marker instead of scanning every full frame
+    #   display [String]: "window" draws and shows every frame on the tracker thread, "preview" shows the latest result
+    #                     at no more than preview_fps on a separate loop, "headless" skips all drawing and GUI calls
+    #   preview_thread [Boolean]: Run the preview loop on its own thread. Set to False (macOS) and call RunPreview() from the main thread.
+    #   parallel [Boolean]: Detect markers in one worker process per camera. On Windows and macOS the script creating
+    #                       Vision must keep its top-level code under if __name__ == "__main__", since workers re-import it.
+    #   scale [Float]: Search for markers in a frame downscaled by this factor first (coarse-to-fine), 1 to disable
+    #   sources [List]: Where frames come from, [left, right] for stereo or [camera] otherwise. Each one is a stream URL,
+    #                   a video file or a directory of images (see openSource). Defaults to the phone cameras.
+    #   benchmark [Boolean]: Time each processing stage (stage_times) and keep every frame's Measurement (measurement_log).
+    #                        If tracemalloc is tracing, also record the memory detection allocates (allocation_log).
+    #   on_red [Function]: Called on the tracker thread with the Measurement as soon as a red marker is seen (once per
+    #                      sighting), so the robot can be stopped without waiting for the controller
+    #   temporal_filter [Boolean]: Smooth markers across frames and predict them through short dropouts (MarkerFilter)
+    #                              instead of publishing every frame's reading as it is
+    #   calibration [String]: Stereo calibration file (see StereoCalibration). Marker positions are rectified and depth
+    #                         uses the calibrated focal length and baseline. Without it (None, or the file is missing)
+    #                         the cameras are taken as ideal, aligned pinholes with focal_length and baseline.
+    #   rectify_frames [Boolean]: Rectify whole frames before detection instead of only the detected marker centers.
+    #                             Costs a remap per frame, but the preview shows the rectified views.
+    #   decode_scale [Float]: Shrink frames by this factor as soon as they are read, and search for markers in them
+    #                         directly. MJPEG streams and files are decoded at that scale, which skips most of the
+    #                         decoding work for 0.5, 0.25 or 0.125. Readings are still in full resolution pixels.
+    #   color_table [String]: Colour table file (see thresholds.py). Pixels are labelled with one lookup each in it.
+    #                         Without it (None, or the file is missing) the HSV ranges at the top of this file are used.
+    #   recorder [SessionRecorder]: If given, every frame the tracker receives and every Measurement it publishes is
+    #                               recorded (see session.py), without waiting on the disk
+    def __init__(self, stereo, roi_tracking=False, display="window", preview_thread=True, parallel=False, scale=1.0,
+                 sources=None, benchmark=False, on_red=None, temporal_filter=True, calibration=calibration_file,
+                 rectify_frames=False, decode_scale=1.0, color_table=color_table_file, recorder=None):
+        # Working values of the tracker. Read measurement (or history) instead: these change while a frame is processed.
+        self.distance = None
+        self.angle = None
+        self.color = None
+        
+        # Published results
+        self.ready = threading.Event()  # Set once the first frame (pair) has been processed
+        self.measurement_ready = threading.Condition()
+        self.measurement = Measurement(0, None, None, None, None, 0.0)  # Latest published Measurement
+        self.history = MeasurementHistory(history_length)
+        self.on_red = on_red
+        self.marker_filter = MarkerFilter() if temporal_filter else None
+        
+        if sources is None:
+            sources = [left_camera_url, right_camera_url] if stereo else [single_camera_url]
+        self.sources = sources
+        self.decode_scale = decode_scale
+        
+        # Stereo calibration
+        self.calibration = None
+        if stereo and calibration is not None and os.path.exists(calibration):
+            self.calibration = StereoCalibration(calibration)
+        self.rectify_frames = rectify_frames and self.calibration is not None
+        
+        # Benchmarking
+        self.stage_times = {} if benchmark else None  # Total seconds spent in each stage
+        self.measurement_log = [] if benchmark else None  # Every published Measurement
+        # Bytes allocated by detection on top of what was in use, at its peak, for every frame (with tracemalloc on)
+        self.allocation_log = [] if benchmark and tracemalloc.is_tracing() else None
+
+        # Marker detection, either on the tracker thread or in one worker process per camera
+        self.roi_tracking = roi_tracking
+        self.scale = scale
+        self.color_table = loadColorTable(color_table)
+        self.detector = MarkerDetector(roi_tracking, scale, self.stage_times, decode_scale, self.color_table)
+        self.parallel = parallel
+        self.workers = {}
+        self.rejected_pairs = 0  # Stereo pairs dropped because their frames were captured too far apart
+
+        # Session recording, with the settings a replay needs to track the frames the same way
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.describeTracker(stereo=stereo, roi_tracking=roi_tracking, scale=scale,
+                                     temporal_filter=temporal_filter, rectify_frames=rectify_frames,
+                                     decode_scale=decode_scale)
+
+        # Duty cycle (see Throttle and Resume)
+        self.activity = threading.Condition()
+        self.throttled = False
+        self.skip_before = None  # Frames captured before this time are not processed
+        self.last_processed = 0.0  # When the tracker last started on a frame
+        self.frames_skipped = False  # Frames were skipped since the last one processed
+
+        # Display
+        self.display = display
+        self.preview_fps = preview_fps
+        self.preview_lock = threading.Lock()
+        self.preview = None  # Latest (views, overlay, overlay_color) waiting to be shown
+        self.tracking = True
+        self.stop_requested = False  # Set by Stop to end the tracker
+
+        self.thread = threading.Thread(target=self.TrackerThread, args=(stereo,), daemon=True)
+        self.thread.start()
+        
+        if display == "preview" and preview_thread:
+            preview = threading.Thread(target=self.RunPreview, daemon=True)
+            preview.start()
         
     def TrackerThread(self, stereo):
         print("Tracker Started")
         # Check is user wants to use stereo vision or single camera
         if stereo:
-            # Get the cameras
-            vc_left = cv2.VideoCapture("http://192.168.223.77:8080/video")   # Other phone
-            vc_right = cv2.VideoCapture("http://192.168.223.249:8080/video")  # Maher's phone
-
-            # Set frame rates
-            vc_left.set(cv2.CAP_PROP_FPS, 30)
-            vc_right.set(cv2.CAP_PROP_FPS, 30)
+            # Get the cameras, both at once (live cameras are each read on their own capture thread)
+            vc_left, vc_right = openSources(self.sources[:2], self.decode_scale)
             
-            # Try to get the first frames
-            if vc_left.isOpened() and vc_right.isOpened():
-                rval_left, frame_left = vc_left.read()
-                rval_right, frame_right = vc_right.read()
-            else:
+            if not (vc_left.IsOpened() and vc_right.IsOpened()):
                 print("\t\tERROR: Could not open video streams")
-                rval_left = False
-                rval_right = False
             
-            while rval_left and rval_right:
-                # Get the frames
-                rval_left, frame_left = vc_left.read()
-                rval_right, frame_right = vc_right.read()
-                
-                # Process the frames
-                circle_left, color_left = self.GetLocation(frame_left)     # Left frame
-                circle_right, color_right = self.GetLocation(frame_right)  # Right frame
+            pair = None
+            while not self.stop_requested:
+                self.DutyCycle(vc_left.live)
+                # Get the next pair of frames captured at (nearly) the same time
+                pair = self.GetStereoPair(vc_left, vc_right, pair)
+                if pair is None:
+                    break
+                (_, time_left, frame_left), (_, time_right, frame_right) = pair
+                self.RecordFrames([("left", time_left, frame_left), ("right", time_right, frame_right)])
+                if not self.Settled(min(time_left, time_right), vc_left.live):
+                    continue
+                if vc_left.live:
+                    metrics.observe("vision.capture_age", time.monotonic() - min(time_left, time_right))
+                if self.rectify_frames:
+                    started = time.perf_counter()
+                    frame_left = self.calibration.Rectify(frame_left, 0)
+                    frame_right = self.calibration.Rectify(frame_right, 1)
+                    recordStage(self.stage_times, "rectify", started)
                 
-                # Draw the detected circles
-                self.DrawCircle(frame_left, circle_left, color_left)
-                self.DrawCircle(frame_right, circle_right, color_right)
+                # Process the frames (left and right at the same time when running in parallel)
+                (circle_left, color_left), (circle_right, color_right) = self.DetectFrames([("left", frame_left),
+                                                                                           ("right", frame_right)])
                 
-                # Initialize flag
+                # Initialize flag and overlay text
                 same_marker_detected = False
+                overlay, overlay_color = [], (255, 255, 255)
                 
                 # Verify that both cameras detected the same marker
                 if circle_left is not None and circle_right is not None:
@@ -89,7 +1170,7 @@ class Vision:
                             same_marker_detected = True
                             
                             # Image center (principal point)
-                            image_width = frame_left.shape[1]
+                            image_width = self.CameraShape(frame_left)[1]
                             c_x = image_width / 2
                             
                             # Positions of the marker in left and right images
@@ -97,23 +1178,20 @@ class Vision:
                             x_right = circle_right[0]
                             
                             # Compute disparity, depth, and angle
-                            self.StereoVision(c_x, x_left, x_right)
+                            started = time.perf_counter()
+                            if self.calibration is not None:
+                                self.CalibratedStereoVision((frame_left.shape[1], frame_left.shape[0]),
+                                                            circle_left * self.decode_scale,
+                                                            circle_right * self.decode_scale)
+                            else:
+                                self.StereoVision(c_x, x_left, x_right)
+                            recordStage(self.stage_times, "stereo", started)
                                     
                             # Overlay the information on the video frames
                             if self.distance is not None and self.angle is not None and self.color is not None:
-                                cv2.putText(frame_left, f"Distance: {self.distance:.2f} cm", (10, 30),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                                cv2.putText(frame_left, f"Angle: {self.angle:.2f} deg", (10, 60),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                                cv2.putText(frame_left, f"Color: {self.color}", (10, 90),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                                
-                                cv2.putText(frame_right, f"Distance: {self.distance:.2f} cm", (10, 30),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                                cv2.putText(frame_right, f"Angle: {self.angle:.2f} deg", (10, 60),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                                cv2.putText(frame_right, f"Color: {self.color}", (10, 90),
-                                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+                                overlay = [f"Distance: {self.distance:.2f} cm",
+                                           f"Angle: {self.angle:.2f} deg",
+                                           f"Color: {self.color}"]
                             
                         else:
                             # Marker sizes do not match, likely not the same marker.
@@ -134,8 +1212,8 @@ class Vision:
                     self.color = None
 
                     margin = 5  # Pixel margin to check if marker is too close to the frame edges
-                    frame_height_left, frame_width_left = frame_left.shape[:2]
-                    frame_height_right, frame_width_right = frame_right.shape[:2]
+                    frame_height_left, frame_width_left = self.CameraShape(frame_left)
+                    frame_height_right, frame_width_right = self.CameraShape(frame_right)
 
                     # Determine which camera sees the marker that is better positioned within the frame
                     if circle_left is not None and circle_right is not None:
@@ -177,221 +1255,342 @@ class Vision:
 
                     if self.angle is not None:
                         # Overlay the instruction on the frames
-                        cv2.putText(frame_left, "Same marker not detected in both frames", (10, 30),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                        cv2.putText(frame_left, f"Angle: Try {self.angle:.2f} deg", (10, 60),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                        
-                        cv2.putText(frame_right, "Same marker not detected in both frames", (10, 30),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
-                        cv2.putText(frame_right, f"Angle: Try {self.angle:.2f} deg", (10, 60),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
+                        overlay = ["Same marker not detected in both frames",
+                                   f"Angle: Try {self.angle:.2f} deg"]
+                        overlay_color = (0, 0, 255)
 
-                
-                # Display the result (Does not work on macOS with threading. So comment out for macOS, uncomment for Windows)
-                cv2.imshow("Left Camera", frame_left)
-                cv2.imshow("Right Camera", frame_right)
-                
-                # Check if esc key pressed
-                if cv2.waitKey(1) & 0xFF == 27:
+                # Display the result, unless running headless
+                views = [("Left Camera", frame_left, circle_left, color_left),
+                         ("Right Camera", frame_right, circle_right, color_right)]
+                self.PublishMeasurement(min(time_left, time_right))
+                if not self.ShowResult(views, overlay, overlay_color):
                     break
             
-            vc_left.release()
-            vc_right.release()
-            cv2.destroyAllWindows()
-            print("Tracker Ended")
+            vc_left.Stop()
+            vc_right.Stop()
+            if self.stage_times is not None:
+                self.stage_times["decode"] = vc_left.decode_time + vc_right.decode_time
+            self.StopTracker()
         
         else:
-            vc = cv2.VideoCapture("http://192.168.223.249:8080/video")  # Maher's phone
+            vc = openSource(self.sources[0], self.decode_scale)
             
-            # Try to get the first frames
-            if vc.isOpened():
-                rval, frame = vc.read()
-            else:
+            if not vc.IsOpened():
                 print("\t\tERROR: Could not open video stream")
-                rval = False
             
-            while rval:
-                # Get the frame
-                rval, frame = vc.read()
+            frame_id = 0
+            while not self.stop_requested:
+                self.DutyCycle(vc.live)
+                # Get the newest frame
+                latest = vc.WaitForFrame(frame_id)
+                if latest is None:
+                    break
+                frame_id, captured, frame = latest
+                self.RecordFrames([("single", captured, frame)])
+                if not self.Settled(captured, vc.live):
+                    continue
+                if vc.live:
+                    metrics.observe("vision.capture_age", time.monotonic() - captured)
                 
                 # Process the frame
-                circle, color = self.GetLocation(frame)
-                
-                # Draw the detected circle
-                self.DrawCircle(frame, circle, color)
+                [(circle, color)] = self.DetectFrames([("single", frame)])
                 
                 # Calculate distance to marker and angle to marker
+                overlay = []
                 if circle is not None:
                     self.color = color
                         
                     # Frame dimensions
-                    frame_height = frame.shape[0]
-                    frame_width = frame.shape[1]
+                    frame_height, frame_width = self.CameraShape(frame)
                     
                     # Compute disparity, depth, and angle
+                    started = time.perf_counter()
                     self.SingleCameraCalculations(frame_height, frame_width, circle)
+                    recordStage(self.stage_times, "stereo", started)
                             
                     # Overlay the information on the video frames
                     if self.distance is not None and self.angle is not None and self.color is not None:
-                        cv2.putText(frame, f"Distance: {self.distance:.2f} cm", (10, 30),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                        cv2.putText(frame, f"Angle: {self.angle:.2f} deg", (10, 60),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-                        cv2.putText(frame, f"Color: {self.color}", (10, 90),
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+                        overlay = [f"Distance: {self.distance:.2f} cm",
+                                   f"Angle: {self.angle:.2f} deg",
+                                   f"Color: {self.color}"]
                 else:
                     # Reset readings to avoid misinformation
                     self.distance = None
                     self.angle = None
                     self.color = None
                 
-                # Display the result (Does not work on macOS with threading. So comment out for macOS, uncomment for Windows)
-                cv2.imshow("Camera", frame)
-                
-                # Check if esc key pressed
-                if cv2.waitKey(1) & 0xFF == 27:
+                # Display the result, unless running headless
+                self.PublishMeasurement(captured)
+                if not self.ShowResult([("Camera", frame, circle, color)], overlay, (255, 255, 255)):
                     break
             
-            vc.release()
-            cv2.destroyAllWindows()
-            print("Tracker Ended")
+            vc.Stop()
+            if self.stage_times is not None:
+                self.stage_times["decode"] = vc.decode_time
+            self.StopTracker()
     
-    def StereoVision(self, c_x, x_left, x_right):        
-        disparity = abs(x_left - x_right)  # In pixels
+    # Hands the annotated result of one tracker iteration to the display.
+    # Input:
+    #   views [List]: (window name, frame, circle, color) for each camera
+    #   overlay [List]: Lines of text to write on every frame
+    #   overlay_color [Tuple]: BGR color of the text
+    # Output: False if the user pressed esc in the tracker's own window, True otherwise
+    def ShowResult(self, views, overlay, overlay_color):
+        if self.display == "headless":
+            return True
         
-        if disparity != 0:
-            # Calculate depth (Z)
-            Z = (focal_length * baseline) / disparity  # Depth in meters
-            self.distance = Z * 100  # Depth in centimeters
-            
-            # Calculate the average x-position of the marker
-            x_center_image = (x_left + x_right) / 2  # In pixels
-            
-            # Calculate horizontal displacement (X)
-            X = (x_center_image - c_x) * Z / focal_length  # In meters
-            
-            # Calculate the angle in radians
-            angle_rad = np.arctan2(X, Z)
-            # Convert to degrees
-            self.angle = np.degrees(angle_rad)
-
-        else:
-            print("\t\tERROR: Disparity is zero, cannot compute depth")
-            self.distance = None
-            self.angle = None
-            self.color = None
+        if self.display == "preview":
+            # The preview loop draws (on a copy) and shows the latest result at its own rate
+            with self.preview_lock:
+                self.preview = (views, overlay, overlay_color)
+            return True
+        
+        # Display the result on the tracker thread (Does not work on macOS with threading, use "preview" there)
+        for name, frame, circle, color in views:
+            self.DrawOverlay(frame, circle, color, overlay, overlay_color)
+            cv2.imshow(name, frame)
+        
+        # Check if esc key pressed
+        return cv2.waitKey(1) & 0xFF != 27
+    
+    # Shows the tracker's latest result at no more than preview_fps frames per second, until the tracker ends or esc is pressed.
+    # Started on its own thread by default. On macOS, create Vision with preview_thread=False and call this from the main thread.
+    def RunPreview(self):
+        shown = None
+        while self.tracking:
+            started = time.monotonic()
             
-    def SingleCameraCalculations(self, frame_height, frame_width, circle):
-        # Extract the marker's information
-        x, y, radius = circle
-        c_x = frame_width / 2
-
-        # Contour completeness check
-        margin = 5  # Pixel margin to check if marker is too close to the frame edges
-        tolerance = 15  # degrees (tolerance for angle to the marker)
-        if (x - radius < margin or x + radius > frame_width - margin):
-            if round(radius) < 55:
-                self.distance = None
-                self.color = radius
-                if x - c_x > tolerance:
-                    self.angle = 20
-                elif x - c_x < -tolerance:
-                    self.angle = -20
-                else:
-                    self.angle = 0
-                return
-        if (y - radius < margin or y + radius > frame_height - margin):
-            if round(radius) < 65:
-                self.distance = None
-                self.color = radius
-                if x - c_x > 0:
-                    self.angle = 20
-                elif x - c_x < 0:
-                    self.angle = -20
-                else:
-                    self.angle = 0
-                return
+            with self.preview_lock:
+                latest = self.preview
+            if latest is not None and latest is not shown:
+                views, overlay, overlay_color = latest
+                for name, frame, circle, color in views:
+                    frame = frame.copy()
+                    self.DrawOverlay(frame, circle, color, overlay, overlay_color)
+                    cv2.imshow(name, frame)
+                shown = latest
             
-        # Minimum radius threshold to filter out small unreliable detections
-        threshold = 20  # Pixels
-        if radius < threshold:
-            self.distance = None
-            self.angle = None
-            self.color = None
+            # Check if esc key pressed
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+            time.sleep(max(1.0 / self.preview_fps - (time.monotonic() - started), 0))
+        
+        cv2.destroyAllWindows()
+    
+    # Output: (height, width) of the camera's frames at full resolution (see decode_scale)
+    def CameraShape(self, frame):
+        return round(frame.shape[0] / self.decode_scale), round(frame.shape[1] / self.decode_scale)
+    
+    # Finds the marker in each camera's frame.
+    # Input:
+    #   frames [List]: (camera name, frame) for each camera
+    # Output: List of (circle, color), one per camera
+    def DetectFrames(self, frames):
+        if self.allocation_log is not None and not self.parallel:
+            tracemalloc.reset_peak()
+            in_use = tracemalloc.get_traced_memory()[0]
+            detections = [self.detector.TrackLocation(frame, camera) for camera, frame in frames]
+            self.allocation_log.append(tracemalloc.get_traced_memory()[1] - in_use)
+            return detections
+        if not self.parallel:
+            return [self.detector.TrackLocation(frame, camera) for camera, frame in frames]
+        
+        # Hand every frame to its camera's worker first, then wait for all of them
+        for camera, frame in frames:
+            worker = self.workers.get(camera)
+            if worker is None or worker.shape != frame.shape:
+                # First frame, or the stream resolution changed
+                if worker is not None:
+                    worker.Stop()
+                worker = self.workers[camera] = DetectionWorker(frame.shape, self.roi_tracking, self.scale,
+                                                                self.decode_scale, self.color_table)
+            worker.Submit(frame)
+        return [self.workers[camera].Result() for camera, _ in frames]
+    
+    # Hands the frames just received to the session recorder, if there is one.
+    # Input: frames [List]: (camera name, capture time, frame) for each camera
+    def RecordFrames(self, frames):
+        if self.recorder is None:
             return
+        for camera, captured, frame in frames:
+            # The tracker's own window draws on the frames it shows
+            self.recorder.recordFrame(camera, captured, frame.copy() if self.display == "window" else frame)
+    
+    # Publishes the tracker's current distance, angle and color (through the marker filter) as one Measurement
+    def PublishMeasurement(self, timestamp):
+        distance, angle, color = self.distance, self.angle, self.color
+        confidence = 1.0 if angle is not None else 0.0
+        if self.marker_filter is not None:
+            distance, angle, color, confidence = self.marker_filter.Update(timestamp, distance, angle, color)
         
-        # Calculate the distance to the marker using scaling
-        if radius > 0:
-            # Approach 1
-            self.distance = (distance_to_largest_marker_radius * largest_marker_radius) / radius  # Distance in cm
-
-            # Calculate the angle to the marker
-            del_x = x - c_x  # Horizontal Displacement
+        with self.measurement_ready:
+            red_seen = color == 'red' and self.measurement.color != 'red'
+            self.measurement = Measurement(self.measurement.sequence + 1, timestamp, distance, angle, color, confidence)
+            measurement = self.measurement
+            self.history.Append(measurement)
+            if self.measurement_log is not None:
+                self.measurement_log.append(measurement)
+            self.ready.set()  # Under the lock, so WaitUntilReady cannot miss the first notify
+            self.measurement_ready.notify_all()
+        metrics.count("vision.frames")
+        if self.recorder is not None:
+            self.recorder.recordEvent(session.MEASUREMENT, measurement._asdict(), timestamp)
+        if red_seen and self.on_red is not None:
+            self.on_red(measurement)
+    
+    # Tells the marker filter how the car is moving, so markers are predicted where they will be seen.
+    # Input:
+    #   velocity [Float]: cm/s forward (negative when reversing)
+    #   turn_rate [Float]: radians/s (positive turns right)
+    def SetMotion(self, velocity, turn_rate):
+        if self.marker_filter is not None:
+            self.marker_filter.motion = (velocity, turn_rate)
+    
+    # Hint from the controller: the car is moving and nobody is waiting for a measurement (its frames are blurred anyway),
+    # so process no more than throttled_fps frames per second. Red markers are still seen (see on_red), a little later.
+    def Throttle(self):
+        with self.activity:
+            self.throttled = True
+    
+    # Hint from the controller: measurements are needed again. Processing goes back to every frame right away, skipping
+    # frames captured before since (time.monotonic), so the first measurement published is a settled one.
+    def Resume(self, since=None):
+        with self.activity:
+            self.throttled = False
+            self.skip_before = since
+            self.activity.notify_all()
+    
+    # Waits, before the tracker asks its sources for the next frame, until it may process one: throttled_fps after the
+    # last frame while throttled, and until skip_before with live sources (see Throttle and Resume). Frames that arrive
+    # meanwhile are never fetched, so they are never decoded either.
+    # Input: live [Boolean]: Whether the sources' timestamps are time.monotonic() capture times
+    def DutyCycle(self, live):
+        with self.activity:
+            while not self.stop_requested:
+                if self.throttled:
+                    wait = self.last_processed + 1.0 / throttled_fps - time.monotonic()
+                    metric = "vision.throttled_frames"
+                elif live and self.skip_before is not None:
+                    wait = self.skip_before - time.monotonic()
+                    metric = "vision.unsettled_frames"
+                else:
+                    break
+                if wait <= 0:
+                    break
+                # Resume wakes the tracker up early
+                self.activity.wait(wait)
+                metrics.count(metric)
+                self.frames_skipped = True
+            self.last_processed = time.monotonic()
+    
+    # Decides whether the tracker processes the frame it fetched after DutyCycle.
+    # Input:
+    #   timestamp [Float]: Capture time of the frame
+    #   live [Boolean]: Whether the timestamp is a time.monotonic() capture time (recording positions are never skipped)
+    # Output: False to skip the frame (captured before skip_before) and fetch the next one instead
+    def Settled(self, timestamp, live):
+        with self.activity:
+            if live and self.skip_before is not None and timestamp < self.skip_before:
+                metrics.count("vision.unsettled_frames")
+                self.frames_skipped = True
+                return False
+            if self.frames_skipped and self.marker_filter is not None:
+                self.marker_filter.Resync()
+            self.frames_skipped = False
+            return True
+    
+    # Blocks until a measurement newer than after_sequence is published.
+    # Output: The latest Measurement, or None if the timeout (seconds) ran out first
+    def WaitForMeasurement(self, after_sequence, timeout=None):
+        with self.measurement_ready:
+            if self.measurement_ready.wait_for(lambda: self.measurement.sequence > after_sequence, timeout):
+                return self.measurement
+            return None
+    
+    # Blocks until the tracker has processed its first frame (pair), so its measurements can be acted on.
+    # Output: False if the tracker ended first (e.g. the cameras could not be opened) or the timeout (seconds) ran out
+    def WaitUntilReady(self, timeout=startup_timeout):
+        with self.measurement_ready:
+            self.measurement_ready.wait_for(lambda: self.ready.is_set() or not self.tracking, timeout)
+        return self.ready.is_set()
+    
+    # Ends the tracker after the frame it is working on, and waits (up to timeout seconds) for it to close its streams
+    def Stop(self, timeout=stream_timeout):
+        self.stop_requested = True
+        self.Resume()  # In case it is waiting while throttled
+        self.thread.join(timeout)
+    
+    def StopTracker(self):
+        with self.measurement_ready:
+            self.tracking = False
+            self.measurement_ready.notify_all()
+        for worker in self.workers.values():
+            worker.Stop()
+        if self.display == "window":
+            cv2.destroyAllWindows()
+        print("Tracker Ended")
+    
+    # Pairs the newest frames of the two cameras by capture time.
+    # Input:
+    #   left_camera, right_camera [FrameGrabber]: The two camera streams
+    #   last_pair [Tuple]: The pair returned by the previous call (None on the first call), so no frame is used twice
+    # Output: ((frame_id, timestamp, frame) left, (frame_id, timestamp, frame) right), or None if a stream ended
+    def GetStereoPair(self, left_camera, right_camera, last_pair=None):
+        last_left_id, last_right_id = (last_pair[0][0], last_pair[1][0]) if last_pair is not None else (0, 0)
+        left = left_camera.WaitForFrame(last_left_id)
+        right = right_camera.WaitForFrame(last_right_id)
+        
+        while left is not None and right is not None:
+            skew = left[1] - right[1]
+            if abs(skew) <= max_pair_skew:
+                return left, right
             
-            # Calculate the angle in radians and then convert to degrees
-            angle_rad = np.arctan2(del_x, focal_length)
-            self.angle = np.degrees(angle_rad)
+            # The camera that is behind may have a newer frame closer in time to the other camera's frame
+            if skew < 0:
+                newer = left_camera.WaitForFrame(left[0])
+                if newer is not None and abs(newer[1] - right[1]) >= abs(skew):
+                    # No closer frame exists, so the pair is too far apart. Drop it and start over.
+                    self.rejected_pairs += 1
+                    metrics.count("vision.rejected_pairs")
+                    right = right_camera.WaitForFrame(right[0])
+                left = newer
+            else:
+                newer = right_camera.WaitForFrame(right[0])
+                if newer is not None and abs(newer[1] - left[1]) >= abs(skew):
+                    # No closer frame exists, so the pair is too far apart. Drop it and start over.
+                    self.rejected_pairs += 1
+                    metrics.count("vision.rejected_pairs")
+                    left = left_camera.WaitForFrame(left[0])
+                right = newer
+        
+        return None
+    
+    # Same as StereoVision, with the calibrated cameras (see StereoCalibration.Locate)
+    # Input:
+    #   size [Tuple]: (width, height) of the frames
+    #   circle_left, circle_right [Array]: The marker's (x, y, radius) in the left and right frames
+    def CalibratedStereoVision(self, size, circle_left, circle_right):
+        location = self.calibration.Locate(circle_left, circle_right, size, self.rectify_frames)
+        if location is not None:
+            self.distance, self.angle = location
         else:
+            print("\t\tERROR: Disparity is zero, cannot compute depth")
             self.distance = None
             self.angle = None
-            self.color = None     
-        
-    def GetLocation(self, frame):
-        # Convert the frame to HSV color space
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        
-        # Initialize list to hold contours with their colors
-        contours_with_color = []
-        
-        # Process red color
-        # Red mask may span across the hue range, so combine two masks
-        mask1 = cv2.inRange(hsv, redLower1, redUpper1)
-        mask2 = cv2.inRange(hsv, redLower2, redUpper2)
-        red_mask = cv2.bitwise_or(mask1, mask2)
-        # Morphological operations
-        mask = cv2.erode(red_mask, None, iterations=2)
-        mask = cv2.dilate(mask, None, iterations=2)
-        # Find contours
-        contours, _ = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        for c in contours:
-            contours_with_color.append(('red', c))
-        
-        # Process yellow color
-        yellow_mask = cv2.inRange(hsv, yellowLower, yellowUpper)
-        mask = cv2.erode(yellow_mask, None, iterations=2)
-        mask = cv2.dilate(mask, None, iterations=2)
-        contours, _ = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        for c in contours:
-            contours_with_color.append(('yellow', c))
-        
-        # Process green color
-        green_mask = cv2.inRange(hsv, greenLower, greenUpper)
-        mask = cv2.erode(green_mask, None, iterations=2)
-        mask = cv2.dilate(mask, None, iterations=2)
-        contours, _ = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        for c in contours:
-            contours_with_color.append(('green', c))
-            
-        # Proceed only if at least one contour was found
-        if len(contours_with_color) > 0:
-            # Sort the contours by area in descending order
-            contours_with_color.sort(key=lambda x: cv2.contourArea(x[1]), reverse=True)
+            self.color = None
             
-            # Iterate through the sorted contours to find the first valid one
-            for color, contour in contours_with_color:
-                # Determine the circle enclosing the current contour
-                ((x, y), radius) = cv2.minEnclosingCircle(contour)
-                if 20 < radius <= largest_marker_radius:
-                    # Return the circle parameters and the color
-                    return np.array([x, y, radius]), color
+    def DrawOverlay(self, frame, circle, color_name, overlay, overlay_color):
+        # Draw the detected circle
+        self.DrawCircle(frame, circle, color_name)
         
-        return None, None
-
+        # Overlay the information on the video frame
+        for line, text in enumerate(overlay):
+            cv2.putText(frame, text, (10, 30 * (line + 1)), cv2.FONT_HERSHEY_SIMPLEX, 0.7, overlay_color, 2)
+    
     def DrawCircle(self, frame, circle, color_name):
         if circle is not None:
             # Convert the circle parameters to integers
-            x, y, r = np.round(circle).astype("int")
+            x, y, r = np.round(circle * self.decode_scale).astype("int")
             # Draw the circle in the output image
             cv2.circle(frame, (x, y), r, (0, 255, 0), 2)
             # Set the dotColor based on color_name
@@ -407,20 +1606,22 @@ class Vision:
             cv2.rectangle(frame, (x - 5, y - 5), (x + 5, y + 5), dotColor, -1)
 
 if __name__ == "__main__":
-    vision = Vision(stereo=True)
+    vision = Vision(stereo=True, display="preview")
     print("Tracker Initializing...")
-    time.sleep(5)  # Wait for the tracker to initialize
+    if not vision.WaitUntilReady():
+        raise SystemExit("\t\tERROR: The tracker processed no frames, check the camera streams")
     
     while True:
         # Output the distance, angle, and color
-        if vision.angle is not None:
-            if vision.distance is not None:
-                print(f"Distance to the marker: {vision.distance:.2f} centimeters")
+        measurement = vision.measurement
+        if measurement.angle is not None:
+            if measurement.distance is not None:
+                print(f"Distance to the marker: {measurement.distance:.2f} centimeters")
 
-            print(f"Angle to the marker: {vision.angle:.2f} degrees")
+            print(f"Angle to the marker: {measurement.angle:.2f} degrees")
             
-            if vision.color is not None:
-                print(f"Color of the marker: {vision.color}")
+            if measurement.color is not None:
+                print(f"Color of the marker: {measurement.color}")
         
         else:
             print("\t\tERROR: No markers detected.")